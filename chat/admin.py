@@ -1,5 +1,8 @@
 from django.contrib import admin
-from .models import ChatSession, Message, ChatWidget, AutomatedResponse, AutomatedResponseLog
+from .models import (
+    ChatSession, Message, ChatWidget, AutomatedResponse, AutomatedResponseLog, ScheduledResponse,
+    BusinessCalendar, BusinessHours, Holiday, ChunkedUpload, AttachmentBlob,
+)
 
 
 @admin.register(ChatSession)
@@ -7,7 +10,8 @@ class ChatSessionAdmin(admin.ModelAdmin):
     list_display = ['id', 'customer_name', 'customer_id', 'status', 'unread_messages_count', 'created_at', 'updated_at']
     list_filter = ['status', 'created_at', 'updated_at']
     search_fields = ['customer_name', 'customer_email', 'customer_id']
-    readonly_fields = ['id', 'created_at', 'updated_at']
+    readonly_fields = ['id', 'created_at', 'updated_at', 'unread_count', 'customer_message_count',
+                       'last_message', 'last_message_preview', 'last_activity_at']
     
     def unread_messages_count(self, obj):
         return obj.unread_messages_count
@@ -83,3 +87,56 @@ class AutomatedResponseLogAdmin(admin.ModelAdmin):
     def has_change_permission(self, request, obj=None):
         # Logs are read-only
         return False
+
+
+@admin.register(ScheduledResponse)
+class ScheduledResponseAdmin(admin.ModelAdmin):
+    list_display = ['chat_session', 'automated_response', 'status', 'due_at', 'created_at']
+    list_filter = ['status', 'due_at']
+    readonly_fields = ['chat_session', 'automated_response', 'trigger_message_content', 'due_at', 'created_at']
+    
+    def has_add_permission(self, request):
+        # Scheduled responses are created by the automated response service
+        return False
+
+
+class BusinessHoursInline(admin.TabularInline):
+    model = BusinessHours
+    extra = 0
+
+
+class HolidayInline(admin.TabularInline):
+    model = Holiday
+    extra = 0
+
+
+@admin.register(BusinessCalendar)
+class BusinessCalendarAdmin(admin.ModelAdmin):
+    list_display = ['name', 'timezone', 'is_active', 'updated_at']
+    list_filter = ['is_active']
+    readonly_fields = ['created_at', 'updated_at']
+    inlines = [BusinessHoursInline, HolidayInline]
+
+
+@admin.register(ChunkedUpload)
+class ChunkedUploadAdmin(admin.ModelAdmin):
+    list_display = ['filename', 'customer_id', 'content_type', 'received', 'size', 'status', 'updated_at']
+    list_filter = ['status', 'content_type']
+    search_fields = ['filename', 'customer_id']
+    readonly_fields = ['id', 'customer_id', 'filename', 'content_type', 'size', 'received', 'status',
+                       'attachment_path', 'created_at', 'updated_at']
+    
+    def has_add_permission(self, request):
+        # Uploads are created by the widget upload endpoints
+        return False
+
+
+@admin.register(AttachmentBlob)
+class AttachmentBlobAdmin(admin.ModelAdmin):
+    list_display = ['path', 'size', 'ref_count', 'created_at', 'updated_at']
+    search_fields = ['sha256', 'path']
+    readonly_fields = ['sha256', 'path', 'size', 'ref_count', 'created_at', 'updated_at']
+    
+    def has_add_permission(self, request):
+        # Blobs are created when attachments are uploaded
+        return False
@@ -0,0 +1,388 @@
+"""
+In-process WebSocket load benchmark for the chat consumers
+
+Opens N widget sockets (ChatConsumer) and M admin sockets
+(AdminDashboardConsumer) with channels.testing.WebsocketCommunicator, drives
+customer messages at a fixed offered rate through ChatConsumer.receive and the
+automated response path, and records end-to-end latency for:
+
+- widget_echo: customer message sent -> echoed back to the sender's socket
+- admin_notify: customer message sent -> conversation list update on each admin socket
+- auto_reply: keyword message sent -> automated reply on the sender's socket
+
+Messages are sent open-loop (on a schedule, not after the previous reply), so
+latency includes queueing once the worker falls behind. Run it through the
+bench_websockets management command.
+
+measure_wire_codecs() compares the negotiable wire protocols (chat/wire.py) on
+representative frames: bytes per frame, bytes after per-message deflate, and
+encode/decode cost. Run it through bench_wire_protocol.
+"""
+import asyncio
+import math
+import random
+import time
+import timeit
+import uuid
+import zlib
+from collections import defaultdict, deque
+
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+
+from .db_executor import db_executor_metrics
+from .models import AutomatedResponse
+from .routing import websocket_urlpatterns
+from .wire import CODECS, DEFAULT_CODEC
+
+
+BENCH_AGENT_USERNAME = 'bench_agent'
+AUTO_REPLY_KEYWORD = 'benchprice'
+AUTO_REPLY_TEXT = 'Benchmark automated reply'
+
+# Longest time a socket reader waits for one frame; readers are cancelled when the run ends
+READ_TIMEOUT = 3600
+
+# How often the harness checks whether every expected frame has arrived
+DRAIN_POLL_INTERVAL = 0.05
+
+LATENCY_METRICS = ['widget_echo', 'admin_notify', 'auto_reply']
+
+# Presence, stats deltas and rule-engine version stamps written during a run
+# must not reach the deployment's shared cache
+BENCHMARK_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'chat-benchmark',
+    }
+}
+
+
+def layer_config(name, redis_url=None):
+    """CHANNEL_LAYERS entry for a benchmark run"""
+    if name == 'inmemory':
+        return {'BACKEND': 'channels.layers.InMemoryChannelLayer'}
+    if name == 'redis':
+        return {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {'hosts': [redis_url]},
+        }
+    raise ValueError(f'Unknown channel layer: {name}')
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples, or None if it is empty"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def summarize_latency(samples):
+    """Count and p50/p95/p99/max in milliseconds"""
+    summary = {'count': len(samples)}
+    for name, pct in [('p50', 50), ('p95', 95), ('p99', 99), ('max', 100)]:
+        value = percentile(samples, pct)
+        summary[name] = round(value * 1000, 2) if value is not None else None
+    return summary
+
+
+@database_sync_to_async
+def create_fixtures():
+    """Staff user for the admin sockets and the keyword rule used for auto-replies"""
+    agent, _ = User.objects.get_or_create(
+        username=BENCH_AGENT_USERNAME, defaults={'is_staff': True}
+    )
+    AutomatedResponse.objects.update_or_create(
+        name='Benchmark auto-reply',
+        defaults={
+            'trigger_type': 'keyword',
+            'keywords': AUTO_REPLY_KEYWORD,
+            'response_message': AUTO_REPLY_TEXT,
+            'is_active': True,
+            'delay_seconds': 0,
+        },
+    )
+    return agent
+
+
+def _application(user):
+    """WebSocket router with a fixed user in the scope (stands in for AuthMiddlewareStack)"""
+    router = URLRouter(websocket_urlpatterns)
+
+    async def application(scope, receive, send):
+        return await router(dict(scope, user=user), receive, send)
+
+    return application
+
+
+class LoadRun:
+    """State for one benchmark run: sockets, send times and latency samples"""
+
+    def __init__(self, widgets, admins, rate, duration, auto_reply_ratio, admin_batch_ms=0, seed=0):
+        self.widgets = widgets
+        self.admins = admins
+        self.admin_batch_ms = admin_batch_ms
+        self.rate = rate
+        self.duration = duration
+        self.auto_reply_ratio = auto_reply_ratio
+        self.seed = seed
+        self.run_id = uuid.uuid4().hex[:8]
+        self.sent_at = {}
+        self.admin_unacknowledged = [defaultdict(deque) for _ in range(admins)]
+        self.pending_auto_replies = {}
+        self.samples = {name: [] for name in LATENCY_METRICS}
+        self.sent = 0
+        self.auto_triggers = 0
+        self.frames_received = 0
+        self.last_delivery = None
+
+    def expected(self):
+        return {
+            'widget_echo': self.sent,
+            'admin_notify': self.sent * self.admins,
+            'auto_reply': self.auto_triggers,
+        }
+
+    def complete(self):
+        expected = self.expected()
+        return all(len(self.samples[name]) >= expected[name] for name in LATENCY_METRICS)
+
+    def _record(self, metric, sent_at):
+        now = time.perf_counter()
+        self.samples[metric].append(now - sent_at)
+        self.last_delivery = now
+
+    async def _read_widget(self, communicator, customer_id):
+        while True:
+            data = await communicator.receive_json_from(timeout=READ_TIMEOUT)
+            self.frames_received += 1
+            if data.get('type') != 'chat_message':
+                continue
+            if data['sender_type'] == 'customer':
+                sent_at = self.sent_at.get(data['message'])
+                if sent_at is not None:
+                    self._record('widget_echo', sent_at)
+            elif data['message'] == AUTO_REPLY_TEXT:
+                pending = self.pending_auto_replies.get(customer_id)
+                if pending:
+                    self._record('auto_reply', pending.pop(0))
+
+    async def _read_admin(self, communicator, index):
+        unacknowledged = self.admin_unacknowledged[index]
+        while True:
+            data = await communicator.receive_json_from(timeout=READ_TIMEOUT)
+            self.frames_received += 1
+            # Batched frames are arrays; a merged row also acknowledges the messages it superseded
+            for event in data if isinstance(data, list) else [data]:
+                if event.get('type') != 'session_update':
+                    continue
+                pending = unacknowledged[event['session']['customer_id']]
+                preview = event['session']['last_message_preview']
+                if not any(text == preview for text, _ in pending):
+                    continue
+                while pending:
+                    text, sent_at = pending.popleft()
+                    self._record('admin_notify', sent_at)
+                    if text == preview:
+                        break
+
+    async def _drive_widget(self, communicator, customer_id, index, start, end):
+        rng = random.Random(f'{self.seed}:{index}')
+        interval = self.widgets / self.rate
+        next_send = start + index / self.rate
+        sequence = 0
+        while next_send < end:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            is_trigger = rng.random() < self.auto_reply_ratio
+            prefix = AUTO_REPLY_KEYWORD if is_trigger else 'bench'
+            text = f'{prefix} {customer_id} {sequence}'
+            sent_at = time.perf_counter()
+            self.sent_at[text] = sent_at
+            for unacknowledged in self.admin_unacknowledged:
+                unacknowledged[customer_id].append((text, sent_at))
+            if is_trigger:
+                self.pending_auto_replies.setdefault(customer_id, []).append(sent_at)
+                self.auto_triggers += 1
+            self.sent += 1
+            await communicator.send_json_to({
+                'type': 'chat_message',
+                'message': text,
+                'sender_type': 'customer',
+                'sender_name': 'Benchmark',
+            })
+            sequence += 1
+            next_send += interval
+
+    async def run(self, drain_timeout=10):
+        agent = await create_fixtures()
+        widget_app = _application(AnonymousUser())
+        admin_app = _application(agent)
+
+        widget_sockets = []
+        for index in range(self.widgets):
+            customer_id = f'bench_{self.run_id}_{index}'
+            communicator = WebsocketCommunicator(widget_app, f'/ws/chat/{customer_id}/')
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise RuntimeError(f'Widget socket {customer_id} was rejected')
+            widget_sockets.append((communicator, customer_id))
+
+        admin_sockets = []
+        for _ in range(self.admins):
+            communicator = WebsocketCommunicator(
+                admin_app, f'/ws/admin/dashboard/?topics=sessions&batch_ms={self.admin_batch_ms}'
+            )
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise RuntimeError('Admin socket was rejected')
+            admin_sockets.append(communicator)
+
+        readers = [asyncio.ensure_future(self._read_widget(c, cid)) for c, cid in widget_sockets]
+        readers += [asyncio.ensure_future(self._read_admin(c, i)) for i, c in enumerate(admin_sockets)]
+
+        try:
+            start = time.perf_counter()
+            end = start + self.duration
+            await asyncio.gather(*[
+                self._drive_widget(communicator, customer_id, index, start, end)
+                for index, (communicator, customer_id) in enumerate(widget_sockets)
+            ])
+            send_finished = time.perf_counter()
+
+            # Wait for the backlog to drain
+            drain_deadline = send_finished + drain_timeout
+            while not self.complete() and time.perf_counter() < drain_deadline:
+                for reader in readers:
+                    if reader.done():
+                        reader.result()
+                await asyncio.sleep(DRAIN_POLL_INTERVAL)
+        finally:
+            for reader in readers:
+                reader.cancel()
+            await asyncio.gather(*readers, return_exceptions=True)
+            for communicator, _ in widget_sockets:
+                await communicator.disconnect()
+            for communicator in admin_sockets:
+                await communicator.disconnect()
+
+        return self.report(start, send_finished)
+
+    def report(self, start, send_finished):
+        delivered_until = self.last_delivery or send_finished
+        echoed = len(self.samples['widget_echo'])
+        expected = self.expected()
+        return {
+            'widgets': self.widgets,
+            'admins': self.admins,
+            'admin_batch_ms': self.admin_batch_ms,
+            'offered_rate': self.rate,
+            'duration': round(send_finished - start, 3),
+            'messages_sent': self.sent,
+            'auto_reply_triggers': self.auto_triggers,
+            'send_rate': round(self.sent / (send_finished - start), 2),
+            'processed_rate': round(echoed / (delivered_until - start), 2),
+            'frames_received': self.frames_received,
+            'frames_per_second': round(self.frames_received / (delivered_until - start), 2),
+            'missing': {
+                name: expected[name] - len(self.samples[name]) for name in LATENCY_METRICS
+            },
+            'latency_ms': {
+                name: summarize_latency(self.samples[name]) for name in LATENCY_METRICS
+            },
+            'db_executor': db_executor_metrics(),
+        }
+
+
+async def run_benchmark(widgets=10, admins=2, rate=50, duration=10, auto_reply_ratio=0.1,
+                        admin_batch_ms=0, drain_timeout=10, seed=0):
+    """Run one load test against the configured channel layer and return its report"""
+    load_run = LoadRun(widgets, admins, rate, duration, auto_reply_ratio, admin_batch_ms=admin_batch_ms, seed=seed)
+    return await load_run.run(drain_timeout=drain_timeout)
+
+
+def sample_frames():
+    """Typical outbound frames, keyed by a short description"""
+    timestamp = '2024-05-01T10:15:30.123456+00:00'
+    session = {
+        'id': '3f2c8a9e-6d1b-4c7e-9a53-1b2d3e4f5a6b',
+        'customer_id': 'customer_1714558530123_k3j9x2m1q',
+        'customer_name': 'Jane Doe',
+        'customer_email': 'jane@example.com',
+        'status': 'open',
+        'unread_count': 2,
+        'last_message_preview': 'Hi, I have a question about my invoice',
+        'updated_at': timestamp,
+    }
+    stats = {
+        'total_sessions': 1520, 'open_sessions': 37, 'closed_sessions': 1483,
+        'unread_messages': 12, 'recent_sessions': 204,
+    }
+    chat_message = {
+        'type': 'chat_message',
+        'message': 'Hi, I have a question about my invoice',
+        'sender_type': 'admin',
+        'sender_name': 'Support Agent',
+        'timestamp': timestamp,
+        'message_id': '8b7e2f1a-0c3d-4e5f-9a8b-7c6d5e4f3a2b',
+        'attachment_url': None,
+    }
+    notification = {
+        'type': 'new_message_notification',
+        'chat_session_id': session['id'],
+        'customer_id': session['customer_id'],
+        'message': chat_message['message'],
+        'sender_type': 'customer',
+        'sender_name': 'Jane Doe',
+        'timestamp': timestamp,
+        'attachment_url': None,
+        'stats': None,
+        'stats_delta': {'unread_messages': 1},
+        'session': session,
+    }
+    stats_update = {'type': 'stats_update', 'stats': stats}
+    session_update = {'type': 'session_update', 'session': session}
+    return {
+        'widget chat_message': chat_message,
+        'admin new_message_notification': notification,
+        'admin session_update': session_update,
+        'admin stats_update': stats_update,
+        'admin batch of 10 rows': [session_update] * 10,
+    }
+
+
+def _deflated_size(data):
+    """Size after per-message deflate without context takeover (RFC 7692)"""
+    if isinstance(data, str):
+        data = data.encode()
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+
+
+def measure_wire_codecs(iterations=20000):
+    """
+    Bytes and encode/decode cost of every wire codec for each sample frame
+    Returns a list of dicts, one per (frame, codec)
+    """
+    results = []
+    for frame_name, payload in sample_frames().items():
+        for codec in [DEFAULT_CODEC] + CODECS:
+            encoded = codec.encode(payload)
+            size = len(encoded.encode() if isinstance(encoded, str) else encoded)
+            encode_time = timeit.timeit(lambda: codec.encode(payload), number=iterations)
+            decode_time = timeit.timeit(lambda: codec.decode(encoded), number=iterations)
+            results.append({
+                'frame': frame_name,
+                'protocol': codec.subprotocol or 'json',
+                'bytes': size,
+                'deflated_bytes': _deflated_size(encoded),
+                'encode_us': round(encode_time / iterations * 1e6, 2),
+                'decode_us': round(decode_time / iterations * 1e6, 2),
+            })
+    return results
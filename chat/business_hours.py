@@ -0,0 +1,112 @@
+"""
+In-memory business calendar for the 'Outside Business Hours' trigger
+
+The active BusinessCalendar (time zone, weekly hours and holidays) is loaded
+once per worker and compiled into a flat, sorted list of UTC open/close
+timestamps covering a window of days around now. Checking whether a moment is
+inside business hours is a bisect over that list on the event loop, with no
+database read or thread hop. When a check falls outside the compiled window
+the window is recompiled from the definition already in memory, so DST
+changes and new weeks are picked up without touching the database.
+
+Like the rule engine, the definition is reloaded whenever the shared version
+stamp (bumped by the calendar save/delete signals in any worker) changes.
+"""
+import zoneinfo
+from bisect import bisect_right
+from datetime import datetime, time as clock_time, timedelta
+
+from .models import BusinessCalendar
+from .versioned_cache import VersionedCache
+
+
+CALENDAR_VERSION_CACHE_KEY = 'chat:business_calendar:version'
+
+# How often (in seconds) a worker checks the shared version stamp
+CALENDAR_VERSION_CHECK_INTERVAL = 5
+
+# Days before and after the checked moment covered by one compiled window
+WINDOW_DAYS_BEFORE = 1
+WINDOW_DAYS_AFTER = 35
+
+# Used when no calendar is active: Monday-Friday, 9 AM - 5 PM UTC
+DEFAULT_TIMEZONE = 'UTC'
+DEFAULT_WEEKLY_HOURS = [(weekday, clock_time(9), clock_time(17)) for weekday in range(5)]
+
+
+class CompiledCalendar:
+    """Sorted open/close timestamps for a weekly schedule with holidays"""
+
+    def __init__(self, tz_name, weekly_hours, holidays=()):
+        self.tz = zoneinfo.ZoneInfo(tz_name)
+        self.weekly_hours = list(weekly_hours)
+        self.holidays = frozenset(holidays)
+        self._bounds = []
+        self._window = (0.0, 0.0)
+
+    def compile(self, moment):
+        """Build the interval list for the window of days around moment"""
+        today = moment.astimezone(self.tz).date()
+        first_day = today - timedelta(days=WINDOW_DAYS_BEFORE + 1)
+        last_day = today + timedelta(days=WINDOW_DAYS_AFTER)
+
+        intervals = []
+        day = first_day
+        while day <= last_day:
+            if day not in self.holidays:
+                for weekday, opens_at, closes_at in self.weekly_hours:
+                    if weekday != day.weekday():
+                        continue
+                    start = datetime.combine(day, opens_at, tzinfo=self.tz)
+                    end_day = day + timedelta(days=1) if closes_at <= opens_at else day
+                    end = datetime.combine(end_day, closes_at, tzinfo=self.tz)
+                    intervals.append((start.timestamp(), end.timestamp()))
+            day += timedelta(days=1)
+
+        # Merge overlapping periods so the bounds alternate open, close, open, ...
+        bounds = []
+        for start, end in sorted(intervals):
+            if bounds and start <= bounds[-1]:
+                bounds[-1] = max(bounds[-1], end)
+            else:
+                bounds.extend([start, end])
+
+        window_start = datetime.combine(first_day + timedelta(days=1), clock_time(), tzinfo=self.tz)
+        window_end = datetime.combine(last_day, clock_time(), tzinfo=self.tz)
+        self._bounds = bounds
+        self._window = (window_start.timestamp(), window_end.timestamp())
+
+    def is_open(self, moment):
+        """True if moment (an aware datetime) falls inside business hours"""
+        timestamp = moment.timestamp()
+        if not self._window[0] <= timestamp < self._window[1]:
+            self.compile(moment)
+        return bisect_right(self._bounds, timestamp) % 2 == 1
+
+
+def _load_calendar():
+    calendar = BusinessCalendar.objects.filter(is_active=True).first()
+    if calendar is None:
+        return CompiledCalendar(DEFAULT_TIMEZONE, DEFAULT_WEEKLY_HOURS)
+    return CompiledCalendar(
+        calendar.timezone,
+        calendar.hours.values_list('weekday', 'opens_at', 'closes_at'),
+        calendar.holidays.values_list('date', flat=True),
+    )
+
+
+_calendar = VersionedCache(CALENDAR_VERSION_CACHE_KEY, _load_calendar, CALENDAR_VERSION_CHECK_INTERVAL)
+
+
+def invalidate_business_calendar():
+    """Bump the shared version stamp so every worker reloads its calendar"""
+    _calendar.invalidate()
+
+
+async def get_business_calendar():
+    """
+    Return the compiled business calendar for this process
+    The shared version stamp is checked at most every CALENDAR_VERSION_CHECK_INTERVAL
+    seconds; the database is only read when the calendar has changed.
+    """
+    return await _calendar.aget()
@@ -1,24 +1,51 @@
-import json
+import asyncio
+import itertools
+from collections import OrderedDict
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.utils import timezone
 from .models import ChatSession, Message
 from .automated_responses import AutomatedResponseService
+from .db_executor import db_sync_to_async
+from .db_router import bind_pin_identity
+from .presence import agent_presence
+from .scheduler import response_scheduler
+from .pagination import parse_page_size
+from .fanout import DEFAULT_ADMIN_TOPICS, notify_admins, topic_group
+from .serializers import ChatSessionSummarySerializer
+from .stats import add_stats, apply_stats_delta, get_stats, new_session_delta, status_change_delta
+from .wire import WireProtocolMixin
+from .write_behind import message_writer, write_behind_enabled
 import uuid
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+# Upper bound for a connection's outbound batch window
+MAX_ADMIN_BATCH_WINDOW_MS = 1000
+
+
+class ChatConsumer(WireProtocolMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.customer_id = self.scope['url_route']['kwargs']['customer_id']
         self.room_group_name = f'chat_{self.customer_id}'
 
+        # Make sure this worker sends due auto-replies, including ones left by a crashed worker
+        response_scheduler.ensure_started()
+
+        # Writes on this socket pin the customer's reads to the primary database
+        bind_pin_identity(f'customer:{self.customer_id}')
+
+        # Resolve the conversation once; the handle is reused for every frame on this socket
+        self.chat_session = await self.get_or_create_chat_session(self.customer_id)
+
         # Join room group
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
 
-        await self.accept()
+        await self.accept_negotiated()
 
     async def disconnect(self, close_code):
         # Leave room group
@@ -28,8 +55,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
 
     # Receive message from WebSocket
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        text_data_json = self.decode_frame(text_data, bytes_data)
         message_type = text_data_json.get('type', 'chat_message')
         
         if message_type == 'chat_message':
@@ -38,14 +65,23 @@ class ChatConsumer(AsyncWebsocketConsumer):
             sender_name = text_data_json.get('sender_name', 'Anonymous')
             attachment_url = text_data_json.get('attachment_url')  # Get attachment URL if present
             attachment_path = text_data_json.get('attachment_path')  # Get attachment path from upload
+            thumbnail_url = text_data_json.get('thumbnail_url')  # Preview of an image attachment
+            thumbnail_path = text_data_json.get('thumbnail_path')
             
             # Save message to database with attachment if provided
-            chat_session, message_obj = await self.save_message(
-                self.customer_id, message, sender_type, sender_name, attachment_path
-            )
+            if write_behind_enabled():
+                chat_session, message_obj, stats_delta = await message_writer.write(
+                    self.customer_id, message, sender_type, sender_name, attachment_path,
+                    thumbnail_path=thumbnail_path
+                )
+            else:
+                chat_session, message_obj, stats_delta = await self.save_message(
+                    self.chat_session, message, sender_type, sender_name, attachment_path, thumbnail_path
+                )
             
             # Use attachment URL from message if available, otherwise check message_obj
             final_attachment_url = attachment_url if attachment_url else (message_obj.attachment.url if message_obj.attachment else None)
+            final_thumbnail_url = thumbnail_url if thumbnail_url else (message_obj.attachment_thumbnail.url if message_obj.attachment_thumbnail else None)
             
             # Send message to room group
             await self.channel_layer.group_send(
@@ -58,12 +94,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     'timestamp': message_obj.timestamp.isoformat(),
                     'message_id': str(message_obj.id),
                     'attachment_url': final_attachment_url,
+                    'thumbnail_url': final_thumbnail_url,
                 }
             )
             
-            # Also send to admin dashboard
-            await self.channel_layer.group_send(
-                'admin_dashboard',
+            # Also send to admin dashboards subscribed to this conversation
+            await notify_admins(
+                self.channel_layer,
+                chat_session,
                 {
                     'type': 'new_message_notification',
                     'chat_session_id': str(chat_session.id),
@@ -73,7 +111,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     'sender_name': sender_name,
                     'timestamp': message_obj.timestamp.isoformat(),
                     'attachment_url': final_attachment_url,
-                }
+                    'thumbnail_url': final_thumbnail_url,
+                },
+                stats_delta=stats_delta
             )
             
             # Process automated responses for customer messages
@@ -82,13 +122,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     self.customer_id,
                     message,
                     self.channel_layer,
-                    self.room_group_name
+                    self.room_group_name,
+                    chat_session=chat_session
                 )
             
         elif message_type == 'close_conversation':
             # Close the conversation
-            chat_session = await self.close_conversation(
-                self.customer_id, text_data_json.get('sender_name', 'Customer')
+            chat_session, stats = await self.close_conversation(
+                self.chat_session, text_data_json.get('sender_name', 'Customer')
             )
             
             # Notify both customer and admin
@@ -101,9 +142,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 }
             )
             
-            # Notify admin dashboard
-            await self.channel_layer.group_send(
-                'admin_dashboard',
+            # Notify admin dashboards
+            await notify_admins(
+                self.channel_layer,
+                chat_session,
                 {
                     'type': 'conversation_status_changed',
                     'chat_session_id': str(chat_session.id),
@@ -111,7 +153,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     'status': 'closed',
                     'closed_by': text_data_json.get('sender_name', 'Customer'),
                     'timestamp': chat_session.updated_at.isoformat(),
-                }
+                },
+                stats
             )
 
     # Receive message from room group
@@ -122,9 +165,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
         timestamp = event['timestamp']
         message_id = event['message_id']
         attachment_url = event.get('attachment_url')
+        thumbnail_url = event.get('thumbnail_url')
 
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
+        await self.send_payload({
             'type': 'chat_message',
             'message': message,
             'sender_type': sender_type,
@@ -132,49 +176,76 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'timestamp': timestamp,
             'message_id': message_id,
             'attachment_url': attachment_url,
-        }))
+            'thumbnail_url': thumbnail_url,
+        })
+
+    # Handle an image preview finished after its message was sent
+    async def thumbnail_ready(self, event):
+        await self.send_payload({
+            'type': 'thumbnail_ready',
+            'message_id': event['message_id'],
+            'attachment_url': event['attachment_url'],
+            'thumbnail_url': event['thumbnail_url'],
+        })
 
     # Handle conversation closure
     async def conversation_closed(self, event):
-        await self.send(text_data=json.dumps({
+        await self.refresh_chat_session()
+        await self.send_payload({
             'type': 'conversation_closed',
             'closed_by': event['closed_by'],
             'timestamp': event['timestamp'],
-        }))
+        })
     
     # Handle conversation reopening
     async def conversation_reopened(self, event):
-        await self.send(text_data=json.dumps({
+        await self.refresh_chat_session()
+        await self.send_payload({
             'type': 'conversation_reopened',
             'reopened_by': event['reopened_by'],
             'timestamp': event['timestamp'],
-        }))
+        })
 
-    @database_sync_to_async
-    def save_message(self, customer_id, message, sender_type, sender_name, attachment_path=None):
-        # Get or create chat session
+    @db_sync_to_async
+    def get_or_create_chat_session(self, customer_id):
         chat_session, created = ChatSession.objects.get_or_create(
             customer_id=customer_id,
             defaults={'status': 'open'}
         )
-        
+        if created:
+            apply_stats_delta(**new_session_delta())
+        return chat_session
+
+    @db_sync_to_async
+    def refresh_chat_session(self):
+        # Status changed elsewhere (e.g. an admin closed the conversation)
+        self.chat_session.refresh_from_db()
+
+    @db_sync_to_async
+    def save_message(self, chat_session, message, sender_type, sender_name, attachment_path=None, thumbnail_path=None):
         # Create message with attachment if provided
         message_obj = Message.objects.create(
             chat_session=chat_session,
             content=message,
             sender_type=sender_type,
             sender_name=sender_name,
-            attachment=attachment_path if attachment_path else None
+            attachment=attachment_path if attachment_path else None,
+            attachment_thumbnail=thumbnail_path if thumbnail_path else None
         )
         
-        return chat_session, message_obj
+        # Keep the dashboard counters current
+        stats_delta = {'unread_messages': int(sender_type == 'customer')}
+        apply_stats_delta(**stats_delta)
+        
+        return chat_session, message_obj, stats_delta
 
-    @database_sync_to_async
-    def close_conversation(self, customer_id, closed_by):
-        # Get chat session and close it
-        chat_session = ChatSession.objects.get(customer_id=customer_id)
-        chat_session.status = 'closed'
-        chat_session.save()
+    @db_sync_to_async
+    def close_conversation(self, chat_session, closed_by):
+        # Close the chat session; the conditional update keeps the stats right even if the handle is stale
+        if ChatSession.objects.filter(pk=chat_session.pk).exclude(status='closed').update(
+            status='closed', updated_at=timezone.now()
+        ):
+            apply_stats_delta(**status_change_delta('open', 'closed'))
         
         # Add a system message about the closure
         Message.objects.create(
@@ -184,55 +255,159 @@ class ChatConsumer(AsyncWebsocketConsumer):
             sender_name='System'
         )
         
-        return chat_session
+        return chat_session, get_stats()
 
 
-class AdminDashboardConsumer(AsyncWebsocketConsumer):
+class AdminDashboardConsumer(WireProtocolMixin, AsyncWebsocketConsumer):
     async def connect(self):
         # Only allow authenticated users (admins)
         if self.scope["user"].is_anonymous or not self.scope["user"].is_staff:
             await self.close()
         else:
-            self.room_group_name = 'admin_dashboard'
+            # Join only the topics this page asked for, e.g. ?topics=summary,session:<id>
+            self.topic_groups = {}
+            query = parse_qs(self.scope.get('query_string', b'').decode())
+            topics = [t for value in query.get('topics', []) for t in value.split(',') if t]
             
-            # Join admin dashboard group
-            await self.channel_layer.group_add(
-                self.room_group_name,
-                self.channel_name
-            )
+            # Outbound batching: events are sent as one JSON array per window (?batch_ms=, 0 = off)
+            self.outbox = OrderedDict()
+            self.outbox_ids = itertools.count()
+            self.flush_task = None
+            self.last_flush = 0
+            self.set_batch_window(query.get('batch_ms', [settings.CHAT_ADMIN_BATCH_WINDOW_MS])[0])
             
-            await self.accept()
+            # Count this agent as online while the socket is open
+            await agent_presence.connect(self.scope["user"])
+            self.presence_registered = True
+            bind_pin_identity(f'user:{self.scope["user"].pk}')
+            
+            await self.accept_negotiated()
+            await self.subscribe(topics or DEFAULT_ADMIN_TOPICS)
 
     async def disconnect(self, close_code):
-        # Leave room group
-        if hasattr(self, 'room_group_name'):
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
+        if getattr(self, 'presence_registered', False):
+            await agent_presence.disconnect(self.scope["user"])
+        
+        # Leave all topic groups
+        for group in getattr(self, 'topic_groups', {}).values():
+            await self.channel_layer.group_discard(group, self.channel_name)
+        if getattr(self, 'flush_task', None):
+            self.flush_task.cancel()
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+    def set_batch_window(self, batch_ms):
+        try:
+            batch_ms = int(batch_ms)
+        except (TypeError, ValueError):
+            batch_ms = settings.CHAT_ADMIN_BATCH_WINDOW_MS
+        self.batch_window = max(0, min(batch_ms, MAX_ADMIN_BATCH_WINDOW_MS)) / 1000
+
+    async def send_event(self, payload, merge_key=None):
+        """
+        Send an event, or queue it for the next batch frame when batching is on
+        Events with the same merge_key replace each other while queued
+        """
+        if not self.batch_window:
+            await self.send_payload(payload)
+            return
+        
+        key = merge_key if merge_key is not None else next(self.outbox_ids)
+        self.outbox.pop(key, None)
+        self.outbox[key] = payload
+        if self.flush_task is None:
+            # Send right away when idle, otherwise at most one frame per window
+            loop = asyncio.get_running_loop()
+            delay = max(0, self.last_flush + self.batch_window - loop.time())
+            self.flush_task = asyncio.ensure_future(self.flush_outbox(delay))
+
+    async def flush_outbox(self, delay):
+        await asyncio.sleep(delay)
+        events = list(self.outbox.values())
+        self.outbox.clear()
+        self.flush_task = None
+        self.last_flush = asyncio.get_running_loop().time()
+        if events:
+            await self.send_payload(events)
+
+    async def subscribe(self, topics):
+        for topic in topics:
+            if topic in self.topic_groups:
+                continue
+            try:
+                group = topic_group(topic, self.scope["user"])
+            except ValueError as e:
+                await self.send_payload({'type': 'error', 'error': str(e)})
+                continue
+            await self.channel_layer.group_add(group, self.channel_name)
+            self.topic_groups[topic] = group
+
+    async def unsubscribe(self, topics):
+        for topic in topics:
+            group = self.topic_groups.pop(topic, None)
+            if group:
+                await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        text_data_json = self.decode_frame(text_data, bytes_data)
         message_type = text_data_json.get('type')
         
-        if message_type == 'admin_message':
+        if message_type == 'subscribe':
+            await self.subscribe(text_data_json.get('topics', []))
+            await self.send_payload({
+                'type': 'subscriptions',
+                'topics': list(self.topic_groups),
+            })
+        
+        elif message_type == 'unsubscribe':
+            await self.unsubscribe(text_data_json.get('topics', []))
+            await self.send_payload({
+                'type': 'subscriptions',
+                'topics': list(self.topic_groups),
+            })
+        
+        elif message_type == 'configure':
+            self.set_batch_window(text_data_json.get('batch_ms', 0))
+            await self.send_payload({
+                'type': 'configured',
+                'batch_ms': int(self.batch_window * 1000),
+            })
+        
+        elif message_type == 'conversations_snapshot':
+            # Compact list used to (re)build the live conversation list
+            sessions = await self.get_conversations_snapshot(
+                text_data_json.get('status', 'all'), parse_page_size(text_data_json.get('limit'))
+            )
+            await self.send_payload({
+                'type': 'conversations_snapshot',
+                'sessions': sessions,
+            })
+        
+        elif message_type == 'admin_message':
             customer_id = text_data_json['customer_id']
             message = text_data_json['message']
             sender_name = text_data_json.get('sender_name', self.scope["user"].get_full_name() or self.scope["user"].username)
             attachment_url = text_data_json.get('attachment_url')  # Get attachment URL if present
             attachment_path = text_data_json.get('attachment_path')  # Get attachment path from upload
+            thumbnail_url = text_data_json.get('thumbnail_url')  # Preview of an image attachment
+            thumbnail_path = text_data_json.get('thumbnail_path')
             
             print(f"Admin message received: customer_id={customer_id}, message={message}")  # Debug
             
             # Save message to database with attachment if provided
-            chat_session, message_obj = await self.save_admin_message(
-                customer_id, message, sender_name, attachment_path
-            )
+            if write_behind_enabled():
+                chat_session, message_obj, stats_delta = await message_writer.write(
+                    customer_id, message, 'admin', sender_name, attachment_path, from_admin=True,
+                    thumbnail_path=thumbnail_path
+                )
+            else:
+                chat_session, message_obj, stats_delta = await self.save_admin_message(
+                    customer_id, message, sender_name, attachment_path, thumbnail_path
+                )
             
             print(f"Message saved: {message_obj.id}")  # Debug
             
             # Use provided attachment URL or get from message object
             final_attachment_url = attachment_url if attachment_url else (message_obj.attachment.url if message_obj.attachment else None)
+            final_thumbnail_url = thumbnail_url if thumbnail_url else (message_obj.attachment_thumbnail.url if message_obj.attachment_thumbnail else None)
             
             # Send message to specific customer room
             customer_room = f'chat_{customer_id}'
@@ -248,14 +423,16 @@ class AdminDashboardConsumer(AsyncWebsocketConsumer):
                     'timestamp': message_obj.timestamp.isoformat(),
                     'message_id': str(message_obj.id),
                     'attachment_url': final_attachment_url,
+                    'thumbnail_url': final_thumbnail_url,
                 }
             )
             
             print(f"Message sent to customer room")  # Debug
             
-            # Also send confirmation back to admin dashboard
-            await self.channel_layer.group_send(
-                'admin_dashboard',
+            # Also send confirmation back to admin dashboards viewing this conversation
+            await notify_admins(
+                self.channel_layer,
+                chat_session,
                 {
                     'type': 'admin_message_sent',
                     'chat_session_id': str(chat_session.id),
@@ -266,7 +443,9 @@ class AdminDashboardConsumer(AsyncWebsocketConsumer):
                     'timestamp': message_obj.timestamp.isoformat(),
                     'message_id': str(message_obj.id),
                     'attachment_url': final_attachment_url,
-                }
+                    'thumbnail_url': final_thumbnail_url,
+                },
+                stats_delta=stats_delta
             )
             
         elif message_type == 'admin_close_conversation':
@@ -274,7 +453,7 @@ class AdminDashboardConsumer(AsyncWebsocketConsumer):
             admin_name = self.scope["user"].get_full_name() or self.scope["user"].username
             
             # Close the conversation
-            chat_session = await self.close_admin_conversation(customer_id, admin_name)
+            chat_session, stats = await self.close_admin_conversation(customer_id, admin_name)
             
             # Notify customer
             customer_room = f'chat_{customer_id}'
@@ -287,9 +466,10 @@ class AdminDashboardConsumer(AsyncWebsocketConsumer):
                 }
             )
             
-            # Notify admin dashboard
-            await self.channel_layer.group_send(
-                'admin_dashboard',
+            # Notify admin dashboards
+            await notify_admins(
+                self.channel_layer,
+                chat_session,
                 {
                     'type': 'conversation_status_changed',
                     'chat_session_id': str(chat_session.id),
@@ -297,7 +477,8 @@ class AdminDashboardConsumer(AsyncWebsocketConsumer):
                     'status': 'closed',
                     'closed_by': admin_name,
                     'timestamp': chat_session.updated_at.isoformat(),
-                }
+                },
+                stats
             )
             
         elif message_type == 'admin_reopen_conversation':
@@ -305,7 +486,7 @@ class AdminDashboardConsumer(AsyncWebsocketConsumer):
             admin_name = self.scope["user"].get_full_name() or self.scope["user"].username
             
             # Reopen the conversation
-            chat_session = await self.reopen_admin_conversation(customer_id, admin_name)
+            chat_session, stats = await self.reopen_admin_conversation(customer_id, admin_name)
             
             # Notify customer
             customer_room = f'chat_{customer_id}'
@@ -318,9 +499,10 @@ class AdminDashboardConsumer(AsyncWebsocketConsumer):
                 }
             )
             
-            # Notify admin dashboard
-            await self.channel_layer.group_send(
-                'admin_dashboard',
+            # Notify admin dashboards
+            await notify_admins(
+                self.channel_layer,
+                chat_session,
                 {
                     'type': 'conversation_status_changed',
                     'chat_session_id': str(chat_session.id),
@@ -328,12 +510,13 @@ class AdminDashboardConsumer(AsyncWebsocketConsumer):
                     'status': 'open',
                     'reopened_by': admin_name,
                     'timestamp': chat_session.updated_at.isoformat(),
-                }
+                },
+                stats
             )
 
     async def new_message_notification(self, event):
         # Send notification to admin dashboard
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             'type': 'new_message_notification',
             'chat_session_id': event['chat_session_id'],
             'customer_id': event['customer_id'],
@@ -342,7 +525,43 @@ class AdminDashboardConsumer(AsyncWebsocketConsumer):
             'sender_name': event['sender_name'],
             'timestamp': event['timestamp'],
             'attachment_url': event.get('attachment_url'),
-        }))
+            'thumbnail_url': event.get('thumbnail_url'),
+            'stats': event.get('stats'),
+            'stats_delta': event.get('stats_delta'),
+            'session': event.get('session'),
+        })
+
+    async def thumbnail_ready(self, event):
+        # An image message's preview is ready; the page swaps it in for the original
+        await self.send_event({
+            'type': 'thumbnail_ready',
+            'chat_session_id': event['chat_session_id'],
+            'customer_id': event['customer_id'],
+            'message_id': event['message_id'],
+            'attachment_url': event['attachment_url'],
+            'thumbnail_url': event['thumbnail_url'],
+        })
+
+    async def session_update(self, event):
+        # Compact conversation row for list and queue views; only the newest row per session matters
+        await self.send_event({
+            'type': 'session_update',
+            'session': event['session'],
+        }, merge_key=('session', event['session']['id']))
+
+    async def stats_update(self, event):
+        # Dashboard counters only: a snapshot supersedes anything queued, deltas add up
+        payload = {'type': 'stats_update'}
+        queued = self.outbox.get(('stats',)) if self.batch_window else None
+        if 'stats' in event:
+            payload['stats'] = event['stats']
+        elif queued is not None and 'stats' in queued:
+            payload['stats'] = add_stats(queued['stats'], event['stats_delta'])
+        elif queued is not None:
+            payload['stats_delta'] = add_stats(queued['stats_delta'], event['stats_delta'])
+        else:
+            payload['stats_delta'] = event['stats_delta']
+        await self.send_event(payload, merge_key=('stats',))
 
     async def conversation_status_changed(self, event):
         # Send conversation status change notification to admin dashboard
@@ -352,6 +571,8 @@ class AdminDashboardConsumer(AsyncWebsocketConsumer):
             'customer_id': event['customer_id'],
             'status': event['status'],
             'timestamp': event['timestamp'],
+            'stats': event.get('stats'),
+            'session': event.get('session'),
         }
         
         # Add the appropriate field based on action
@@ -360,11 +581,12 @@ class AdminDashboardConsumer(AsyncWebsocketConsumer):
         elif event['status'] == 'open':
             response_data['reopened_by'] = event.get('reopened_by', 'Unknown')
         
-        await self.send(text_data=json.dumps(response_data))
+        # A newer status for the same conversation supersedes one still waiting to be sent
+        await self.send_event(response_data, merge_key=('status', event['chat_session_id']))
 
     async def admin_message_sent(self, event):
         # Send confirmation that admin message was sent (for real-time update in dashboard)
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             'type': 'admin_message_sent',
             'chat_session_id': event['chat_session_id'],
             'customer_id': event['customer_id'],
@@ -374,19 +596,28 @@ class AdminDashboardConsumer(AsyncWebsocketConsumer):
             'timestamp': event['timestamp'],
             'message_id': event['message_id'],
             'attachment_url': event.get('attachment_url'),
-        }))
+            'thumbnail_url': event.get('thumbnail_url'),
+            'stats': event.get('stats'),
+            'stats_delta': event.get('stats_delta'),
+            'session': event.get('session'),
+        })
 
-    @database_sync_to_async
-    def save_admin_message(self, customer_id, message, sender_name, attachment_path=None):
+    @db_sync_to_async
+    def get_conversations_snapshot(self, status_filter, limit):
+        sessions = ChatSession.objects.order_by('-updated_at', '-id')
+        if status_filter != 'all':
+            sessions = sessions.filter(status=status_filter)
+        return [dict(row) for row in ChatSessionSummarySerializer(sessions[:limit], many=True).data]
+
+    @db_sync_to_async
+    def save_admin_message(self, customer_id, message, sender_name, attachment_path=None, thumbnail_path=None):
         # Get chat session
         chat_session = ChatSession.objects.get(customer_id=customer_id)
         
         # Mark customer messages as read
-        Message.objects.filter(
-            chat_session=chat_session,
-            sender_type='customer',
-            is_read=False
-        ).update(is_read=True)
+        marked_read = chat_session.mark_customer_messages_read()
+        stats_delta = {'unread_messages': -marked_read}
+        apply_stats_delta(**stats_delta)
         
         # Create admin message with attachment if provided
         message_obj = Message.objects.create(
@@ -394,15 +625,17 @@ class AdminDashboardConsumer(AsyncWebsocketConsumer):
             content=message,
             sender_type='admin',
             sender_name=sender_name,
-            attachment=attachment_path if attachment_path else None
+            attachment=attachment_path if attachment_path else None,
+            attachment_thumbnail=thumbnail_path if thumbnail_path else None
         )
         
-        return chat_session, message_obj
+        return chat_session, message_obj, stats_delta
 
-    @database_sync_to_async
+    @db_sync_to_async
     def close_admin_conversation(self, customer_id, admin_name):
         # Get chat session and close it
         chat_session = ChatSession.objects.get(customer_id=customer_id)
+        apply_stats_delta(**status_change_delta(chat_session.status, 'closed'))
         chat_session.status = 'closed'
         chat_session.save()
         
@@ -414,12 +647,13 @@ class AdminDashboardConsumer(AsyncWebsocketConsumer):
             sender_name='System'
         )
         
-        return chat_session
+        return chat_session, get_stats()
     
-    @database_sync_to_async
+    @db_sync_to_async
     def reopen_admin_conversation(self, customer_id, admin_name):
         # Get chat session and reopen it
         chat_session = ChatSession.objects.get(customer_id=customer_id)
+        apply_stats_delta(**status_change_delta(chat_session.status, 'open'))
         chat_session.status = 'open'
         chat_session.save()
         
@@ -431,4 +665,4 @@ class AdminDashboardConsumer(AsyncWebsocketConsumer):
             sender_name='System'
         )
         
-        return chat_session
\ No newline at end of file
+        return chat_session, get_stats()
\ No newline at end of file
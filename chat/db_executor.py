@@ -0,0 +1,141 @@
+"""
+Dedicated database executor for the chat consumers
+
+database_sync_to_async runs every call on Channels' thread-sensitive executor,
+a single thread shared with the rest of the worker, so one slow query stalls
+every socket. The consumers, the automated response service and the
+write-behind buffer instead run their queries on a bounded thread pool of
+CHAT_DB_EXECUTOR_WORKERS threads that is not thread-sensitive; each thread
+keeps its own database connection (subject to CONN_MAX_AGE).
+
+Django 4.2's async ORM methods (aget, acreate, ...) are themselves wrappers
+around the thread-sensitive executor, so they are not used for these paths.
+
+The pool records its queue depth and how long calls wait for a thread, which
+the admin metrics endpoint and the WebSocket benchmark report.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db import connections
+
+
+# Recent calls kept for the wait/run time percentiles
+METRIC_SAMPLES = 1000
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize_ms(samples):
+    """p50/p95/p99/max in milliseconds for durations in seconds"""
+    values = [sample * 1000 for sample in samples]
+    return {
+        'p50': _percentile(values, 50),
+        'p95': _percentile(values, 95),
+        'p99': _percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor that tracks queue depth and wait/run times"""
+
+    def __init__(self, max_workers, thread_name_prefix=''):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._max_queued = 0
+        self._running = 0
+        self._completed = 0
+        self._wait_times = deque(maxlen=METRIC_SAMPLES)
+        self._run_times = deque(maxlen=METRIC_SAMPLES)
+
+    def submit(self, fn, /, *args, **kwargs):
+        submitted_at = time.monotonic()
+        with self._lock:
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+
+        def run():
+            started_at = time.monotonic()
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+                self._wait_times.append(started_at - submitted_at)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+                    self._run_times.append(time.monotonic() - started_at)
+
+        return super().submit(run)
+
+    def metrics(self):
+        """Current queue depth plus wait and run time percentiles (ms) over recent calls"""
+        with self._lock:
+            wait_times = list(self._wait_times)
+            run_times = list(self._run_times)
+            return {
+                'max_workers': self.max_workers,
+                'queue_depth': self._queued,
+                'max_queue_depth': self._max_queued,
+                'running': self._running,
+                'completed': self._completed,
+                'wait_ms': summarize_ms(wait_times),
+                'run_ms': summarize_ms(run_times),
+            }
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _default_workers():
+    # SQLite allows one writer at a time, so extra threads only add lock contention
+    if connections['default'].vendor == 'sqlite':
+        return 1
+    return 8
+
+
+def get_db_executor():
+    """Return this process's database executor, creating it on first use"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                workers = settings.CHAT_DB_EXECUTOR_WORKERS or _default_workers()
+                _executor = InstrumentedExecutor(workers, thread_name_prefix='chat-db')
+    return _executor
+
+
+def db_executor_metrics():
+    return get_db_executor().metrics()
+
+
+class DbSyncToAsync(DatabaseSyncToAsync):
+    """database_sync_to_async that runs on the dedicated database executor"""
+
+    def __init__(self, func):
+        super().__init__(func, thread_sensitive=False)
+
+    async def __call__(self, *args, **kwargs):
+        # Resolved per call so the pool is only created once settings and connections are ready
+        self._executor = get_db_executor()
+        return await super().__call__(*args, **kwargs)
+
+
+# Used as a decorator, like database_sync_to_async
+db_sync_to_async = DbSyncToAsync
@@ -0,0 +1,8 @@
+"""
+PostgreSQL backend with a bounded, process-wide connection pool
+
+Use ENGINE 'chat.db_pool' (set automatically when CHAT_DB_POOL is enabled)
+with CONN_MAX_AGE = 0 and pool settings under the database's 'POOL' key:
+MIN_SIZE, MAX_SIZE, TIMEOUT (checkout timeout in seconds), CHECK_INTERVAL
+(ping connections idle for longer than this) and MAX_IDLE.
+"""
@@ -0,0 +1,239 @@
+"""
+Thread-safe database connection pool
+
+One pool per database alias and process, shared by every thread that talks
+to the database: request threads, the thread-sensitive executor and the chat
+database executor. Connections are checked out when Django opens a
+connection and returned when it closes one, which with CONN_MAX_AGE = 0
+happens at the end of every request and every consumer database call.
+Returned connections are rolled back and reset with DISCARD ALL; Django
+reapplies its per-connection setup (time zone, role) on every checkout.
+"""
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+
+from chat.db_executor import METRIC_SAMPLES, summarize_ms
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """No connection became available within the checkout timeout"""
+
+
+class ConnectionPool:
+    """
+    Bounded LIFO pool of DB-API connections
+
+    At most max_size connections exist at once; a checkout waits up to
+    timeout seconds for one to be returned. Connections that sat idle for
+    longer than check_interval seconds are pinged before being handed out,
+    and idle connections above min_size are closed after max_idle seconds.
+    """
+
+    def __init__(self, min_size=2, max_size=10, timeout=10.0, check_interval=30.0, max_idle=300.0):
+        if min_size > max_size:
+            raise ValueError('min_size cannot be larger than max_size')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.max_idle = max_idle
+        self._idle = deque()  # (connection, returned_at), most recently returned last
+        self._size = 0
+        self._prefilled = False
+        self._condition = threading.Condition()
+        self._checkouts = 0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._max_in_use = 0
+        self._wait_times = deque(maxlen=METRIC_SAMPLES)
+
+    def getconn(self, connect):
+        """Check out a connection, calling connect() if a new one is needed"""
+        self._prefill(connect)
+        started_at = time.monotonic()
+        deadline = started_at + self.timeout
+        while True:
+            with self._condition:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(
+                            f'No database connection available within {self.timeout:g}s '
+                            f'({self.max_size} in use)'
+                        )
+                    self._condition.wait(remaining)
+                if self._idle:
+                    connection, returned_at = self._idle.pop()
+                else:
+                    connection, returned_at = None, None
+                    self._size += 1
+
+            if connection is None:
+                break
+            # Ping connections that sat idle for a while, outside the lock
+            if time.monotonic() - returned_at < self.check_interval or self._is_healthy(connection):
+                with self._condition:
+                    self._checked_out(started_at)
+                return connection
+            self._discard(connection)
+
+        try:
+            connection = connect()
+        except BaseException:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._created += 1
+            self._checked_out(started_at)
+        return connection
+
+    def putconn(self, connection):
+        """Return a connection, discarding it if it is broken or stuck in a transaction"""
+        if not self._reset(connection):
+            self._discard(connection)
+            return
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._reap_idle()
+            self._condition.notify()
+
+    def close(self):
+        """Close every idle connection"""
+        with self._condition:
+            idle = [connection for connection, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+        for connection in idle:
+            self._close_quietly(connection)
+
+    def metrics(self):
+        with self._condition:
+            idle = len(self._idle)
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': idle,
+                'in_use': self._size - idle,
+                'max_in_use': self._max_in_use,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'created': self._created,
+                'discarded': self._discarded,
+                'wait_ms': summarize_ms(list(self._wait_times)),
+            }
+
+    def _prefill(self, connect):
+        if self._prefilled:
+            return
+        with self._condition:
+            if self._prefilled:
+                return
+            self._prefilled = True
+            missing = max(self.min_size - self._size, 0)
+            self._size += missing
+        for _ in range(missing):
+            try:
+                connection = connect()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                continue
+            with self._condition:
+                self._created += 1
+                self._idle.append((connection, time.monotonic()))
+                self._condition.notify()
+
+    def _checked_out(self, started_at):
+        self._checkouts += 1
+        self._wait_times.append(time.monotonic() - started_at)
+        self._max_in_use = max(self._max_in_use, self._size - len(self._idle))
+
+    def _reap_idle(self):
+        # Called with the lock held; oldest idle connections are at the left
+        now = time.monotonic()
+        while self._size > self.min_size and self._idle and now - self._idle[0][1] > self.max_idle:
+            connection, _ = self._idle.popleft()
+            self._size -= 1
+            self._close_quietly(connection)
+
+    def _discard(self, connection):
+        self._close_quietly(connection)
+        with self._condition:
+            self._size -= 1
+            self._discarded += 1
+            self._condition.notify()
+
+    def _is_healthy(self, connection):
+        if connection.closed:
+            return False
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            if connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _reset(self, connection):
+        if connection.closed:
+            return False
+        try:
+            if connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+            # Drop session state (SET, temp tables, prepared statements, advisory locks) so
+            # it cannot leak into the next borrower; DISCARD ALL refuses to run in a transaction
+            autocommit = connection.autocommit
+            connection.autocommit = True
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('DISCARD ALL')
+            finally:
+                connection.autocommit = autocommit
+            return connection.get_transaction_status() == extensions.TRANSACTION_STATUS_IDLE
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _close_quietly(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, settings_dict):
+    """Return the process-wide pool for a database alias and target database"""
+    key = (alias, settings_dict['NAME'], settings_dict['HOST'], settings_dict['PORT'], settings_dict['USER'])
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                options = settings_dict.get('POOL', {})
+                pool = _pools[key] = ConnectionPool(
+                    min_size=options.get('MIN_SIZE', 2),
+                    max_size=options.get('MAX_SIZE', 10),
+                    timeout=options.get('TIMEOUT', 10.0),
+                    check_interval=options.get('CHECK_INTERVAL', 30.0),
+                    max_idle=options.get('MAX_IDLE', 300.0),
+                )
+    return pool
+
+
+def pool_metrics():
+    """Metrics for every pool created in this process, keyed by '<alias>/<database name>'"""
+    return {f'{key[0]}/{key[1]}': pool.metrics() for key, pool in list(_pools.items())}
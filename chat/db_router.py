@@ -0,0 +1,180 @@
+"""
+Read-replica routing with read-your-writes pinning
+
+When DATABASE_REPLICA_URLS configures read replicas, views wrapped in
+read_from_replica (history, session listings, dashboard pages) run their
+queries on a randomly chosen replica; everything else, and every write, goes
+to the primary ('default').
+
+Replicas lag, so whoever writes is pinned to the primary for
+CHAT_REPLICA_PIN_SECONDS. A pin belongs to an identity: 'user:<id>' for
+signed-in agents (set by PrimaryPinMiddleware and AdminDashboardConsumer) and
+'customer:<customer_id>' for widget users (set by the widget views and
+ChatConsumer). The router notices writes made under an identity and records
+the pin in the shared cache, so a request served by any worker right after a
+socket write still reads from the primary.
+
+A pin is stored for half a window longer than CHAT_REPLICA_PIN_SECONDS and
+only rewritten once less than a full window is left, so a busy socket does not
+write to the cache on every query yet reads stay pinned for at least
+CHAT_REPLICA_PIN_SECONDS after its last write.
+"""
+import math
+import random
+import time
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+PIN_KEY_PREFIX = 'chat:db_pin:'
+
+_replica_reads = ContextVar('chat_replica_reads', default=False)
+_pin_state = ContextVar('chat_pin_state', default=None)
+
+
+def replica_aliases():
+    """Database aliases configured as read replicas"""
+    return [alias for alias in settings.DATABASES if alias.startswith('replica')]
+
+
+def _pin_key(identity):
+    return f'{PIN_KEY_PREFIX}{identity}'
+
+
+def _pin_timeout():
+    # Half a window of slack, so a pin is only rewritten every half window
+    return math.ceil(settings.CHAT_REPLICA_PIN_SECONDS * 1.5)
+
+
+def _user_identity(user):
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    return None
+
+
+class PinState:
+    """Who the current request or socket writes as, and when it last pinned itself"""
+
+    def __init__(self, identity=None, request=None):
+        self._identity = identity
+        self._request = request
+        self.pinned_until = 0.0
+
+    @property
+    def identity(self):
+        # Requests resolve their user only once they actually write
+        if self._identity is None and self._request is not None:
+            self._identity = _user_identity(getattr(self._request, 'user', None))
+            self._request = None
+        return self._identity
+
+    @identity.setter
+    def identity(self, identity):
+        self._identity = identity
+        self._request = None
+        self.pinned_until = 0.0
+
+    def _pin_due(self):
+        # Refresh the shared pin once less than a full window of it is left
+        now = time.monotonic()
+        if self.identity is None or self.pinned_until - now >= settings.CHAT_REPLICA_PIN_SECONDS:
+            return None
+        timeout = _pin_timeout()
+        self.pinned_until = now + timeout
+        return timeout
+
+    def note_write(self):
+        timeout = self._pin_due()
+        if timeout:
+            cache.set(_pin_key(self.identity), True, timeout=timeout)
+
+    async def anote_write(self):
+        timeout = self._pin_due()
+        if timeout:
+            await cache.aset(_pin_key(self.identity), True, timeout=timeout)
+
+
+def bind_pin_identity(identity):
+    """Attribute writes in the current request or socket to identity"""
+    state = _pin_state.get()
+    if state is None:
+        _pin_state.set(PinState(identity))
+    else:
+        state.identity = identity
+
+
+async def anote_write():
+    """Pin the current socket after a write made on its behalf elsewhere (e.g. write-behind)"""
+    state = _pin_state.get()
+    if state is not None:
+        await state.anote_write()
+
+
+def is_pinned(identity):
+    """True if identity wrote recently and must read from the primary"""
+    return identity is not None and cache.get(_pin_key(identity)) is not None
+
+
+def read_from_replica(view):
+    """
+    Run a read-only view against a replica, unless its caller wrote recently
+    Anonymous widget requests are identified by their customer_id URL argument
+    """
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        if not replica_aliases():
+            return view(request, *args, **kwargs)
+
+        identity = _user_identity(getattr(request, 'user', None))
+        if identity is None and 'customer_id' in kwargs:
+            identity = f"customer:{kwargs['customer_id']}"
+        if is_pinned(identity):
+            return view(request, *args, **kwargs)
+
+        token = _replica_reads.set(True)
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            _replica_reads.reset(token)
+    return wrapped
+
+
+class PrimaryPinMiddleware:
+    """Track writes per request, attributed to the signed-in user"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _pin_state.set(PinState(request=request))
+        try:
+            return self.get_response(request)
+        finally:
+            _pin_state.reset(token)
+
+
+class ReplicaRouter:
+    """Send reads in read_from_replica views to a replica, everything else to the primary"""
+
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get():
+            replicas = replica_aliases()
+            if replicas:
+                return random.choice(replicas)
+        return None
+
+    def db_for_write(self, model, **hints):
+        state = _pin_state.get()
+        if state is not None:
+            state.note_write()
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas mirror the primary, so objects from any of them can be related
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
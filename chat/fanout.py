@@ -0,0 +1,79 @@
+"""
+Topic-based fan-out of chat events to admin dashboard sockets
+
+Each admin socket subscribes only to the topics its page needs, so an agent no
+longer receives (and the worker no longer encodes) every event in the system:
+
+- summary: dashboard counters only ('stats_update')
+- sessions: compact row for every conversation change ('session_update')
+- unassigned: compact rows for conversations nobody is assigned to
+- assigned: compact rows for conversations assigned to the connected agent
+- session:<id>: full message and status events for one conversation being viewed
+"""
+import uuid
+
+from .serializers import ChatSessionSummarySerializer
+
+
+ADMIN_SUMMARY_GROUP = 'admin_summary'
+ADMIN_SESSIONS_GROUP = 'admin_sessions'
+ADMIN_UNASSIGNED_GROUP = 'admin_unassigned'
+
+DEFAULT_ADMIN_TOPICS = ['summary']
+
+
+def admin_session_group(session_id):
+    return f'admin_session_{session_id}'
+
+
+def admin_assigned_group(user_id):
+    return f'admin_assigned_{user_id}'
+
+
+def topic_group(topic, user):
+    """
+    Channel layer group for a subscription topic
+    Raises ValueError for unknown topics or malformed session ids
+    """
+    if topic == 'summary':
+        return ADMIN_SUMMARY_GROUP
+    if topic == 'sessions':
+        return ADMIN_SESSIONS_GROUP
+    if topic == 'unassigned':
+        return ADMIN_UNASSIGNED_GROUP
+    if topic == 'assigned':
+        return admin_assigned_group(user.pk)
+    if topic.startswith('session:'):
+        return admin_session_group(uuid.UUID(topic[len('session:'):]))
+    raise ValueError(f'Unknown topic: {topic}')
+
+
+def session_summary(chat_session):
+    """Compact conversation row sent to admin dashboards with each event"""
+    return dict(ChatSessionSummarySerializer(chat_session).data)
+
+
+async def notify_admins(channel_layer, chat_session, event, stats=None, stats_delta=None):
+    """
+    Send an admin event for chat_session to the topics that want it: the full
+    event to agents viewing the conversation, a compact row to list and queue
+    subscribers and the counters (a snapshot, or just the change) to summary
+    subscribers
+    """
+    summary = session_summary(chat_session)
+    await channel_layer.group_send(
+        admin_session_group(chat_session.id),
+        dict(event, stats=stats, stats_delta=stats_delta, session=summary),
+    )
+
+    session_update = {'type': 'session_update', 'session': summary}
+    await channel_layer.group_send(ADMIN_SESSIONS_GROUP, session_update)
+    if chat_session.admin_user_id:
+        await channel_layer.group_send(admin_assigned_group(chat_session.admin_user_id), session_update)
+    else:
+        await channel_layer.group_send(ADMIN_UNASSIGNED_GROUP, session_update)
+
+    if stats is not None:
+        await channel_layer.group_send(ADMIN_SUMMARY_GROUP, {'type': 'stats_update', 'stats': stats})
+    elif stats_delta and any(stats_delta.values()):
+        await channel_layer.group_send(ADMIN_SUMMARY_GROUP, {'type': 'stats_update', 'stats_delta': stats_delta})
@@ -0,0 +1,140 @@
+"""
+Management command to load test the chat WebSocket consumers in-process
+"""
+import asyncio
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from redis.exceptions import ConnectionError as RedisConnectionError
+from chat.benchmark import BENCHMARK_CACHES, LATENCY_METRICS, layer_config, run_benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Opens simulated widget and admin sockets against ChatConsumer and AdminDashboardConsumer, '
+        'drives customer messages at a fixed rate and reports throughput and p50/p95/p99 latency'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--widgets', type=int, default=10, help='Number of widget (customer) sockets')
+        parser.add_argument('--admins', type=int, default=2, help='Number of admin dashboard sockets')
+        parser.add_argument('--rate', type=float, default=50, help='Customer messages per second across all widgets')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds to keep sending')
+        parser.add_argument(
+            '--auto-reply-ratio', type=float, default=0.1,
+            help='Fraction of messages that match the benchmark keyword auto-reply rule',
+        )
+        parser.add_argument(
+            '--drain-timeout', type=float, default=10,
+            help='Seconds to wait for outstanding deliveries after sending stops',
+        )
+        parser.add_argument(
+            '--layer',
+            action='append',
+            choices=['inmemory', 'redis'],
+            dest='layers',
+            help='Channel layer to run against (can be repeated; default: inmemory)',
+        )
+        parser.add_argument(
+            '--redis-url',
+            default=None,
+            help='Redis (or any Redis-compatible server) for --layer redis; defaults to REDIS_URL',
+        )
+        parser.add_argument(
+            '--admin-batch-ms', type=int, default=0,
+            help='Outbound batch window for the admin sockets in milliseconds (0 = one frame per event)',
+        )
+        parser.add_argument(
+            '--write-behind', action='store_true',
+            help='Persist messages through the batched write-behind buffer (CHAT_WRITE_BEHIND)',
+        )
+        parser.add_argument('--seed', type=int, default=0, help='Seed for choosing auto-reply messages')
+        parser.add_argument('--json', action='store_true', help='Print the reports as JSON')
+
+    def handle(self, *args, **options):
+        if options['widgets'] < 1 or options['rate'] <= 0 or options['duration'] <= 0:
+            raise CommandError('--widgets, --rate and --duration must be positive')
+
+        layers = options['layers'] or ['inmemory']
+        redis_url = options['redis_url'] or getattr(settings, 'REDIS_URL', None) or 'redis://127.0.0.1:6379/15'
+
+        # Run against a throwaway test database and a private cache so benchmark data never reaches the real ones
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        reports = []
+        try:
+            for layer in layers:
+                with override_settings(
+                    CACHES=BENCHMARK_CACHES,
+                    CHANNEL_LAYERS={'default': layer_config(layer, redis_url)},
+                    CHAT_WRITE_BEHIND=options['write_behind'] or settings.CHAT_WRITE_BEHIND,
+                ):
+                    try:
+                        report = asyncio.run(run_benchmark(
+                            widgets=options['widgets'],
+                            admins=options['admins'],
+                            rate=options['rate'],
+                            duration=options['duration'],
+                            auto_reply_ratio=options['auto_reply_ratio'],
+                            admin_batch_ms=options['admin_batch_ms'],
+                            drain_timeout=options['drain_timeout'],
+                            seed=options['seed'],
+                        ))
+                    except RedisConnectionError as e:
+                        raise CommandError(f'Could not connect to Redis at {redis_url}: {e}') from e
+                report['layer'] = layer
+                report['write_behind'] = options['write_behind'] or settings.CHAT_WRITE_BEHIND
+                reports.append(report)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['json']:
+            self.stdout.write(json.dumps(reports, indent=2))
+            return
+
+        for report in reports:
+            self.write_report(report)
+
+    def write_report(self, report):
+        options = []
+        if report['write_behind']:
+            options.append('write-behind')
+        if report['admin_batch_ms']:
+            options.append(f"admin batch {report['admin_batch_ms']}ms")
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"{report['layer']}: {report['widgets']} widget sockets, {report['admins']} admin sockets, "
+            f"{report['offered_rate']:g} msg/s offered for {report['duration']:g}s"
+            f"{' (' + ', '.join(options) + ')' if options else ''}"
+        ))
+        self.stdout.write(
+            f"  sent {report['messages_sent']} messages ({report['auto_reply_triggers']} auto-reply triggers) "
+            f"at {report['send_rate']:g} msg/s"
+        )
+        self.stdout.write(
+            f"  processed {report['processed_rate']:g} msg/s, "
+            f"delivered {report['frames_received']} frames ({report['frames_per_second']:g} frames/s)"
+        )
+        self.stdout.write(f"  {'latency (ms)':<14}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+        for name in LATENCY_METRICS:
+            summary = report['latency_ms'][name]
+            values = ''.join(
+                f"{summary[key]:>10.2f}" if summary[key] is not None else f"{'-':>10}"
+                for key in ['p50', 'p95', 'p99', 'max']
+            )
+            self.stdout.write(f"  {name:<14}{summary['count']:>8}{values}")
+
+        executor = report['db_executor']
+        line = f"  db executor: {executor['max_workers']} threads, {executor['completed']} calls"
+        if executor['wait_ms']['max'] is not None:
+            line += (
+                f", max queue depth {executor['max_queue_depth']}, "
+                f"wait p95 {executor['wait_ms']['p95']:.2f}ms max {executor['wait_ms']['max']:.2f}ms"
+            )
+        self.stdout.write(line)
+
+        missing = {name: count for name, count in report['missing'].items() if count}
+        if missing:
+            self.stdout.write(self.style.WARNING(f'  not delivered before the drain timeout: {missing}'))
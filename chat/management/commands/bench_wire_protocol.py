@@ -0,0 +1,37 @@
+"""
+Management command to compare the WebSocket wire protocols
+"""
+import json
+
+from django.core.management.base import BaseCommand
+from chat.benchmark import measure_wire_codecs
+
+
+class Command(BaseCommand):
+    help = 'Compares bytes per frame and encode/decode cost of the JSON, compact JSON and msgpack wire protocols'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000, help='Encode/decode repetitions per measurement')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        results = measure_wire_codecs(options['iterations'])
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        baseline = {}
+        current_frame = None
+        for row in results:
+            if row['frame'] != current_frame:
+                current_frame = row['frame']
+                baseline[current_frame] = row['bytes']
+                self.stdout.write(self.style.MIGRATE_HEADING(current_frame))
+                self.stdout.write(
+                    f"  {'protocol':<20}{'bytes':>8}{'vs json':>9}{'deflated':>10}{'encode us':>11}{'decode us':>11}"
+                )
+            ratio = row['bytes'] / baseline[current_frame]
+            self.stdout.write(
+                f"  {row['protocol']:<20}{row['bytes']:>8}{ratio:>8.0%} {row['deflated_bytes']:>10}"
+                f"{row['encode_us']:>11.2f}{row['decode_us']:>11.2f}"
+            )
@@ -0,0 +1,29 @@
+"""
+Management command to backfill preview thumbnails for image attachments
+"""
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from chat.models import Message
+from chat.thumbnails import create_thumbnail, is_image
+
+
+class Command(BaseCommand):
+    help = 'Creates preview thumbnails for image attachments that do not have one yet'
+
+    def handle(self, *args, **options):
+        messages = Message.objects.exclude(attachment='').exclude(attachment__isnull=True).filter(
+            attachment_thumbnail__isnull=True
+        )
+        
+        # Rendered in the thumbnail pool; each is saved on its message (and announced) when ready
+        pending = []
+        for message in messages.iterator():
+            if not is_image(message.attachment.name):
+                continue
+            if not default_storage.exists(message.attachment.name):
+                self.stderr.write(f'Missing attachment for message {message.id}: {message.attachment.name}')
+                continue
+            pending.append(create_thumbnail(message.attachment.name, message.pk))
+        
+        created = sum(1 for future in pending if future.result() is not None)
+        self.stdout.write(self.style.SUCCESS(f'Created {created} thumbnails'))
@@ -0,0 +1,30 @@
+"""
+Management command to delete chunked uploads that were never finished and
+stored attachments that no message uses
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.uploads import purge_stale_uploads, purge_unused_attachments
+
+
+class Command(BaseCommand):
+    help = ('Deletes unfinished chunked uploads (and their partial files) that have not received data recently, '
+            'and stored attachments no message has referenced for as long')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours',
+            type=int,
+            default=settings.CHAT_UPLOAD_EXPIRY_HOURS,
+            help='Delete uploads and attachments idle for longer than this many hours (default: CHAT_UPLOAD_EXPIRY_HOURS)',
+        )
+
+    def handle(self, *args, **options):
+        max_age = timedelta(hours=options['hours'])
+        purged_uploads = purge_stale_uploads(max_age)
+        purged_attachments = purge_unused_attachments(max_age)
+        self.stdout.write(self.style.SUCCESS(
+            f'Purged {purged_uploads} stale uploads and {purged_attachments} unused attachments'
+        ))
@@ -0,0 +1,32 @@
+"""
+Management command to rebuild the conversation full-text search index
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from chat.models import ChatSession, Message
+from chat.search import clear_index, index_message, index_session, search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search index from all chat sessions and messages'
+
+    def handle(self, *args, **options):
+        backend = search_backend()
+        if backend is None:
+            self.stdout.write(self.style.WARNING('Full-text search is not supported on this database'))
+            return
+        
+        with transaction.atomic():
+            clear_index()
+            sessions = 0
+            for chat_session in ChatSession.objects.iterator():
+                index_session(chat_session)
+                sessions += 1
+            messages = 0
+            for message in Message.objects.only('id', 'chat_session_id', 'content').iterator():
+                index_message(message)
+                messages += 1
+        
+        self.stdout.write(
+            self.style.SUCCESS(f'Indexed {sessions} chat sessions and {messages} messages ({backend})')
+        )
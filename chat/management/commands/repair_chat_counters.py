@@ -0,0 +1,42 @@
+"""
+Management command to backfill or repair the denormalized ChatSession counters
+"""
+from django.core.management.base import BaseCommand
+from chat.models import ChatSession
+
+
+class Command(BaseCommand):
+    help = 'Recomputes unread/customer message counters and the last message pointer for chat sessions'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--customer-id',
+            action='append',
+            dest='customer_ids',
+            help='Only repair the session for this customer (can be repeated)',
+        )
+
+    def handle(self, *args, **options):
+        sessions = ChatSession.objects.all()
+        if options['customer_ids']:
+            sessions = sessions.filter(customer_id__in=options['customer_ids'])
+        
+        repaired = 0
+        for chat_session in sessions.iterator():
+            before = (
+                chat_session.unread_count,
+                chat_session.customer_message_count,
+                chat_session.last_message_id,
+            )
+            chat_session.recalculate_counters()
+            after = (
+                chat_session.unread_count,
+                chat_session.customer_message_count,
+                chat_session.last_message_id,
+            )
+            if before != after:
+                repaired += 1
+        
+        self.stdout.write(
+            self.style.SUCCESS(f'Checked {sessions.count()} chat sessions, repaired {repaired}')
+        )
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.7 on 2026-10-17 01:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_chatsession_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledResponse',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigger_message_content', models.TextField(help_text='The customer message that triggered this response')),
+                ('due_at', models.DateTimeField(help_text='When the response should be sent')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('cancelled', 'Cancelled')], default='pending', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('automated_response', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='chat.automatedresponse')),
+                ('chat_session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scheduled_responses', to='chat.chatsession')),
+            ],
+            options={
+                'verbose_name': 'Scheduled Response',
+                'verbose_name_plural': 'Scheduled Responses',
+                'ordering': ['due_at'],
+                'indexes': [models.Index(fields=['status', 'due_at'], name='chat_schedu_status_33d564_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.7 on 2026-10-17 01:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_scheduledresponse'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatsession',
+            index=models.Index(fields=['updated_at', 'id'], name='chat_session_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatsession',
+            index=models.Index(fields=['status', 'updated_at', 'id'], name='chat_session_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatsession',
+            index=models.Index(fields=['admin_user', 'updated_at', 'id'], name='chat_session_assignee_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatsession',
+            index=models.Index(fields=['created_at'], name='chat_session_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat_session', 'timestamp', 'id'], name='chat_msg_session_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat_session', 'sender_type', 'is_read'], name='chat_msg_session_sender_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_read', False), ('sender_type', 'customer')), fields=['chat_session'], name='chat_msg_unread_customer_idx'),
+        ),
+    ]
@@ -0,0 +1,114 @@
+from django.db import migrations
+
+
+SQLITE_CREATE = [
+    """
+    CREATE TABLE chat_search_document (
+        id INTEGER PRIMARY KEY,
+        doc_type TEXT NOT NULL,
+        object_id TEXT NOT NULL,
+        session_id TEXT NOT NULL,
+        body TEXT NOT NULL,
+        UNIQUE (doc_type, object_id)
+    )
+    """,
+    """
+    CREATE VIRTUAL TABLE chat_search_index USING fts5(
+        body,
+        doc_type UNINDEXED,
+        session_id UNINDEXED,
+        object_id UNINDEXED,
+        content = 'chat_search_document',
+        content_rowid = 'id',
+        tokenize = 'porter unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER chat_search_document_ai AFTER INSERT ON chat_search_document BEGIN
+        INSERT INTO chat_search_index (rowid, body, doc_type, session_id, object_id)
+        VALUES (new.id, new.body, new.doc_type, new.session_id, new.object_id);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_search_document_ad AFTER DELETE ON chat_search_document BEGIN
+        INSERT INTO chat_search_index (chat_search_index, rowid, body, doc_type, session_id, object_id)
+        VALUES ('delete', old.id, old.body, old.doc_type, old.session_id, old.object_id);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_search_document_au AFTER UPDATE ON chat_search_document BEGIN
+        INSERT INTO chat_search_index (chat_search_index, rowid, body, doc_type, session_id, object_id)
+        VALUES ('delete', old.id, old.body, old.doc_type, old.session_id, old.object_id);
+        INSERT INTO chat_search_index (rowid, body, doc_type, session_id, object_id)
+        VALUES (new.id, new.body, new.doc_type, new.session_id, new.object_id);
+    END
+    """,
+]
+
+POSTGRESQL_CREATE = [
+    """
+    CREATE TABLE chat_search_index (
+        doc_type varchar(10) NOT NULL,
+        object_id uuid NOT NULL,
+        session_id uuid NOT NULL,
+        body text NOT NULL,
+        document tsvector GENERATED ALWAYS AS (to_tsvector('english', body)) STORED,
+        PRIMARY KEY (doc_type, object_id)
+    )
+    """,
+    "CREATE INDEX chat_search_document_idx ON chat_search_index USING GIN (document)",
+]
+
+
+def _db_id(pk, connection):
+    # Stored like the UUID primary keys so hits can be joined to chat_chatsession
+    return pk if connection.features.has_native_uuid_field else pk.hex
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        statements = SQLITE_CREATE
+        table = 'chat_search_document'
+    elif connection.vendor == 'postgresql':
+        statements = POSTGRESQL_CREATE
+        table = 'chat_search_index'
+    else:
+        return
+
+    for statement in statements:
+        schema_editor.execute(statement)
+
+    # Backfill existing conversations and messages
+    ChatSession = apps.get_model('chat', 'ChatSession')
+    Message = apps.get_model('chat', 'Message')
+    rows = []
+    for session in ChatSession.objects.iterator():
+        body = ' '.join(filter(None, [session.customer_name, session.customer_email, session.customer_id]))
+        rows.append(('session', _db_id(session.pk, connection), _db_id(session.pk, connection), body))
+    for message in Message.objects.only('id', 'chat_session_id', 'content').iterator():
+        rows.append((
+            'message', _db_id(message.pk, connection), _db_id(message.chat_session_id, connection), message.content,
+        ))
+    if rows:
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {table} (doc_type, object_id, session_id, body) VALUES (%s, %s, %s, %s)', rows
+            )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute('DROP TABLE IF EXISTS chat_search_index')
+        schema_editor.execute('DROP TABLE IF EXISTS chat_search_document')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_chat_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 01:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_chunked_upload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='attachment_thumbnail',
+            field=models.FileField(blank=True, null=True, upload_to='chat_attachments/thumbnails/'),
+        ),
+    ]
@@ -1,6 +1,15 @@
-from django.db import models
+from collections import Counter
+from django.db import connections, models, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 import uuid
+import zoneinfo
+
+
+LAST_MESSAGE_PREVIEW_LENGTH = 100
 
 
 class ChatSession(models.Model):
@@ -19,15 +28,77 @@ class ChatSession(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     admin_user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
     
+    # Denormalized counters, maintained by Message.save() in the insert transaction
+    # and by the Message post_delete signal
+    unread_count = models.PositiveIntegerField(default=0)
+    customer_message_count = models.PositiveIntegerField(default=0)
+    last_message = models.ForeignKey(
+        'Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    last_message_preview = models.CharField(max_length=LAST_MESSAGE_PREVIEW_LENGTH, blank=True)
+    last_activity_at = models.DateTimeField(null=True, blank=True)
+    
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            # Admin session list: keyset pages on (updated_at, id), optionally by status or assignee
+            models.Index(fields=['updated_at', 'id'], name='chat_session_updated_idx'),
+            models.Index(fields=['status', 'updated_at', 'id'], name='chat_session_status_idx'),
+            models.Index(fields=['admin_user', 'updated_at', 'id'], name='chat_session_assignee_idx'),
+            # Dashboard "recent sessions" count
+            models.Index(fields=['created_at'], name='chat_session_created_idx'),
+        ]
     
     def __str__(self):
         return f"Chat {self.id} - {self.customer_name or self.customer_id}"
     
     @property
     def unread_messages_count(self):
-        return self.messages.filter(is_read=False, sender_type='customer').count()
+        return self.unread_count
+    
+    def mark_customer_messages_read(self):
+        """
+        Mark all unread customer messages as read and take them off the unread counter
+        Returns the number of messages marked as read
+        """
+        with transaction.atomic():
+            marked_read = Message.objects.filter(
+                chat_session=self,
+                sender_type='customer',
+                is_read=False
+            ).update(is_read=True)
+            if marked_read:
+                # Messages arriving concurrently stay counted
+                ChatSession.objects.filter(pk=self.pk).update(
+                    unread_count=Greatest(F('unread_count') - marked_read, 0)
+                )
+        self.refresh_from_db(fields=['unread_count'])
+        return marked_read
+    
+    def recalculate_counters(self):
+        """Recompute the denormalized counters from the message table"""
+        customer_messages = self.messages.filter(sender_type='customer')
+        
+        self.unread_count = customer_messages.filter(is_read=False).count()
+        self.customer_message_count = customer_messages.count()
+        last_message_fields = self.newest_message_fields(self.pk)
+        for field, value in last_message_fields.items():
+            setattr(self, field, value)
+        ChatSession.objects.filter(pk=self.pk).update(
+            unread_count=self.unread_count,
+            customer_message_count=self.customer_message_count,
+            **last_message_fields
+        )
+    
+    @staticmethod
+    def newest_message_fields(session_id):
+        """last_message, last_message_preview and last_activity_at for a session's newest message"""
+        last_message = Message.objects.filter(chat_session_id=session_id).order_by('-timestamp', '-id').first()
+        return {
+            'last_message': last_message,
+            'last_message_preview': last_message.preview if last_message else '',
+            'last_activity_at': last_message.timestamp if last_message else None,
+        }
 
 
 class Message(models.Model):
@@ -44,14 +115,104 @@ class Message(models.Model):
     sender_type = models.CharField(max_length=10, choices=SENDER_TYPES)
     sender_name = models.CharField(max_length=100, blank=True, null=True)
     attachment = models.FileField(upload_to='chat_attachments/', blank=True, null=True)
+    # Bounded-size preview of an image attachment (see chat/thumbnails.py)
+    attachment_thumbnail = models.FileField(upload_to='chat_attachments/thumbnails/', blank=True, null=True)
     is_read = models.BooleanField(default=False)
     timestamp = models.DateTimeField(auto_now_add=True)
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Chat history: keyset pages on (timestamp, id) within a session
+            models.Index(fields=['chat_session', 'timestamp', 'id'], name='chat_msg_session_time_idx'),
+            # Per-session customer message counts and read marking
+            models.Index(fields=['chat_session', 'sender_type', 'is_read'], name='chat_msg_session_sender_idx'),
+            # Unread customer messages only; stays small because most messages get read
+            models.Index(
+                fields=['chat_session'],
+                condition=models.Q(sender_type='customer', is_read=False),
+                name='chat_msg_unread_customer_idx',
+            ),
+        ]
     
     def __str__(self):
         return f"{self.sender_type}: {self.content[:50]}..."
+    
+    @property
+    def preview(self):
+        return self.content[:LAST_MESSAGE_PREVIEW_LENGTH]
+    
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            # Edits (including a thumbnail being filled in) change the history's ETag
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                ChatSession.objects.filter(pk=self.chat_session_id).update(updated_at=timezone.now())
+            return
+        
+        # Insert the message and bump the session counters in one transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self._count_on_session()
+            if self.attachment:
+                AttachmentBlob.add_references([self.attachment.name])
+            if self.sender_type == 'admin':
+                ScheduledResponse.cancel_pending(self.chat_session_id)
+    
+    def _count_on_session(self):
+        """
+        Bump the session counters for this new message and make it the last message
+        A chat_session handle the message was created with is updated from the
+        values the UPDATE wrote, using RETURNING where the database supports it
+        instead of reading the row back.
+        """
+        is_customer = self.sender_type == 'customer'
+        increments = {
+            'unread_count': int(is_customer and not self.is_read),
+            'customer_message_count': int(is_customer),
+        }
+        values = {
+            'last_message_id': self.pk,
+            'last_message_preview': self.preview,
+            'last_activity_at': self.timestamp,
+            'updated_at': self.timestamp,
+        }
+        returned_fields = ['status', 'unread_count', 'customer_message_count']
+        connection = connections[self._state.db]
+        
+        if connection.features.can_return_columns_from_insert:
+            opts = ChatSession._meta
+            quote_name = connection.ops.quote_name
+            column = lambda name: quote_name(opts.get_field(name).column)
+            assignments = [f'{column(name)} = {column(name)} + %s' for name in increments]
+            assignments += [f'{column(name)} = %s' for name in values]
+            params = list(increments.values())
+            params += [opts.get_field(name).get_db_prep_save(value, connection) for name, value in values.items()]
+            params.append(opts.pk.get_db_prep_value(self.chat_session_id, connection))
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'UPDATE {quote_name(opts.db_table)} SET {", ".join(assignments)} '
+                    f'WHERE {quote_name(opts.pk.column)} = %s '
+                    f'RETURNING {", ".join(column(name) for name in returned_fields)}',
+                    params,
+                )
+                returned = cursor.fetchone()
+        else:
+            ChatSession.objects.using(self._state.db).filter(pk=self.chat_session_id).update(
+                **{name: F(name) + amount for name, amount in increments.items()}, **values
+            )
+            returned = None
+        
+        if not Message.chat_session.is_cached(self):
+            return
+        chat_session = self.chat_session
+        for name, value in values.items():
+            setattr(chat_session, name, value)
+        if returned is not None:
+            for name, value in zip(returned_fields, returned):
+                setattr(chat_session, name, value)
+        else:
+            chat_session.refresh_from_db(fields=returned_fields)
 
 
 class ChatWidget(models.Model):
@@ -76,6 +237,74 @@ class ChatWidget(models.Model):
         return self.name
 
 
+class ChunkedUpload(models.Model):
+    """An attachment being uploaded in chunks; received is the last acknowledged offset"""
+    STATUS_CHOICES = [
+        ('uploading', 'Uploading'),
+        # A request has claimed the chunk at received and is writing it
+        ('receiving', 'Receiving'),
+        ('complete', 'Complete'),
+    ]
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    customer_id = models.CharField(max_length=50)
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='uploading')
+    attachment_path = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'updated_at']),
+        ]
+        verbose_name = 'Chunked Upload'
+        verbose_name_plural = 'Chunked Uploads'
+    
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size} bytes)"
+
+
+class AttachmentBlob(models.Model):
+    """
+    One stored copy of an attachment's content, shared by every message that sends it
+    ref_count is the number of messages whose attachment is this blob's path
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    path = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        indexes = [
+            # Unreferenced blobs waiting to be purged
+            models.Index(fields=['ref_count', 'updated_at']),
+        ]
+        verbose_name = 'Attachment Blob'
+        verbose_name_plural = 'Attachment Blobs'
+    
+    def __str__(self):
+        return f"{self.path} ({self.ref_count} references)"
+    
+    @classmethod
+    def add_references(cls, paths):
+        """Count new messages attached to paths (attachments stored before blobs existed are ignored)"""
+        for path, count in Counter(paths).items():
+            cls.objects.filter(path=path).update(ref_count=F('ref_count') + count, updated_at=timezone.now())
+    
+    @classmethod
+    def remove_reference(cls, path):
+        cls.objects.filter(path=path, ref_count__gt=0).update(
+            ref_count=F('ref_count') - 1, updated_at=timezone.now()
+        )
+
+
 class AutomatedResponse(models.Model):
     """Automated response rules for chat"""
     TRIGGER_TYPES = [
@@ -125,9 +354,11 @@ class AutomatedResponse(models.Model):
             return False
         
         if self.trigger_type == 'keyword':
-            keywords = self.get_keywords_list()
-            message_lower = message_content.lower()
-            return any(keyword in message_lower for keyword in keywords)
+            from .rule_engine import KeywordAutomaton
+            automaton = KeywordAutomaton()
+            for keyword in self.get_keywords_list():
+                automaton.add(keyword, True)
+            return bool(automaton.search(message_content))
         
         return False
 
@@ -147,3 +378,111 @@ class AutomatedResponseLog(models.Model):
     
     def __str__(self):
         return f"Auto-response in {self.chat_session} at {self.sent_at}"
+
+
+class ScheduledResponse(models.Model):
+    """Delayed automated response waiting to be sent by the response scheduler"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('cancelled', 'Cancelled'),
+    ]
+    
+    chat_session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='scheduled_responses')
+    automated_response = models.ForeignKey(AutomatedResponse, on_delete=models.SET_NULL, null=True)
+    trigger_message_content = models.TextField(help_text="The customer message that triggered this response")
+    due_at = models.DateTimeField(help_text="When the response should be sent")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['due_at']
+        indexes = [
+            models.Index(fields=['status', 'due_at']),
+        ]
+        verbose_name = 'Scheduled Response'
+        verbose_name_plural = 'Scheduled Responses'
+    
+    def __str__(self):
+        return f"Scheduled response in {self.chat_session} due {self.due_at} ({self.status})"
+    
+    @classmethod
+    def cancel_pending(cls, chat_session_id):
+        """Drop the auto-replies still waiting in a conversation; an admin answered first"""
+        return cls.objects.filter(chat_session_id=chat_session_id, status='pending').update(status='cancelled')
+
+
+def validate_timezone(value):
+    try:
+        zoneinfo.ZoneInfo(value)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        raise ValidationError(f'Unknown time zone: {value}')
+
+
+class BusinessCalendar(models.Model):
+    """Opening hours used by the 'Outside Business Hours' automated responses"""
+    name = models.CharField(max_length=100, default='Business Hours')
+    timezone = models.CharField(
+        max_length=64,
+        default='UTC',
+        validators=[validate_timezone],
+        help_text="IANA time zone the hours and holidays are in, e.g. Africa/Nairobi"
+    )
+    is_active = models.BooleanField(
+        default=True,
+        help_text="The first active calendar is used"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-is_active', 'created_at']
+        verbose_name = 'Business Calendar'
+        verbose_name_plural = 'Business Calendars'
+    
+    def __str__(self):
+        return f"{self.name} ({self.timezone})"
+
+
+class BusinessHours(models.Model):
+    """An opening period on one day of the week"""
+    WEEKDAYS = [
+        (0, 'Monday'),
+        (1, 'Tuesday'),
+        (2, 'Wednesday'),
+        (3, 'Thursday'),
+        (4, 'Friday'),
+        (5, 'Saturday'),
+        (6, 'Sunday'),
+    ]
+    
+    calendar = models.ForeignKey(BusinessCalendar, on_delete=models.CASCADE, related_name='hours')
+    weekday = models.PositiveSmallIntegerField(choices=WEEKDAYS)
+    opens_at = models.TimeField()
+    closes_at = models.TimeField(
+        help_text="A closing time at or before the opening time runs past midnight"
+    )
+    
+    class Meta:
+        ordering = ['weekday', 'opens_at']
+        verbose_name = 'Business Hours'
+        verbose_name_plural = 'Business Hours'
+    
+    def __str__(self):
+        return f"{self.get_weekday_display()} {self.opens_at:%H:%M}-{self.closes_at:%H:%M}"
+
+
+class Holiday(models.Model):
+    """A day the business is closed all day"""
+    calendar = models.ForeignKey(BusinessCalendar, on_delete=models.CASCADE, related_name='holidays')
+    date = models.DateField()
+    name = models.CharField(max_length=100, blank=True)
+    
+    class Meta:
+        ordering = ['date']
+        unique_together = [('calendar', 'date')]
+        verbose_name = 'Holiday'
+        verbose_name_plural = 'Holidays'
+    
+    def __str__(self):
+        return f"{self.name or 'Holiday'} ({self.date})"
@@ -0,0 +1,59 @@
+"""
+Keyset (cursor) pagination helpers for the chat APIs
+"""
+import base64
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+MAX_PAGE_SIZE = 200
+
+
+def parse_page_size(value):
+    """Clamp a client-supplied page size, falling back to the REST_FRAMEWORK page size if it is not a number"""
+    default = settings.REST_FRAMEWORK.get('PAGE_SIZE', 50)
+    try:
+        limit = int(value)
+    except (TypeError, ValueError, OverflowError):
+        limit = default
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def get_page_size(request):
+    """Read ?limit= from the request, falling back to the REST_FRAMEWORK page size"""
+    return parse_page_size(request.GET.get('limit'))
+
+
+def encode_cursor(timestamp, pk):
+    """Encode a (timestamp, id) position as an opaque URL-safe cursor"""
+    raw = json.dumps([timestamp.isoformat(), str(pk)]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor produced by encode_cursor
+    Returns (timestamp, id); raises ValueError if the cursor is malformed
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, pk = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError('Invalid cursor') from e
+    parsed = parse_datetime(timestamp)
+    if parsed is None:
+        raise ValueError('Invalid cursor')
+    return parsed, pk
+
+
+def keyset_after(field, timestamp, pk):
+    """Q matching rows strictly after (timestamp, id) in ascending order"""
+    return Q(**{f'{field}__gt': timestamp}) | Q(**{field: timestamp, 'id__gt': pk})
+
+
+def keyset_before(field, timestamp, pk):
+    """Q matching rows strictly before (timestamp, id) in ascending order"""
+    return Q(**{f'{field}__lt': timestamp}) | Q(**{field: timestamp, 'id__lt': pk})
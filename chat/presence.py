@@ -0,0 +1,158 @@
+"""
+Agent presence registry
+
+Tracks which staff users have an admin dashboard socket open. Each worker
+counts its own AdminDashboardConsumer connections per agent and publishes one
+shared-cache key per (agent, worker) with a PRESENCE_TTL timeout, refreshed by
+a heartbeat task every PRESENCE_HEARTBEAT_INTERVAL seconds. A worker that dies
+stops heartbeating, so its agents drop out once the keys expire.
+
+A roster key lists the live (agent, worker) entries. Every worker keeps a
+process-local snapshot of the online agents, rebuilt from the roster at most
+every PRESENCE_REFRESH_INTERVAL seconds, so "is any agent online" and "who is
+online" are answered from memory. The roster is updated read-modify-write;
+a lost update is repaired by the owning worker's next heartbeat.
+"""
+import asyncio
+import logging
+import time
+import uuid
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_KEY_PREFIX = 'chat:presence:agent:'
+PRESENCE_ROSTER_KEY = 'chat:presence:roster'
+
+# Seconds before an agent entry expires without a heartbeat
+PRESENCE_TTL = 60
+
+# How often (in seconds) each worker refreshes its agents' entries
+PRESENCE_HEARTBEAT_INTERVAL = 20
+
+# How often (in seconds) a worker re-reads the shared roster
+PRESENCE_REFRESH_INTERVAL = 5
+
+
+def _display_name(user):
+    return user.get_full_name() or user.username
+
+
+class PresenceRegistry:
+    """Per-worker view of the agents connected to any worker"""
+
+    def __init__(self, ttl=PRESENCE_TTL, heartbeat_interval=PRESENCE_HEARTBEAT_INTERVAL,
+                 refresh_interval=PRESENCE_REFRESH_INTERVAL):
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.refresh_interval = refresh_interval
+        self.worker_id = uuid.uuid4().hex[:12]
+        self._local = {}  # user_id -> [display name, open sockets] on this worker
+        self._online = {}  # user_id -> display name across all workers
+        self._refreshed_at = None
+        self._task = None
+        self._loop = None
+
+    def _entry(self, user_id):
+        return f'{user_id}:{self.worker_id}'
+
+    def _key(self, entry):
+        return f'{PRESENCE_KEY_PREFIX}{entry}'
+
+    def ensure_started(self):
+        """Start the heartbeat task on the running event loop if needed"""
+        loop = asyncio.get_running_loop()
+        if self._task is not None and self._loop is loop and not self._task.done():
+            return
+        self._loop = loop
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.heartbeat()
+            except Exception:
+                logger.exception('Failed to publish agent presence')
+
+    async def connect(self, user):
+        """Register an admin socket for user"""
+        self.ensure_started()
+        local = self._local.setdefault(user.id, [_display_name(user), 0])
+        local[1] += 1
+        self._online[user.id] = local[0]
+        if local[1] == 1:
+            await self._publish([user.id])
+
+    async def disconnect(self, user):
+        """Unregister an admin socket for user"""
+        local = self._local.get(user.id)
+        if local is None:
+            return
+        local[1] -= 1
+        if local[1] > 0:
+            return
+        del self._local[user.id]
+        self._online.pop(user.id, None)
+        entry = self._entry(user.id)
+        await cache.adelete(self._key(entry))
+        roster = await cache.aget(PRESENCE_ROSTER_KEY, {})
+        if entry in roster:
+            del roster[entry]
+            await cache.aset(PRESENCE_ROSTER_KEY, roster, timeout=None)
+        # Another worker may still hold a socket for this agent
+        self._refreshed_at = None
+
+    async def heartbeat(self):
+        """Refresh the entries of every agent connected to this worker"""
+        if self._local:
+            await self._publish(list(self._local))
+
+    async def _publish(self, user_ids):
+        entries = {self._entry(user_id): self._local[user_id][0] for user_id in user_ids}
+        await cache.aset_many({self._key(entry): name for entry, name in entries.items()}, timeout=self.ttl)
+        roster = await cache.aget(PRESENCE_ROSTER_KEY, {})
+        missing = {entry: name for entry, name in entries.items() if entry not in roster}
+        if missing:
+            roster.update(missing)
+            await cache.aset(PRESENCE_ROSTER_KEY, roster, timeout=None)
+
+    async def refresh(self):
+        """Rebuild the online snapshot from the shared roster, dropping expired entries"""
+        roster = await cache.aget(PRESENCE_ROSTER_KEY, {})
+        live = await cache.aget_many([self._key(entry) for entry in roster]) if roster else {}
+        online = {}
+        expired = []
+        for entry in roster:
+            name = live.get(self._key(entry))
+            if name is None:
+                expired.append(entry)
+                continue
+            online[int(entry.split(':', 1)[0])] = name
+        if expired:
+            for entry in expired:
+                del roster[entry]
+            await cache.aset(PRESENCE_ROSTER_KEY, roster, timeout=None)
+        for user_id, (name, _) in self._local.items():
+            online[user_id] = name
+        self._online = online
+        self._refreshed_at = time.monotonic()
+
+    async def _snapshot(self):
+        if self._refreshed_at is None or time.monotonic() - self._refreshed_at >= self.refresh_interval:
+            await self.refresh()
+        return self._online
+
+    async def any_online(self):
+        """True if at least one agent has a dashboard socket open on any worker"""
+        return bool(await self._snapshot())
+
+    async def online_agents(self):
+        """Agents with a dashboard socket open, as [{'user_id', 'name'}]"""
+        online = await self._snapshot()
+        return [{'user_id': user_id, 'name': name} for user_id, name in online.items()]
+
+
+# One registry per worker process
+agent_presence = PresenceRegistry()
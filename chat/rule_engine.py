@@ -0,0 +1,173 @@
+"""
+In-memory rule engine for automated responses
+
+All active AutomatedResponse rules are compiled into a single Aho-Corasick
+automaton that is kept in process memory, so matching a customer message is
+one pass over the text with no database reads. The compiled engine is rebuilt
+whenever the shared version stamp (bumped by the AutomatedResponse save/delete
+signals in any worker) changes.
+"""
+from collections import deque
+
+from .models import AutomatedResponse
+from .versioned_cache import VersionedCache
+
+
+# Phrases that fire the 'greeting' trigger type
+GREETING_KEYWORDS = ['hello', 'hi', 'hey', 'good morning', 'good afternoon', 'good evening']
+
+RULES_VERSION_CACHE_KEY = 'chat:automated_responses:version'
+
+# How often (in seconds) a worker checks the shared version stamp
+RULES_VERSION_CHECK_INTERVAL = 5
+
+GREETING = object()
+
+
+def normalize_text(text):
+    """Lower-case and collapse whitespace so patterns match regardless of spacing"""
+    return ' '.join(text.lower().split())
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton over normalized patterns
+
+    Matches are word-boundary aware: a pattern that starts or ends with a word
+    character only matches when the neighbouring character in the text is not
+    a word character, so 'hi' does not match 'this'.
+    """
+
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        self._built = True
+
+    def add(self, pattern, payload):
+        """Add a pattern that reports payload when found"""
+        pattern = normalize_text(pattern)
+        if not pattern:
+            return
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append((pattern, payload))
+        self._built = False
+
+    def build(self):
+        """Compute failure links breadth-first"""
+        queue = deque(self._goto[0].values())
+        for state in queue:
+            self._fail[state] = 0
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+        self._built = True
+        return self
+
+    def search(self, text):
+        """Return the set of payloads whose patterns occur in text"""
+        if not self._built:
+            self.build()
+        text = normalize_text(text)
+        length = len(text)
+        found = set()
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for pattern, payload in self._output[state]:
+                if payload in found:
+                    continue
+                start = index - len(pattern) + 1
+                if _is_word_char(pattern[0]) and start > 0 and _is_word_char(text[start - 1]):
+                    continue
+                if _is_word_char(pattern[-1]) and index + 1 < length and _is_word_char(text[index + 1]):
+                    continue
+                found.add(payload)
+        return found
+
+
+class RuleEngine:
+    """Compiled snapshot of the active automated response rules"""
+
+    def __init__(self, responses):
+        self._by_trigger = {trigger: [] for trigger, _ in AutomatedResponse.TRIGGER_TYPES}
+        self._automaton = KeywordAutomaton()
+
+        ordered = sorted(responses, key=lambda r: r.priority, reverse=True)
+        for response in ordered:
+            self._by_trigger.setdefault(response.trigger_type, []).append(response)
+            if response.trigger_type == 'keyword':
+                for keyword in response.get_keywords_list():
+                    self._automaton.add(keyword, response.id)
+
+        for greeting in GREETING_KEYWORDS:
+            self._automaton.add(greeting, GREETING)
+        self._automaton.build()
+
+    def match(self, message_content):
+        """
+        Scan a message once
+        Returns (matching keyword responses ordered by priority, is_greeting)
+        """
+        hits = self._automaton.search(message_content)
+        keyword_responses = [r for r in self._by_trigger['keyword'] if r.id in hits]
+        return keyword_responses, GREETING in hits
+
+    def responses_for(self, trigger_type):
+        """Active responses for a non-keyword trigger type, ordered by priority"""
+        return list(self._by_trigger.get(trigger_type, []))
+
+    def get_response(self, response_id):
+        """The compiled copy of a response, or None if it is not in this engine"""
+        for responses in self._by_trigger.values():
+            for response in responses:
+                if response.id == response_id:
+                    return response
+        return None
+
+
+def _load_engine():
+    return RuleEngine(list(AutomatedResponse.objects.filter(is_active=True)))
+
+
+_rules = VersionedCache(RULES_VERSION_CACHE_KEY, _load_engine, RULES_VERSION_CHECK_INTERVAL)
+
+
+def invalidate_rule_engine():
+    """Bump the shared version stamp so every worker rebuilds its engine"""
+    _rules.invalidate()
+
+
+async def get_rule_engine():
+    """
+    Return the compiled rule engine for this process
+    The shared version stamp is checked at most every RULES_VERSION_CHECK_INTERVAL
+    seconds; the database is only read when the rules have changed.
+    """
+    return await _rules.aget()
+
+
+def get_rule_engine_sync():
+    """get_rule_engine for synchronous callers"""
+    return _rules.get()
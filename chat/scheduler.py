@@ -0,0 +1,145 @@
+"""
+Scheduler for delayed automated responses
+
+Delayed responses are persisted as ScheduledResponse rows and kept in a
+per-process min-heap ordered by due time. A single background task per worker
+sleeps until the next response is due, so the ChatConsumer receive path never
+waits on a delay. Each worker also polls the table for due rows, which lets a
+surviving worker send responses scheduled by one that crashed. Rows are
+claimed atomically, so a response is only ever sent once. Saving an admin
+message cancels the conversation's pending responses (Message.save and the
+write-behind batch call ScheduledResponse.cancel_pending).
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.utils import timezone
+
+from .db_executor import db_sync_to_async
+from .models import ScheduledResponse
+
+logger = logging.getLogger(__name__)
+
+# How often (in seconds) each worker looks for due responses it does not know about
+POLL_INTERVAL = 5
+
+
+class ResponseScheduler:
+    """Heap-based scheduler that sends ScheduledResponse rows when they fall due"""
+
+    def __init__(self, poll_interval=POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._heap = []
+        self._known_ids = set()
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._loop = None
+
+    def ensure_started(self):
+        """Start the scheduler task on the running event loop if needed"""
+        loop = asyncio.get_running_loop()
+        if self._task is not None and self._loop is loop and not self._task.done():
+            return
+        self._loop = loop
+        self._heap = []
+        self._known_ids = set()
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    def schedule(self, scheduled_id, due_at):
+        """Add a persisted ScheduledResponse to the heap"""
+        self.ensure_started()
+        self._push(scheduled_id, due_at.timestamp())
+        self._wakeup.set()
+
+    def _push(self, scheduled_id, due_ts):
+        if scheduled_id in self._known_ids:
+            return
+        self._known_ids.add(scheduled_id)
+        heapq.heappush(self._heap, (due_ts, next(self._counter), scheduled_id))
+
+    async def _run(self):
+        next_poll = 0
+        while True:
+            now = time.time()
+            if now >= next_poll:
+                try:
+                    for scheduled_id, due_at in await self._load_pending(self.poll_interval):
+                        self._push(scheduled_id, due_at.timestamp())
+                except Exception:
+                    logger.exception('Failed to load pending scheduled responses')
+                next_poll = now + self.poll_interval
+
+            while self._heap and self._heap[0][0] <= time.time():
+                _, _, scheduled_id = heapq.heappop(self._heap)
+                self._known_ids.discard(scheduled_id)
+                try:
+                    await self._fire(scheduled_id)
+                except Exception:
+                    logger.exception('Failed to send scheduled response %s', scheduled_id)
+
+            wake_at = min(self._heap[0][0], next_poll) if self._heap else next_poll
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(wake_at - time.time(), 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, scheduled_id):
+        from .automated_responses import AutomatedResponseService
+        claimed = await self._claim(scheduled_id)
+        if claimed is None:
+            return
+        chat_session, auto_response, message_obj = claimed
+        await AutomatedResponseService.send_automated_response(
+            get_channel_layer(), chat_session, auto_response, message_obj
+        )
+
+    @staticmethod
+    @db_sync_to_async
+    def _load_pending(horizon_seconds):
+        horizon = timezone.now() + timedelta(seconds=horizon_seconds)
+        return list(
+            ScheduledResponse.objects.filter(status='pending', due_at__lte=horizon)
+            .values_list('id', 'due_at')
+        )
+
+    @staticmethod
+    @db_sync_to_async
+    def _claim(scheduled_id):
+        """
+        Atomically mark a pending response as sent and create its message
+        Returns (chat_session, automated_response, message) or None if it was
+        already sent or cancelled
+        """
+        from .automated_responses import save_automated_message
+
+        with transaction.atomic():
+            claimed = ScheduledResponse.objects.filter(
+                pk=scheduled_id, status='pending'
+            ).update(status='sent')
+            if not claimed:
+                return None
+
+            scheduled = ScheduledResponse.objects.select_related(
+                'chat_session', 'automated_response'
+            ).get(pk=scheduled_id)
+            auto_response = scheduled.automated_response
+            if auto_response is None or not auto_response.is_active:
+                ScheduledResponse.objects.filter(pk=scheduled_id).update(status='cancelled')
+                return None
+
+            message_obj = save_automated_message(
+                scheduled.chat_session, auto_response, scheduled.trigger_message_content
+            )
+        return scheduled.chat_session, auto_response, message_obj
+
+
+response_scheduler = ResponseScheduler()
@@ -0,0 +1,252 @@
+"""
+Full-text search over conversations and message content
+
+Session metadata (name, email, customer id) and message bodies are stored in
+one search index table, kept current by the ChatSession/Message signals:
+
+- PostgreSQL: a tsvector column with a GIN index, ranked with ts_rank
+- SQLite: an FTS5 virtual table over the chat_search_document content table,
+  kept in step by triggers, ranked with bm25
+
+Each document is keyed by (doc_type, object_id), unique in the table, so
+updates and deletes hit an index instead of scanning. Ids are stored in the
+same form as the ChatSession primary key, so results can be joined to the
+session table to filter by status in SQL. Other database vendors fall back to
+icontains filtering on the session columns.
+"""
+import re
+import sqlite3
+import uuid
+
+from django.db import connection
+from django.db.models import Q
+from django.utils.html import escape
+
+from .models import ChatSession
+
+
+SEARCH_INDEX_TABLE = 'chat_search_index'
+# SQLite only: the FTS5 table's external content, which holds the unique (doc_type, object_id) key
+SEARCH_DOCUMENT_TABLE = 'chat_search_document'
+
+# Control characters used to mark matches before HTML escaping
+_MATCH_START = '\x02'
+_MATCH_END = '\x03'
+
+
+def search_backend():
+    """Return 'postgresql', 'sqlite' or None when no full-text index is available"""
+    if connection.vendor in ('postgresql', 'sqlite'):
+        return connection.vendor
+    return None
+
+
+def _document_table(backend):
+    """Table documents are written to"""
+    return SEARCH_DOCUMENT_TABLE if backend == 'sqlite' else SEARCH_INDEX_TABLE
+
+
+def _db_id(object_id):
+    """A UUID in the form the database stores UUID primary keys"""
+    return ChatSession._meta.pk.get_db_prep_value(object_id, connection)
+
+
+def _as_uuid(value):
+    return value if isinstance(value, uuid.UUID) else uuid.UUID(value)
+
+
+def _terms(query):
+    return re.findall(r'[^\W_]+', query.lower())
+
+
+def _format_snippet(snippet):
+    return escape(snippet or '').replace(_MATCH_START, '<mark>').replace(_MATCH_END, '</mark>')
+
+
+def session_document(chat_session):
+    return ' '.join(filter(None, [
+        chat_session.customer_name, chat_session.customer_email, chat_session.customer_id,
+    ]))
+
+
+def index_document(doc_type, object_id, session_id, body):
+    """Add or replace one document in the search index"""
+    backend = search_backend()
+    if backend is None:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {_document_table(backend)} (doc_type, object_id, session_id, body) '
+            f'VALUES (%s, %s, %s, %s) '
+            f'ON CONFLICT (doc_type, object_id) DO UPDATE SET body = EXCLUDED.body',
+            [doc_type, _db_id(object_id), _db_id(session_id), body]
+        )
+
+
+def remove_document(doc_type, object_id):
+    """Remove one document from the search index"""
+    backend = search_backend()
+    if backend is None:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {_document_table(backend)} WHERE doc_type = %s AND object_id = %s',
+            [doc_type, _db_id(object_id)]
+        )
+
+
+def clear_index():
+    """Remove every document from the search index"""
+    backend = search_backend()
+    if backend is None:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {_document_table(backend)}')
+
+
+def index_session(chat_session):
+    index_document('session', chat_session.pk, chat_session.pk, session_document(chat_session))
+
+
+def index_message(message):
+    index_document('message', message.pk, message.chat_session_id, message.content)
+
+
+def index_messages(messages):
+    """Add newly created messages to the search index in one statement (for bulk_create)"""
+    backend = search_backend()
+    if backend is None or not messages:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {_document_table(backend)} (doc_type, object_id, session_id, body) '
+            f'VALUES (%s, %s, %s, %s)',
+            [
+                ('message', _db_id(message.pk), _db_id(message.chat_session_id), message.content)
+                for message in messages
+            ]
+        )
+
+
+def _status_join(alias, status):
+    """JOIN limiting hits to sessions with the given status, and its parameters"""
+    if not status:
+        return '', []
+    return (
+        f'JOIN {ChatSession._meta.db_table} s ON s.id = {alias}.session_id AND s.status = %s',
+        [status],
+    )
+
+
+def _search_postgresql(terms, limit, offset, status=None):
+    tsquery = ' & '.join(f'{term}:*' for term in terms)
+    status_join, status_params = _status_join('idx', status)
+    sql = f'''
+        SELECT session_id, score, snippet, matches FROM (
+            SELECT DISTINCT ON (idx.session_id)
+                idx.session_id,
+                ts_rank(document, query) AS score,
+                ts_headline('english', body, query,
+                            'StartSel={_MATCH_START}, StopSel={_MATCH_END}, MaxWords=20, MinWords=5') AS snippet,
+                COUNT(*) OVER (PARTITION BY idx.session_id) AS matches
+            FROM {SEARCH_INDEX_TABLE} idx
+            {status_join}
+            CROSS JOIN to_tsquery('english', %s) AS query
+            WHERE document @@ query
+            ORDER BY idx.session_id, score DESC
+        ) best
+        ORDER BY score DESC
+        LIMIT %s OFFSET %s
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute(sql, status_params + [tsquery, limit, offset])
+        return cursor.fetchall()
+
+
+def _search_sqlite(terms, limit, offset, status=None):
+    match = ' '.join(f'"{term}"*' for term in terms)
+    status_join, status_params = _status_join('hits', status)
+    # The CTE must be materialized: FTS5 ranking functions cannot run inside an aggregate
+    materialized = 'MATERIALIZED ' if sqlite3.sqlite_version_info >= (3, 35, 0) else ''
+    sql = f'''
+        WITH hits AS {materialized}(
+            SELECT session_id,
+                   bm25({SEARCH_INDEX_TABLE}) AS score,
+                   snippet({SEARCH_INDEX_TABLE}, 0, '{_MATCH_START}', '{_MATCH_END}', '…', 12) AS snippet
+            FROM {SEARCH_INDEX_TABLE}
+            WHERE {SEARCH_INDEX_TABLE} MATCH %s
+        )
+        SELECT hits.session_id, -MIN(score) AS score, snippet, COUNT(*) AS matches
+        FROM hits
+        {status_join}
+        GROUP BY hits.session_id
+        ORDER BY MIN(score)
+        LIMIT %s OFFSET %s
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [match] + status_params + [limit, offset])
+        return cursor.fetchall()
+
+
+def search_conversations(query, limit=50, offset=0, status=None):
+    """
+    Search session metadata and message text, optionally only sessions with the given status
+    Returns a ranked list of dicts with 'session', 'score', 'snippet' and 'matches'
+    """
+    terms = _terms(query)
+    if not terms:
+        return []
+
+    backend = search_backend()
+    if backend is None:
+        sessions = ChatSession.objects.filter(
+            Q(customer_name__icontains=query) |
+            Q(customer_email__icontains=query) |
+            Q(customer_id__icontains=query)
+        )
+        if status:
+            sessions = sessions.filter(status=status)
+        sessions = sessions.order_by('-updated_at')[offset:offset + limit]
+        return [{'session': s, 'score': 0, 'snippet': '', 'matches': 1} for s in sessions]
+
+    search = _search_postgresql if backend == 'postgresql' else _search_sqlite
+    rows = search(terms, limit, offset, status)
+    sessions = ChatSession.objects.in_bulk([_as_uuid(row[0]) for row in rows])
+    results = []
+    for session_id, score, snippet, matches in rows:
+        chat_session = sessions.get(_as_uuid(session_id))
+        if chat_session is None:
+            continue
+        results.append({
+            'session': chat_session,
+            'score': score,
+            'snippet': _format_snippet(snippet),
+            'matches': matches,
+        })
+    return results
+
+
+def search_message_ids(query, limit=1000):
+    """Ids of messages whose text matches query, best match first"""
+    terms = _terms(query)
+    backend = search_backend()
+    if not terms or backend is None:
+        return None
+
+    if backend == 'postgresql':
+        sql = (
+            f"SELECT object_id FROM {SEARCH_INDEX_TABLE} "
+            f"WHERE doc_type = 'message' AND document @@ to_tsquery('english', %s) "
+            f"ORDER BY ts_rank(document, to_tsquery('english', %s)) DESC LIMIT %s"
+        )
+        tsquery = ' & '.join(f'{term}:*' for term in terms)
+        params = [tsquery, tsquery, limit]
+    else:
+        sql = (
+            f"SELECT object_id FROM {SEARCH_INDEX_TABLE} "
+            f"WHERE {SEARCH_INDEX_TABLE} MATCH %s AND doc_type = 'message' ORDER BY rank LIMIT %s"
+        )
+        params = [' '.join(f'"{term}"*' for term in terms), limit]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [_as_uuid(row[0]) for row in cursor.fetchall()]
@@ -5,7 +5,8 @@ from .models import ChatSession, Message, ChatWidget, AutomatedResponse
 class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
-        fields = ['id', 'content', 'sender_type', 'sender_name', 'attachment', 'is_read', 'timestamp']
+        fields = ['id', 'content', 'sender_type', 'sender_name', 'attachment', 'attachment_thumbnail',
+                  'is_read', 'timestamp']
 
 
 class ChatSessionSerializer(serializers.ModelSerializer):
@@ -18,12 +19,19 @@ class ChatSessionSerializer(serializers.ModelSerializer):
                  'created_at', 'updated_at', 'unread_messages_count', 'last_message']
     
     def get_last_message(self, obj):
-        last_message = obj.messages.last()
-        if last_message:
-            return MessageSerializer(last_message).data
+        if obj.last_message_id:
+            return MessageSerializer(obj.last_message).data
         return None
 
 
+class ChatSessionSummarySerializer(serializers.ModelSerializer):
+    """Compact row for the live conversation list"""
+    class Meta:
+        model = ChatSession
+        fields = ['id', 'customer_id', 'customer_name', 'customer_email', 'status',
+                 'unread_count', 'last_message_preview', 'updated_at']
+
+
 class ChatWidgetSerializer(serializers.ModelSerializer):
     class Meta:
         model = ChatWidget
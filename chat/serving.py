@@ -0,0 +1,198 @@
+"""
+Attachment serving
+
+Attachments under MEDIA_URL/chat_attachments/ are served by serve_attachment
+in every environment, not only with DEBUG. Responses carry an ETag and
+Last-Modified (answering If-None-Match / If-Modified-Since with 304) and
+honour single byte ranges (Range / If-Range), so interrupted downloads resume
+and PDFs open page by page.
+
+Content-addressed files (chat_attachments/ab/cd/<sha256>.ext and their
+thumbnails) never change, so they are cached by browsers and CDNs for a year
+as immutable; their ETag is the content hash. Older, flat-named attachments get
+CHAT_ATTACHMENT_MAX_AGE.
+
+Only files under MEDIA_ROOT/chat_attachments/ are served. The Content-Type
+comes from the stored extension, which uploads.py derives from the validated
+content type; anything else is sent as application/octet-stream. Responses
+carry X-Content-Type-Options: nosniff, and everything but images is sent as
+a download (Content-Disposition: attachment), so an upload can never be
+rendered as a page on the app's origin.
+
+With CHAT_ATTACHMENT_SENDFILE set to 'x-accel-redirect' (nginx) or
+'x-sendfile' (Apache, lighttpd), Django only checks the request and the
+front-end server sends the file. Otherwise the file is streamed with
+FileResponse, which WSGI servers hand to sendfile().
+"""
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from django.views.decorators.http import require_http_methods
+
+from .uploads import CONTENT_TYPE_EXTENSIONS
+
+
+# Stored once per content, so the bytes behind the URL never change
+CONTENT_ADDRESSED_PATH = re.compile(r'(?:^|/)([0-9a-f]{2})/([0-9a-f]{2})/(\1\2[0-9a-f]{60})\.\w+$')
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+ATTACHMENT_DIR = 'chat_attachments'
+
+# Served types by stored extension
+SERVED_CONTENT_TYPES = {extension: content_type for content_type, extension in CONTENT_TYPE_EXTENSIONS.items()}
+SERVED_CONTENT_TYPES['.jpeg'] = 'image/jpeg'  # Older, flat-named uploads
+
+
+def _validators(path, stat):
+    """ETag and Last-Modified for a file"""
+    match = CONTENT_ADDRESSED_PATH.search(path)
+    if match:
+        etag = quote_etag(match.group(3))
+    else:
+        etag = quote_etag(f'{stat.st_size:x}-{stat.st_mtime_ns:x}')
+    return etag, int(stat.st_mtime)
+
+
+def _not_modified(request, etag, last_modified):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return if_none_match.strip() == '*' or etag in parse_etags(if_none_match)
+    if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    return if_modified_since is not None and last_modified <= if_modified_since
+
+
+def parse_range(header, size):
+    """
+    (start, end) of a single-range Range header, inclusive
+    Returns None to send the whole file (no or unsupported header) and
+    raises ValueError if the range cannot be satisfied
+    """
+    match = _RANGE.match(header.replace(' ', '')) if header else None
+    if match is None:
+        # Missing, malformed or multiple ranges: the whole file is a valid answer
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last or int(last) == 0:
+            raise ValueError(header)
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, end
+
+
+class RangeFile:
+    """Read-only view of length bytes of an open file starting at offset"""
+
+    def __init__(self, file, offset, length):
+        file.seek(offset)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def _attachment_path(path):
+    """Absolute path of an attachment, or None if path leaves MEDIA_ROOT/chat_attachments/"""
+    root = os.path.join(os.path.realpath(settings.MEDIA_ROOT), ATTACHMENT_DIR)
+    full_path = os.path.realpath(os.path.join(os.path.realpath(settings.MEDIA_ROOT), path))
+    return full_path if full_path.startswith(root + os.sep) else None
+
+
+def _content_type(path):
+    return SERVED_CONTENT_TYPES.get(os.path.splitext(path)[1].lower(), 'application/octet-stream')
+
+
+def _headers(response, path, etag, last_modified):
+    immutable = CONTENT_ADDRESSED_PATH.search(path) is not None
+    content_type = _content_type(path)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    response['X-Content-Type-Options'] = 'nosniff'
+    if not content_type.startswith('image/'):
+        response['Content-Disposition'] = 'attachment'
+    if immutable:
+        response['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    else:
+        response['Cache-Control'] = f'public, max-age={settings.CHAT_ATTACHMENT_MAX_AGE}'
+    return response
+
+
+def _sendfile_response(path, full_path, content_type):
+    response = HttpResponse(content_type=content_type)
+    if settings.CHAT_ATTACHMENT_SENDFILE == 'x-accel-redirect':
+        # The front-end server answers Range requests itself
+        response['X-Accel-Redirect'] = quote(settings.CHAT_ATTACHMENT_ACCEL_PREFIX.rstrip('/') + '/' + path)
+    else:
+        response['X-Sendfile'] = full_path
+    return response
+
+
+@require_http_methods(['GET', 'HEAD'])
+def serve_attachment(request, path):
+    """Serve a stored attachment with validators, range support and cache headers"""
+    full_path = _attachment_path(path)
+    try:
+        if full_path is None:
+            raise FileNotFoundError(path)
+        stat = os.stat(full_path)
+    except OSError:
+        raise Http404('Attachment not found')
+    if not os.path.isfile(full_path):
+        raise Http404('Attachment not found')
+
+    etag, last_modified = _validators(path, stat)
+    if _not_modified(request, etag, last_modified):
+        return _headers(HttpResponseNotModified(), path, etag, last_modified)
+
+    content_type = _content_type(path)
+    if settings.CHAT_ATTACHMENT_SENDFILE:
+        return _headers(_sendfile_response(path, full_path, content_type), path, etag, last_modified)
+
+    size = stat.st_size
+    # A Range only applies if the client's copy is still the current one
+    if_range = request.headers.get('If-Range')
+    range_header = request.headers.get('Range')
+    if if_range and if_range != etag and parse_http_date_safe(if_range) != last_modified:
+        range_header = None
+    try:
+        byte_range = parse_range(range_header, size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return _headers(response, path, etag, last_modified)
+
+    if request.method == 'HEAD':
+        response = HttpResponse(content_type=content_type)
+        response['Content-Length'] = size
+        return _headers(response, path, etag, last_modified)
+
+    if byte_range is None:
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+    else:
+        start, end = byte_range
+        response = FileResponse(
+            RangeFile(open(full_path, 'rb'), start, end - start + 1),
+            status=206, content_type=content_type
+        )
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return _headers(response, path, etag, last_modified)
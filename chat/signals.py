@@ -0,0 +1,90 @@
+"""
+Signal handlers for the chat app
+"""
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from .business_hours import invalidate_business_calendar
+from .models import (
+    AttachmentBlob, AutomatedResponse, BusinessCalendar, BusinessHours, ChatSession, ChatWidget, Holiday, Message,
+)
+from .rule_engine import invalidate_rule_engine
+from .search import index_message, index_session, remove_document
+from .thumbnails import thumbnail_new_messages
+from .widget_config import invalidate_widget_config
+
+
+SESSION_INDEXED_FIELDS = {'customer_name', 'customer_email', 'customer_id'}
+
+
+@receiver([post_save, post_delete], sender=AutomatedResponse)
+def automated_response_changed(sender, **kwargs):
+    """Rebuild the compiled rule engine in every worker"""
+    invalidate_rule_engine()
+
+
+@receiver([post_save, post_delete], sender=BusinessCalendar)
+@receiver([post_save, post_delete], sender=BusinessHours)
+@receiver([post_save, post_delete], sender=Holiday)
+def business_calendar_changed(sender, **kwargs):
+    """Recompile the business calendar in every worker"""
+    invalidate_business_calendar()
+
+
+@receiver([post_save, post_delete], sender=ChatWidget)
+def widget_config_changed(sender, **kwargs):
+    """Reload the public widget configuration in every worker"""
+    invalidate_widget_config()
+
+
+@receiver(post_save, sender=ChatSession)
+def index_chat_session(sender, instance, update_fields=None, **kwargs):
+    """Keep the session's name, email and customer id searchable"""
+    if update_fields is not None and not SESSION_INDEXED_FIELDS.intersection(update_fields):
+        return
+    index_session(instance)
+
+
+@receiver(post_save, sender=Message)
+def index_chat_message(sender, instance, update_fields=None, **kwargs):
+    """Add new or edited message text to the search index"""
+    if update_fields is not None and 'content' not in update_fields:
+        return
+    index_message(instance)
+
+
+@receiver(post_save, sender=Message)
+def thumbnail_chat_message(sender, instance, created, **kwargs):
+    """Give a new image message a preview in the background"""
+    if created:
+        thumbnail_new_messages([instance])
+
+
+@receiver(post_delete, sender=ChatSession)
+@receiver(post_delete, sender=Message)
+def remove_from_search_index(sender, instance, **kwargs):
+    remove_document('session' if sender is ChatSession else 'message', instance.pk)
+
+
+@receiver(post_delete, sender=Message)
+def release_attachment(sender, instance, **kwargs):
+    """Drop the message's reference to its stored attachment; unused blobs are purged later"""
+    if instance.attachment:
+        AttachmentBlob.remove_reference(instance.attachment.name)
+
+
+@receiver(post_delete, sender=Message)
+def release_message_counters(sender, instance, **kwargs):
+    """Take a deleted message off its session's denormalized counters and history ETag"""
+    is_customer = instance.sender_type == 'customer'
+    ChatSession.objects.filter(pk=instance.chat_session_id).update(
+        unread_count=Greatest(F('unread_count') - int(is_customer and not instance.is_read), 0),
+        customer_message_count=Greatest(F('customer_message_count') - int(is_customer), 0),
+        updated_at=timezone.now(),
+    )
+    # Deleting the newest message cleared last_message (SET_NULL); fall back to the one before it
+    ChatSession.objects.filter(pk=instance.chat_session_id, last_message__isnull=True).update(
+        **ChatSession.newest_message_fields(instance.chat_session_id)
+    )
@@ -0,0 +1,92 @@
+"""
+Dashboard statistics snapshot
+
+The counters shown on the dashboard home page are computed with a single
+conditional-aggregate query and stored in the shared cache, one key per
+counter so workers can adjust them atomically with cache.incr. Consumers and
+views apply deltas as messages arrive and conversations change status, and
+the snapshot is fully recomputed every STATS_REFRESH_INTERVAL seconds to roll
+the "this week" window and correct any drift.
+
+Message writes send only their delta to the admin summary topic (the
+dashboard adds it to the counters it shows); status changes send the snapshot.
+"""
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from .models import ChatSession
+
+
+STAT_NAMES = ['total_sessions', 'open_sessions', 'closed_sessions', 'unread_messages', 'recent_sessions']
+
+STATS_KEY_PREFIX = 'chat:stats:'
+STATS_FRESH_KEY = 'chat:stats:fresh'
+
+# Seconds between full recomputes of the snapshot
+STATS_REFRESH_INTERVAL = 300
+
+
+def _key(name):
+    return f'{STATS_KEY_PREFIX}{name}'
+
+
+def compute_stats():
+    """Compute every dashboard counter in one query"""
+    week_ago = timezone.now() - timedelta(days=7)
+    stats = ChatSession.objects.aggregate(
+        total_sessions=Count('id'),
+        open_sessions=Count('id', filter=Q(status='open')),
+        closed_sessions=Count('id', filter=Q(status='closed')),
+        unread_messages=Sum('unread_count'),
+        recent_sessions=Count('id', filter=Q(created_at__gte=week_ago)),
+    )
+    stats['unread_messages'] = stats['unread_messages'] or 0
+    return stats
+
+
+def get_stats():
+    """Return the cached snapshot, recomputing it when it is missing or stale"""
+    keys = [_key(name) for name in STAT_NAMES]
+    cached = cache.get_many([STATS_FRESH_KEY] + keys)
+    if STATS_FRESH_KEY in cached and all(key in cached for key in keys):
+        return {name: max(cached[_key(name)], 0) for name in STAT_NAMES}
+
+    stats = compute_stats()
+    cache.set_many({_key(name): value for name, value in stats.items()}, timeout=None)
+    cache.set(STATS_FRESH_KEY, True, timeout=STATS_REFRESH_INTERVAL)
+    return stats
+
+
+def apply_stats_delta(**deltas):
+    """Adjust cached counters in place, e.g. apply_stats_delta(unread_messages=1)"""
+    for name, delta in deltas.items():
+        if not delta:
+            continue
+        try:
+            cache.incr(_key(name), delta)
+        except ValueError:
+            # No snapshot cached yet; the next get_stats() computes it
+            pass
+
+
+def add_stats(stats, delta):
+    """Counters (a snapshot or a delta) with delta added"""
+    combined = dict(stats)
+    for name, value in delta.items():
+        combined[name] = combined.get(name, 0) + value
+    return combined
+
+
+def status_change_delta(old_status, new_status):
+    """Counter deltas for a conversation moving between open and closed"""
+    if old_status == new_status:
+        return {}
+    return {f'{old_status}_sessions': -1, f'{new_status}_sessions': 1}
+
+
+def new_session_delta():
+    """Counter deltas for a newly created (open) conversation"""
+    return {'total_sessions': 1, 'open_sessions': 1, 'recent_sessions': 1}
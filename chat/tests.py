@@ -1,3 +1,1467 @@
-from django.test import TestCase
+import asyncio
+import contextvars
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time as time_module
+import uuid
+import zoneinfo
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta, timezone as dt_timezone
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+from PIL import Image
+import psycopg2
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+from django.db.models import F
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from .benchmark import _application, run_benchmark
+from .business_hours import CompiledCalendar, get_business_calendar, invalidate_business_calendar
+from .consumers import ChatConsumer
+from .db_executor import db_executor_metrics, db_sync_to_async
+from .db_pool.pool import ConnectionPool, PoolTimeout
+from .db_router import PinState, ReplicaRouter, bind_pin_identity, read_from_replica
+from . import rule_engine
+from .models import (
+    AttachmentBlob, AutomatedResponse, BusinessCalendar, BusinessHours, ChatSession, ChatWidget, ChunkedUpload, Message,
+    ScheduledResponse,
+)
+from .pagination import keyset_after, keyset_before
+from .presence import PRESENCE_KEY_PREFIX, PRESENCE_ROSTER_KEY, PresenceRegistry
+from .rule_engine import RULES_VERSION_CACHE_KEY, KeywordAutomaton, get_rule_engine_sync
+from .scheduler import ResponseScheduler
+from .search import search_backend, search_conversations, search_message_ids
+from .serializers import MessageSerializer
+from .stats import STATS_KEY_PREFIX, STATS_REFRESH_INTERVAL, apply_stats_delta, get_stats
+from .thumbnails import create_thumbnail, render_thumbnail
+from . import uploads as uploads_module
+from .uploads import (
+    MAX_ATTACHMENT_SIZE, UploadError, blob_name, purge_stale_uploads, purge_unused_attachments, store_attachment,
+    write_chunk,
+)
+from .widget_config import invalidate_widget_config
+from .wire import FIELD_CODES, TYPE_CODES, expand, shorten
+from .write_behind import PendingMessage, write_message_batch
+
+
+class RuleEngineTests(TestCase):
+    """Automated responses are matched by the cached Aho-Corasick engine"""
+
+    def setUp(self):
+        cache.clear()
+        rule_engine.invalidate_rule_engine()
+
+    def test_automaton_matches_whole_words(self):
+        automaton = KeywordAutomaton()
+        for pattern in ['hi', 'refund', 'refund policy', 'policy', 'c++']:
+            automaton.add(pattern, pattern)
+        
+        self.assertEqual(automaton.search('this is a test'), set())
+        self.assertEqual(automaton.search('Hi, there'), {'hi'})
+        self.assertEqual(automaton.search('Your   REFUND\tpolicy?'), {'refund', 'refund policy', 'policy'})
+        self.assertEqual(automaton.search('refunds and policyholders'), set())
+        self.assertEqual(automaton.search('do you use c++?'), {'c++'})
+
+    def test_overlapping_keywords(self):
+        automaton = KeywordAutomaton()
+        for pattern in ['he', 'she', 'his', 'hers', 'she sells']:
+            automaton.add(pattern, pattern)
+        
+        self.assertEqual(automaton.search('ushers'), set())
+        self.assertEqual(automaton.search('she sells hers, he said'), {'she', 'she sells', 'hers', 'he'})
+
+    def test_engine_orders_matches_by_priority(self):
+        low = AutomatedResponse.objects.create(
+            name='Billing', trigger_type='keyword', keywords='invoice, bill', response_message='a', priority=1,
+        )
+        high = AutomatedResponse.objects.create(
+            name='Billing urgent', trigger_type='keyword', keywords='invoice', response_message='b', priority=5,
+        )
+        AutomatedResponse.objects.create(
+            name='Off', trigger_type='keyword', keywords='invoice', response_message='c', is_active=False,
+        )
+        
+        responses, is_greeting = get_rule_engine_sync().match('Hello, where is my invoice?')
+        self.assertEqual(responses, [high, low])
+        self.assertTrue(is_greeting)
+
+    def test_save_and_delete_invalidate_the_engine(self):
+        response = AutomatedResponse.objects.create(
+            name='Shipping', trigger_type='keyword', keywords='shipping', response_message='a',
+        )
+        version = cache.get(RULES_VERSION_CACHE_KEY)
+        engine = get_rule_engine_sync()
+        with self.assertNumQueries(0):
+            self.assertIs(get_rule_engine_sync(), engine)
+            self.assertTrue(response.matches_message('Shipping times?'))
+            self.assertFalse(response.matches_message('Tracking?'))
+        
+        response.keywords = 'shipping, tracking'
+        response.save()
+        self.assertEqual(cache.get(RULES_VERSION_CACHE_KEY), version + 1)
+        self.assertTrue(response.matches_message('Tracking?'))
+        self.assertIsNot(get_rule_engine_sync(), engine)
+        
+        response.delete()
+        self.assertEqual(cache.get(RULES_VERSION_CACHE_KEY), version + 2)
+        self.assertEqual(get_rule_engine_sync().match('shipping')[0], [])
+
+    def test_other_workers_reload_on_version_change(self):
+        engine = get_rule_engine_sync()
+        # Another worker saved a rule: only the shared stamp changes here
+        cache.incr(RULES_VERSION_CACHE_KEY)
+        with self.assertNumQueries(0):
+            self.assertIs(get_rule_engine_sync(), engine)
+        with mock.patch.object(rule_engine._rules, '_checked_at', 0.0):
+            with self.assertNumQueries(1):
+                self.assertIsNot(get_rule_engine_sync(), engine)
+
+
+class SessionCounterTests(TestCase):
+    """The denormalized ChatSession counters follow message writes"""
+
+    def setUp(self):
+        self.session = ChatSession.objects.create(customer_id='counter_customer')
+
+    def add(self, sender_type='customer', content='hello', **kwargs):
+        return Message.objects.create(chat_session=self.session, content=content, sender_type=sender_type, **kwargs)
+
+    def counters(self):
+        self.session.refresh_from_db()
+        return self.session.unread_count, self.session.customer_message_count
+
+    def test_create_updates_counters_and_last_message(self):
+        self.add()
+        self.add(is_read=True)
+        reply = self.add(sender_type='admin')
+        self.assertEqual(self.counters(), (1, 2))
+        self.assertEqual(self.session.last_message, reply)
+        self.assertEqual(self.session.last_activity_at, reply.timestamp)
+
+    def test_create_updates_the_session_handle(self):
+        # Stands in for messages counted by another worker since the handle was loaded
+        ChatSession.objects.filter(pk=self.session.pk).update(unread_count=3, status='closed')
+        with capture_all_queries() as queries:
+            message = self.add()
+        if connection.features.can_return_columns_from_insert:
+            self.assertFalse([sql for sql in queries if sql.startswith('SELECT')], queries)
+        self.assertEqual((self.session.unread_count, self.session.customer_message_count), (4, 1))
+        self.assertEqual(self.session.status, 'closed')
+        self.assertEqual(self.session.last_message, message)
+        self.assertEqual(self.session.last_message_preview, 'hello')
+        self.assertEqual(self.counters(), (4, 1))
+
+    def test_mark_read_subtracts_the_messages_it_marked(self):
+        self.add()
+        self.add()
+        # Stands in for a customer message counted while the messages were being marked
+        ChatSession.objects.filter(pk=self.session.pk).update(unread_count=F('unread_count') + 1)
+        self.assertEqual(self.session.mark_customer_messages_read(), 2)
+        self.assertEqual(self.session.unread_count, 1)
+        self.assertEqual(self.session.mark_customer_messages_read(), 0)
+        self.assertEqual(self.counters(), (1, 2))
+
+    def test_delete_releases_counters(self):
+        unread = self.add()
+        read = self.add(is_read=True)
+        self.add(sender_type='admin').delete()
+        self.assertEqual(self.counters(), (1, 2))
+        read.delete()
+        self.assertEqual(self.counters(), (1, 1))
+        unread.delete()
+        self.assertEqual(self.counters(), (0, 0))
+
+    def test_delete_newest_message_falls_back_to_previous(self):
+        first = self.add(content='first')
+        self.add(content='second').delete()
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.last_message, first)
+        self.assertEqual(self.session.last_message_preview, first.preview)
+        self.assertEqual(self.session.last_activity_at, first.timestamp)
+        first.delete()
+        self.session.refresh_from_db()
+        self.assertIsNone(self.session.last_message)
+        self.assertEqual(self.session.last_message_preview, '')
+        self.assertIsNone(self.session.last_activity_at)
+
+    def test_repair_chat_counters(self):
+        self.add()
+        self.add()
+        ChatSession.objects.filter(pk=self.session.pk).update(unread_count=7, customer_message_count=0)
+        out = io.StringIO()
+        call_command('repair_chat_counters', stdout=out)
+        self.assertIn('repaired 1', out.getvalue())
+        self.assertEqual(self.counters(), (2, 2))
+
+
+class ResponseSchedulerTests(TransactionTestCase):
+    """Delayed auto-replies are sent once and dropped when an admin answers first"""
+
+    def setUp(self):
+        self.session = ChatSession.objects.create(customer_id='scheduled_customer')
+        self.rule = AutomatedResponse.objects.create(
+            name='Hours', trigger_type='keyword', keywords='hours', response_message='We open at 9', delay_seconds=30,
+        )
+
+    def schedule(self, due_in=30):
+        return ScheduledResponse.objects.create(
+            chat_session=self.session, automated_response=self.rule, trigger_message_content='hours?',
+            due_at=timezone.now() + timedelta(seconds=due_in),
+        )
+
+    async def test_claims_once(self):
+        scheduled = await database_sync_to_async(self.schedule)()
+        first, second = await asyncio.gather(
+            ResponseScheduler._claim(scheduled.pk), ResponseScheduler._claim(scheduled.pk)
+        )
+        self.assertEqual([claim is None for claim in (first, second)].count(True), 1)
+        self.assertEqual(await Message.objects.filter(sender_type='system').acount(), 1)
+
+    def test_admin_reply_cancels_pending(self):
+        scheduled = self.schedule()
+        Message.objects.create(chat_session=self.session, content='Hi, we open at 9', sender_type='admin')
+        scheduled.refresh_from_db()
+        self.assertEqual(scheduled.status, 'cancelled')
+        self.assertIsNone(async_to_sync(ResponseScheduler._claim)(scheduled.pk))
+
+    def test_http_and_write_behind_admin_replies_cancel_pending(self):
+        scheduled = self.schedule()
+        response = self.client.post('/chat/api/chat/message/', {
+            'customer_id': 'scheduled_customer', 'message': 'On it', 'sender_type': 'admin',
+        })
+        self.assertEqual(response.status_code, 201)
+        scheduled.refresh_from_db()
+        self.assertEqual(scheduled.status, 'cancelled')
+        
+        scheduled = self.schedule()
+        write_message_batch([PendingMessage('scheduled_customer', 'Done', 'admin', 'Agent', None, True)])
+        scheduled.refresh_from_db()
+        self.assertEqual(scheduled.status, 'cancelled')
+
+    async def test_restarted_worker_sends_due_responses(self):
+        # Scheduled by a worker that went away before it fell due
+        scheduled = await database_sync_to_async(self.schedule)(due_in=-1)
+        scheduler = ResponseScheduler(poll_interval=0.05)
+        fired = asyncio.Event()
+        fire = scheduler._fire
+        
+        async def fire_and_signal(scheduled_id):
+            await fire(scheduled_id)
+            fired.set()
+        
+        # Wait for the scheduler rather than polling the row, which the in-memory
+        # SQLite test database would lock against the scheduler's write
+        with mock.patch.object(scheduler, '_fire', fire_and_signal):
+            scheduler.ensure_started()
+            try:
+                await asyncio.wait_for(fired.wait(), timeout=5)
+            finally:
+                scheduler._task.cancel()
+        await scheduled.arefresh_from_db()
+        self.assertEqual(scheduled.status, 'sent')
+        message = await Message.objects.aget(chat_session=self.session, sender_type='system')
+        self.assertEqual(message.content, 'We open at 9')
+
+
+class ChatHistoryTests(TestCase):
+    """Widget history: keyset pages, delta sync and conditional requests"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.session = ChatSession.objects.create(customer_id='history_customer')
+        cls.messages = [
+            Message.objects.create(chat_session=cls.session, content=f'message {i}', sender_type='customer')
+            for i in range(5)
+        ]
+
+    def history(self, **params):
+        return self.client.get('/chat/api/chat/history_customer/history/', params)
+
+    def contents(self, response):
+        return [message['content'] for message in response.json()['results']]
+
+    def test_before_pages_back_to_the_start(self):
+        response = self.history(limit=2)
+        self.assertEqual(self.contents(response), ['message 3', 'message 4'])
+        self.assertTrue(response.json()['has_more'])
+        
+        response = self.history(limit=2, before=response.json()['previous'])
+        self.assertEqual(self.contents(response), ['message 1', 'message 2'])
+        
+        response = self.history(limit=2, before=response.json()['previous'])
+        self.assertEqual(self.contents(response), ['message 0'])
+        self.assertFalse(response.json()['has_more'])
+        self.assertIsNone(response.json()['previous'])
+
+    def test_since_returns_only_newer_messages(self):
+        response = self.history(since=str(self.messages[2].id))
+        self.assertEqual(self.contents(response), ['message 3', 'message 4'])
+        self.assertEqual(self.contents(self.history(since=str(self.messages[4].id))), [])
+        self.assertEqual(self.history(since=str(uuid.uuid4())).status_code, 400)
+        self.assertEqual(self.history(before='not-a-cursor').status_code, 400)
+
+    def test_unchanged_history_is_not_modified(self):
+        etag = self.history()['ETag']
+        response = self.client.get(
+            '/chat/api/chat/history_customer/history/', HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 304)
+        # A different page is a different representation
+        self.assertNotEqual(self.history(limit=2)['ETag'], etag)
+
+    def test_edits_and_deletes_change_the_etag(self):
+        etags = {self.history()['ETag']}
+        
+        message = self.messages[1]
+        message.content = 'edited'
+        message.save(update_fields=['content'])
+        etags.add(self.history()['ETag'])
+        
+        message.attachment_thumbnail = 'chat_attachments/thumbnails/x.webp'
+        message.save(update_fields=['attachment_thumbnail'])
+        etags.add(self.history()['ETag'])
+        
+        self.messages[2].delete()
+        etags.add(self.history()['ETag'])
+        self.assertEqual(len(etags), 4)
+        self.assertEqual(self.contents(self.history()), ['message 0', 'edited', 'message 3', 'message 4'])
+
+
+class AdminSessionListTests(TestCase):
+    """The admin session list costs one query per page however many sessions it shows"""
+
+    # Session and user lookups for the logged-in agent, then the page itself
+    QUERIES_PER_PAGE = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.agent = User.objects.create_user('list_agent', is_staff=True)
+        cls.other = User.objects.create_user('other_agent', is_staff=True)
+        for i in range(6):
+            session = ChatSession.objects.create(
+                customer_id=f'list_customer_{i}',
+                status='closed' if i % 3 == 0 else 'open',
+                admin_user=[cls.agent, cls.other, None][i % 3],
+            )
+            Message.objects.create(chat_session=session, content=f'message {i}', sender_type='customer')
+
+    def setUp(self):
+        self.client.force_login(self.agent)
+
+    def sessions(self, **params):
+        with self.assertNumQueries(self.QUERIES_PER_PAGE):
+            response = self.client.get('/chat/api/admin/sessions/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def customers(self, page):
+        return [row['customer_id'] for row in page['results']]
+
+    def test_pages_and_filters(self):
+        first = self.sessions(limit=4)
+        self.assertEqual(self.customers(first), [f'list_customer_{i}' for i in (5, 4, 3, 2)])
+        self.assertEqual(first['results'][0]['last_message']['content'], 'message 5')
+        
+        second = self.sessions(limit=4, cursor=first['next'])
+        self.assertEqual(self.customers(second), ['list_customer_1', 'list_customer_0'])
+        self.assertFalse(second['has_more'])
+        
+        self.assertEqual(self.customers(self.sessions(status='closed')), ['list_customer_3', 'list_customer_0'])
+        self.assertEqual(self.customers(self.sessions(assignee='me')), ['list_customer_3', 'list_customer_0'])
+        self.assertEqual(self.customers(self.sessions(assignee='none')), ['list_customer_5', 'list_customer_2'])
+        open_page = self.sessions(status='open', assignee=str(self.other.id), limit=1)
+        self.assertEqual(self.customers(open_page), ['list_customer_4'])
+        self.assertEqual(
+            self.customers(self.sessions(status='open', assignee=str(self.other.id), limit=1, cursor=open_page['next'])),
+            ['list_customer_1'],
+        )
+
+
+class DashboardStatsTests(TestCase):
+    """The dashboard counters come from one cached aggregate kept current by deltas"""
+
+    def setUp(self):
+        cache.clear()
+        ChatSession.objects.create(customer_id='stats_open')
+        ChatSession.objects.create(customer_id='stats_closed', status='closed')
+        Message.objects.create(
+            chat_session=ChatSession.objects.get(customer_id='stats_open'), content='hi', sender_type='customer',
+        )
+
+    def test_snapshot_is_one_query_and_cached(self):
+        with self.assertNumQueries(1):
+            stats = get_stats()
+        self.assertEqual(stats, {
+            'total_sessions': 2, 'open_sessions': 1, 'closed_sessions': 1, 'unread_messages': 1, 'recent_sessions': 2,
+        })
+        with self.assertNumQueries(0):
+            self.assertEqual(get_stats(), stats)
+
+    def test_deltas_adjust_the_cached_counters(self):
+        get_stats()
+        apply_stats_delta(unread_messages=2, open_sessions=-1, closed_sessions=1)
+        with self.assertNumQueries(0):
+            stats = get_stats()
+        self.assertEqual((stats['unread_messages'], stats['open_sessions'], stats['closed_sessions']), (3, 0, 2))
+
+    def test_missing_counters_are_recomputed(self):
+        # A delta without a snapshot is dropped rather than starting a counter at the delta
+        apply_stats_delta(unread_messages=5)
+        self.assertIsNone(cache.get(STATS_KEY_PREFIX + 'unread_messages'))
+        self.assertEqual(get_stats()['unread_messages'], 1)
+        
+        cache.delete(STATS_KEY_PREFIX + 'open_sessions')
+        with self.assertNumQueries(1):
+            self.assertEqual(get_stats()['open_sessions'], 1)
+
+    def test_recomputed_after_refresh_interval(self):
+        get_stats()
+        apply_stats_delta(unread_messages=10)  # drift, e.g. a lost update
+        self.assertEqual(get_stats()['unread_messages'], 11)
+        
+        later = time_module.time() + STATS_REFRESH_INTERVAL + 1
+        with mock.patch('django.core.cache.backends.locmem.time') as locmem_time:
+            locmem_time.time.return_value = later
+            with self.assertNumQueries(1):
+                self.assertEqual(get_stats()['unread_messages'], 1)
+
+
+class ConversationSearchTests(TestCase):
+    """The full-text index ranks, highlights and follows message and session changes"""
+
+    def setUp(self):
+        if search_backend() is None:
+            self.skipTest(f'No full-text index on {connection.vendor}')
+        self.refunds = ChatSession.objects.create(customer_id='search_refunds', customer_name='Ada Lovelace')
+        self.other = ChatSession.objects.create(customer_id='search_other', status='closed')
+        Message.objects.create(chat_session=self.refunds, content='Refund please, the refund is late', sender_type='customer')
+        Message.objects.create(
+            chat_session=self.other, content='<b>Shipping</b> was slow and I may ask for a refund one day',
+            sender_type='customer',
+        )
+
+    def customers(self, query, **kwargs):
+        return [result['session'].customer_id for result in search_conversations(query, **kwargs)]
+
+    def test_ranking_and_snippets(self):
+        results = search_conversations('refund')
+        self.assertEqual([result['session'] for result in results], [self.refunds, self.other])
+        self.assertGreater(results[0]['score'], results[1]['score'])
+        self.assertIn('<mark>Refund</mark>', results[0]['snippet'])
+        
+        snippet = search_conversations('shipping')[0]['snippet']
+        self.assertIn('&lt;b&gt;<mark>Shipping</mark>&lt;/b&gt;', snippet)
+        # Prefix terms, all of which must appear; session details are searchable too
+        self.assertEqual(self.customers('ship slow'), ['search_other'])
+        self.assertEqual(self.customers('lovel'), ['search_refunds'])
+        self.assertEqual(self.customers('please lovelace'), [])
+
+    def test_status_filter_and_paging_run_in_the_query(self):
+        self.assertEqual(self.customers('refund', status='closed'), ['search_other'])
+        self.assertEqual(self.customers('refund', status='open'), ['search_refunds'])
+        self.assertEqual(self.customers('refund', limit=1), ['search_refunds'])
+        self.assertEqual(self.customers('refund', limit=1, offset=1), ['search_other'])
+        
+        agent = User.objects.create_user('search_agent', is_staff=True)
+        self.client.force_login(agent)
+        response = self.client.get('/dashboard/conversations/', {'search': 'refund', 'status': 'closed'})
+        self.assertEqual([c.customer_id for c in response.context['conversations']], ['search_other'])
+        self.assertFalse(response.context['has_next'])
+        with mock.patch('dashboard.views.CONVERSATIONS_PER_PAGE', 1):
+            response = self.client.get('/dashboard/conversations/', {'search': 'refund', 'page': 2})
+        self.assertEqual([c.customer_id for c in response.context['conversations']], ['search_other'])
+        self.assertTrue(response.context['has_previous'])
+
+    def test_signals_keep_the_index_current(self):
+        message = Message.objects.create(chat_session=self.other, content='Where is my parcel', sender_type='customer')
+        self.assertEqual(self.customers('parcel'), ['search_other'])
+        
+        message.content = 'Where is my package'
+        message.save()
+        self.assertEqual(self.customers('parcel'), [])
+        self.assertEqual(self.customers('package'), ['search_other'])
+        
+        message.delete()
+        self.assertEqual(self.customers('package'), [])
+        
+        self.other.customer_name = 'Grace Hopper'
+        self.other.save()
+        self.assertEqual(self.customers('hopper'), ['search_other'])
+        
+        self.other.delete()
+        self.assertEqual(self.customers('hopper'), [])
+        self.assertEqual(self.customers('shipping'), [])
+
+    def test_ids_sharing_leading_bits_do_not_collide(self):
+        # The old index key kept only the top 63 bits of each UUID
+        prefix = uuid.uuid4().int >> 65 << 65
+        for low_bits, content in [(1, 'alpha'), (2, 'bravo')]:
+            Message.objects.create(
+                id=uuid.UUID(int=prefix | low_bits), chat_session=self.refunds, content=content, sender_type='customer',
+            )
+        self.assertEqual(self.customers('alpha'), ['search_refunds'])
+        self.assertEqual(self.customers('bravo'), ['search_refunds'])
+        self.assertEqual(len(search_message_ids('alpha')), 1)
+
+
+@contextmanager
+def capture_all_queries():
+    """
+    SQL run on any thread's connection (consumer queries run on the db executor),
+    leaving out transaction control, which only some backends send as SQL
+    """
+    queries = []
+    execute = CursorWrapper._execute
+    executemany = CursorWrapper._executemany
+    
+    def record(sql):
+        if not sql.startswith(('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT')):
+            queries.append(sql)
+    
+    def counting_execute(cursor, sql, *args):
+        record(sql)
+        return execute(cursor, sql, *args)
+    
+    def counting_executemany(cursor, sql, *args):
+        record(sql)
+        return executemany(cursor, sql, *args)
+    
+    with mock.patch.object(CursorWrapper, '_execute', counting_execute), \
+            mock.patch.object(CursorWrapper, '_executemany', counting_executemany):
+        yield queries
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ChatConsumerSessionTests(TransactionTestCase):
+    """The widget socket resolves its ChatSession once and keeps it current"""
+
+    def setUp(self):
+        cache.clear()
+
+    async def connect(self, customer_id):
+        consumers = []
+        connect = ChatConsumer.connect
+        
+        async def capture(consumer):
+            consumers.append(consumer)
+            await connect(consumer)
+        
+        with mock.patch.object(ChatConsumer, 'connect', capture):
+            communicator = WebsocketCommunicator(_application(AnonymousUser()), f'/ws/chat/{customer_id}/')
+            connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, consumers[0]
+
+    async def send(self, communicator, message):
+        await communicator.send_json_to({
+            'type': 'chat_message', 'message': message, 'sender_type': 'customer', 'sender_name': 'Tester',
+        })
+        return await communicator.receive_json_from()
+
+    async def test_queries_per_message(self):
+        widget, _ = await self.connect('consumer_queries')
+        # The first message also loads the rule engine and business calendar
+        await self.send(widget, 'first')
+        
+        for message in ['second', 'third']:
+            with capture_all_queries() as queries:
+                await self.send(widget, message)
+            # Message insert, counter update (which returns the counters) and search index write
+            self.assertEqual(len(queries), 3, queries)
+            self.assertFalse([sql for sql in queries if 'chat_chatsession' in sql and 'INSERT' in sql])
+        await widget.disconnect()
+
+    async def test_cached_session_follows_close_and_reopen(self):
+        widget, consumer = await self.connect('consumer_status')
+        channel_layer = get_channel_layer()
+        self.assertEqual(consumer.chat_session.status, 'open')
+        
+        await ChatSession.objects.filter(customer_id='consumer_status').aupdate(status='closed')
+        await channel_layer.group_send('chat_consumer_status', {
+            'type': 'conversation_closed', 'closed_by': 'Agent', 'timestamp': timezone.now().isoformat(),
+        })
+        self.assertEqual((await widget.receive_json_from())['type'], 'conversation_closed')
+        self.assertEqual(consumer.chat_session.status, 'closed')
+        
+        await ChatSession.objects.filter(customer_id='consumer_status').aupdate(status='open')
+        await channel_layer.group_send('chat_consumer_status', {
+            'type': 'conversation_reopened', 'reopened_by': 'Agent', 'timestamp': timezone.now().isoformat(),
+        })
+        self.assertEqual((await widget.receive_json_from())['type'], 'conversation_reopened')
+        self.assertEqual(consumer.chat_session.status, 'open')
+        
+        # Messages keep using the same handle, with counters updated by each save
+        await self.send(widget, 'hello again')
+        self.assertEqual(consumer.chat_session.customer_message_count, 1)
+        await widget.disconnect()
+
+
+class HotQueryIndexTests(TestCase):
+    """
+    Run EXPLAIN on the hot chat queries and fail if any of them falls back to
+    a sequential scan. Works on SQLite (EXPLAIN QUERY PLAN) and PostgreSQL
+    (EXPLAIN with enable_seqscan off, so tiny test tables still show whether
+    a usable index exists).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user('agent', is_staff=True)
+        cls.session = ChatSession.objects.create(customer_id='explain_customer', admin_user=cls.admin)
+        for i in range(5):
+            Message.objects.create(chat_session=cls.session, content=f'message {i}', sender_type='customer')
+        cls.message = cls.session.messages.first()
+
+    def setUp(self):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertUsesIndex(self, queryset):
+        plan = queryset.explain()
+        if connection.vendor == 'postgresql':
+            self.assertNotIn('Seq Scan', plan, plan)
+        elif connection.vendor == 'sqlite':
+            # A bare "SCAN <table>" is a full table scan; "SCAN ... USING INDEX" is not
+            full_scans = [line for line in plan.splitlines() if re.search(r'SCAN \w+$', line.strip())]
+            self.assertEqual(full_scans, [], plan)
+        else:
+            self.skipTest(f'No EXPLAIN check for {connection.vendor}')
+
+    def test_unread_customer_messages(self):
+        self.assertUsesIndex(Message.objects.filter(
+            chat_session=self.session, sender_type='customer', is_read=False
+        ))
+
+    def test_customer_message_count(self):
+        self.assertUsesIndex(Message.objects.filter(chat_session=self.session, sender_type='customer'))
+
+    def test_history_newest_page(self):
+        self.assertUsesIndex(self.session.messages.order_by('-timestamp', '-id')[:51])
+
+    def test_history_older_page(self):
+        self.assertUsesIndex(self.session.messages.filter(
+            keyset_before('timestamp', self.message.timestamp, self.message.id)
+        ).order_by('-timestamp', '-id')[:51])
+
+    def test_history_since(self):
+        self.assertUsesIndex(self.session.messages.filter(
+            keyset_after('timestamp', self.message.timestamp, self.message.id)
+        ).order_by('timestamp', 'id')[:51])
+
+    def test_sessions_page(self):
+        self.assertUsesIndex(ChatSession.objects.order_by('-updated_at', '-id')[:51])
+
+    def test_sessions_page_by_status(self):
+        self.assertUsesIndex(ChatSession.objects.filter(status='open').order_by('-updated_at', '-id')[:51])
+
+    def test_sessions_page_by_assignee(self):
+        self.assertUsesIndex(ChatSession.objects.filter(admin_user=self.admin).order_by('-updated_at', '-id')[:51])
+
+    def test_recent_sessions_count(self):
+        self.assertUsesIndex(ChatSession.objects.filter(created_at__gte=timezone.now() - timedelta(days=7)))
+
+    def test_due_scheduled_responses(self):
+        self.assertUsesIndex(ScheduledResponse.objects.filter(status='pending', due_at__lte=timezone.now()))
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class WebsocketBenchmarkTests(TransactionTestCase):
+    """Short run of the bench_websockets harness so it keeps working as the consumers change"""
+
+    async def test_every_message_is_delivered(self):
+        report = await run_benchmark(widgets=2, admins=2, rate=20, duration=0.5, auto_reply_ratio=0.5)
+        
+        self.assertGreater(report['messages_sent'], 0)
+        self.assertEqual(report['missing'], {'widget_echo': 0, 'admin_notify': 0, 'auto_reply': 0})
+        self.assertEqual(report['latency_ms']['admin_notify']['count'], report['messages_sent'] * 2)
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    async def test_every_message_is_delivered_with_write_behind(self):
+        report = await run_benchmark(widgets=2, admins=1, rate=20, duration=0.5, auto_reply_ratio=0.5)
+        
+        self.assertEqual(report['missing'], {'widget_echo': 0, 'admin_notify': 0, 'auto_reply': 0})
+
+
+class WriteBehindBatchTests(TestCase):
+    """Batched inserts must leave the same counters as saving messages one by one"""
+
+    def pending(self, customer_id, content, sender_type='customer', from_admin=False):
+        return PendingMessage(customer_id, content, sender_type, 'Tester', None, from_admin)
+
+    def assertCountersMatchMessages(self, chat_session):
+        chat_session.refresh_from_db()
+        counters = (chat_session.unread_count, chat_session.customer_message_count, chat_session.last_message_id)
+        chat_session.recalculate_counters()
+        self.assertEqual(
+            counters,
+            (chat_session.unread_count, chat_session.customer_message_count, chat_session.last_message_id),
+        )
+
+    def test_batch_matches_sequential_counters(self):
+        existing = ChatSession.objects.create(customer_id='batch_existing')
+        Message.objects.create(chat_session=existing, content='earlier', sender_type='customer')
+        
+        results = write_message_batch([
+            self.pending('batch_existing', 'before reply'),
+            self.pending('batch_new', 'hello'),
+            self.pending('batch_existing', 'reply', sender_type='admin', from_admin=True),
+            self.pending('batch_existing', 'after reply'),
+            self.pending('batch_missing', 'reply', sender_type='admin', from_admin=True),
+        ])
+        
+        self.assertIsInstance(results[4], ChatSession.DoesNotExist)
+        # Per-message counter deltas, which add up to the batch's change
+        self.assertEqual([result[2].get('unread_messages', 0) for result in results[:4]], [0, 1, -1, 1])
+        self.assertEqual(results[1][2]['total_sessions'], 1)
+        chat_session, message, stats_delta = results[3]
+        self.assertEqual(chat_session, existing)
+        self.assertEqual(message.content, 'after reply')
+        self.assertIsNotNone(message.timestamp)
+        self.assertEqual(chat_session.unread_count, 1)
+        self.assertEqual(chat_session.customer_message_count, 3)
+        self.assertEqual(chat_session.last_message_id, message.id)
+        self.assertCountersMatchMessages(existing)
+        self.assertCountersMatchMessages(ChatSession.objects.get(customer_id='batch_new'))
+        self.assertEqual(
+            list(existing.messages.filter(sender_type='customer', is_read=False).values_list('content', flat=True)),
+            ['after reply'],
+        )
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class AdminTopicTests(TransactionTestCase):
+    """Admin sockets only receive the events for the topics they subscribed to"""
+
+    def setUp(self):
+        cache.clear()
+
+    async def connect(self, path, user):
+        communicator = WebsocketCommunicator(_application(user), path)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_events_follow_subscriptions(self):
+        agent = await database_sync_to_async(User.objects.create_user)('topic_agent', is_staff=True)
+        widget = await self.connect('/ws/chat/topic_customer/', AnonymousUser())
+        other_widget = await self.connect('/ws/chat/other_customer/', AnonymousUser())
+        chat_session = await database_sync_to_async(ChatSession.objects.get)(customer_id='topic_customer')
+        
+        summary = await self.connect('/ws/admin/dashboard/', agent)
+        unassigned = await self.connect('/ws/admin/dashboard/?topics=unassigned', agent)
+        viewer = await self.connect(f'/ws/admin/dashboard/?topics=session:{chat_session.id}', agent)
+        
+        for communicator in [other_widget, widget]:
+            await communicator.send_json_to({
+                'type': 'chat_message', 'message': 'hello', 'sender_type': 'customer', 'sender_name': 'Tester',
+            })
+            await communicator.receive_json_from()
+        
+        # Viewer gets the full event for its conversation only
+        event = await viewer.receive_json_from()
+        self.assertEqual(event['type'], 'new_message_notification')
+        self.assertEqual(event['customer_id'], 'topic_customer')
+        self.assertTrue(await viewer.receive_nothing())
+        
+        # Queue subscriber gets compact rows for both conversations
+        rows = [await unassigned.receive_json_from() for _ in range(2)]
+        self.assertEqual({row['type'] for row in rows}, {'session_update'})
+        self.assertEqual({row['session']['customer_id'] for row in rows}, {'topic_customer', 'other_customer'})
+        
+        # Summary subscriber gets counter changes only
+        updates = [await summary.receive_json_from() for _ in range(2)]
+        self.assertEqual(updates, [{'type': 'stats_update', 'stats_delta': {'unread_messages': 1}}] * 2)
+        
+        for communicator in [widget, other_widget, summary, unassigned, viewer]:
+            await communicator.disconnect()
+
+    async def test_batched_frames_merge_superseded_updates(self):
+        agent = await database_sync_to_async(User.objects.create_user)('batch_agent', is_staff=True)
+        admin = await self.connect('/ws/admin/dashboard/?topics=sessions,summary&batch_ms=500', agent)
+        channel_layer = get_channel_layer()
+        
+        # The first event after an idle period goes out straight away
+        await channel_layer.group_send('admin_summary', {'type': 'stats_update', 'stats': {'open_sessions': 1}})
+        self.assertEqual(await admin.receive_json_from(), [{'type': 'stats_update', 'stats': {'open_sessions': 1}}])
+        
+        # Everything inside the next window becomes one frame, newest row per session
+        for session_id, preview in [('a', 'first'), ('b', 'other'), ('a', 'second')]:
+            await channel_layer.group_send('admin_sessions', {
+                'type': 'session_update', 'session': {'id': session_id, 'last_message_preview': preview},
+            })
+        await channel_layer.group_send('admin_summary', {'type': 'stats_update', 'stats': {'open_sessions': 2}})
+        
+        frame = await admin.receive_json_from(timeout=2)
+        self.assertEqual(frame, [
+            {'type': 'session_update', 'session': {'id': 'b', 'last_message_preview': 'other'}},
+            {'type': 'session_update', 'session': {'id': 'a', 'last_message_preview': 'second'}},
+            {'type': 'stats_update', 'stats': {'open_sessions': 2}},
+        ])
+        await admin.disconnect()
+
+    async def test_conversations_snapshot_tolerates_bad_limits(self):
+        agent = await database_sync_to_async(User.objects.create_user)('snapshot_agent', is_staff=True)
+        for i in range(3):
+            await ChatSession.objects.acreate(customer_id=f'snapshot_customer_{i}')
+        admin = await self.connect('/ws/admin/dashboard/', agent)
+        
+        for limit, expected in [('abc', 3), (None, 3), ([1], 3), (1e400, 3), ('2', 2), (0, 1)]:
+            await admin.send_json_to({'type': 'conversations_snapshot', 'limit': limit})
+            response = await admin.receive_json_from()
+            self.assertEqual(len(response['sessions']), expected, limit)
+        await admin.disconnect()
+
+    async def test_batched_stats_deltas_add_up(self):
+        agent = await database_sync_to_async(User.objects.create_user)('delta_agent', is_staff=True)
+        admin = await self.connect('/ws/admin/dashboard/?batch_ms=500', agent)
+        channel_layer = get_channel_layer()
+        
+        await channel_layer.group_send('admin_summary', {'type': 'stats_update', 'stats_delta': {'unread_messages': 1}})
+        self.assertEqual(await admin.receive_json_from(), [{'type': 'stats_update', 'stats_delta': {'unread_messages': 1}}])
+        
+        for delta in [{'unread_messages': 1}, {'unread_messages': 2, 'open_sessions': 1}]:
+            await channel_layer.group_send('admin_summary', {'type': 'stats_update', 'stats_delta': delta})
+        self.assertEqual(await admin.receive_json_from(timeout=2), [
+            {'type': 'stats_update', 'stats_delta': {'unread_messages': 3, 'open_sessions': 1}},
+        ])
+        
+        # A delta queued behind a snapshot is folded into it
+        await channel_layer.group_send('admin_summary', {'type': 'stats_update', 'stats': {'unread_messages': 4}})
+        await channel_layer.group_send('admin_summary', {'type': 'stats_update', 'stats_delta': {'unread_messages': -1}})
+        self.assertEqual(await admin.receive_json_from(timeout=2), [
+            {'type': 'stats_update', 'stats': {'unread_messages': 3}},
+        ])
+        await admin.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class WireProtocolTests(TransactionTestCase):
+    """Sockets that offer a compact subprotocol get short field codes"""
+
+    def test_codes_are_unique(self):
+        self.assertEqual(len(set(FIELD_CODES.values())), len(FIELD_CODES))
+        self.assertEqual(len(set(TYPE_CODES.values())), len(TYPE_CODES))
+
+    async def test_negotiated_protocols(self):
+        payload = {'type': 'chat_message', 'message': 'hello', 'sender_type': 'customer', 'sender_name': 'Tester'}
+        
+        # Plain JSON stays the default
+        plain = WebsocketCommunicator(_application(AnonymousUser()), '/ws/chat/plain_customer/')
+        connected, subprotocol = await plain.connect()
+        self.assertTrue(connected)
+        self.assertIsNone(subprotocol)
+        await plain.send_json_to(payload)
+        self.assertEqual((await plain.receive_json_from())['type'], 'chat_message')
+        await plain.disconnect()
+        
+        compact = WebsocketCommunicator(
+            _application(AnonymousUser()), '/ws/chat/compact_customer/', subprotocols=['defmis.compact.v1'],
+        )
+        connected, subprotocol = await compact.connect()
+        self.assertEqual(subprotocol, 'defmis.compact.v1')
+        await compact.send_to(text_data=json.dumps(shorten(payload)))
+        frame = json.loads(await compact.receive_from())
+        self.assertEqual((frame['t'], frame['m'], frame['s']), ('cm', 'hello', 'customer'))
+        await compact.disconnect()
+        
+        # msgpack wins when both are offered
+        binary = WebsocketCommunicator(
+            _application(AnonymousUser()), '/ws/chat/msgpack_customer/',
+            subprotocols=['defmis.compact.v1', 'defmis.msgpack.v1'],
+        )
+        connected, subprotocol = await binary.connect()
+        self.assertEqual(subprotocol, 'defmis.msgpack.v1')
+        await binary.send_to(bytes_data=msgpack.packb(shorten(payload)))
+        frame = expand(msgpack.unpackb(await binary.receive_from()))
+        self.assertEqual((frame['type'], frame['message']), ('chat_message', 'hello'))
+        await binary.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class AgentPresenceTests(TransactionTestCase):
+    """Agents count as online while a dashboard socket is open on any worker"""
+
+    def setUp(self):
+        cache.clear()
+
+    async def test_presence_follows_dashboard_sockets(self):
+        agent = await database_sync_to_async(User.objects.create_user)(
+            'presence_agent', first_name='Pat', last_name='Agent', is_staff=True,
+        )
+        this_worker = PresenceRegistry()
+        other_worker = PresenceRegistry(refresh_interval=0)
+        self.assertFalse(await other_worker.any_online())
+        
+        first = WebsocketCommunicator(_application(agent), '/ws/admin/dashboard/')
+        second = WebsocketCommunicator(_application(agent), '/ws/admin/dashboard/')
+        with mock.patch('chat.consumers.agent_presence', this_worker):
+            await first.connect()
+            await second.connect()
+        self.assertTrue(await this_worker.any_online())
+        self.assertEqual(await other_worker.online_agents(), [{'user_id': agent.id, 'name': 'Pat Agent'}])
+        
+        # Still online until the last socket closes
+        with mock.patch('chat.consumers.agent_presence', this_worker):
+            await first.disconnect()
+            self.assertTrue(await other_worker.any_online())
+            await second.disconnect()
+        self.assertFalse(await other_worker.any_online())
+        self.assertFalse(await this_worker.any_online())
+        this_worker._task.cancel()
+
+    async def test_entries_expire_without_heartbeat(self):
+        agent = await database_sync_to_async(User.objects.create_user)('expiring_agent', is_staff=True)
+        crashed_worker = PresenceRegistry()
+        await crashed_worker.connect(agent)
+        crashed_worker._task.cancel()
+        
+        other_worker = PresenceRegistry(refresh_interval=0)
+        self.assertTrue(await other_worker.any_online())
+        
+        # The TTL lapses once the worker stops heartbeating
+        await cache.adelete(f'{PRESENCE_KEY_PREFIX}{agent.id}:{crashed_worker.worker_id}')
+        self.assertFalse(await other_worker.any_online())
+        self.assertEqual(await cache.aget(PRESENCE_ROSTER_KEY), {})
+
+
+class BusinessCalendarTests(TestCase):
+    """The compiled calendar answers in the calendar's own time zone"""
+
+    def setUp(self):
+        cache.clear()
+        invalidate_business_calendar()
+
+    def test_hours_holidays_and_overnight_periods(self):
+        tz = zoneinfo.ZoneInfo('America/New_York')
+        calendar = CompiledCalendar('America/New_York', [
+            (0, time(9), time(17)),    # Monday
+            (4, time(22), time(2)),    # Friday night into Saturday
+        ], holidays=[date(2024, 3, 18)])
+        
+        def at(*args):
+            return datetime(*args, tzinfo=tz).astimezone(dt_timezone.utc)
+        
+        self.assertTrue(calendar.is_open(at(2024, 3, 4, 9, 0)))
+        self.assertFalse(calendar.is_open(at(2024, 3, 4, 17, 0)))
+        self.assertFalse(calendar.is_open(at(2024, 3, 5, 10, 0)))
+        self.assertTrue(calendar.is_open(at(2024, 3, 9, 1, 30)))
+        # Same local hours either side of the DST change on 10 March
+        self.assertTrue(calendar.is_open(at(2024, 3, 11, 9, 30)))
+        self.assertFalse(calendar.is_open(at(2024, 3, 11, 8, 30)))
+        self.assertFalse(calendar.is_open(at(2024, 3, 18, 10, 0)))
+        # Far outside the first window: recompiled on demand
+        self.assertTrue(calendar.is_open(at(2025, 6, 2, 12, 0)))
+
+    async def test_calendar_reloads_when_changed(self):
+        monday_noon = datetime(2024, 3, 4, 12, 0, tzinfo=dt_timezone.utc)
+        self.assertTrue((await get_business_calendar()).is_open(monday_noon))
+        
+        business_calendar = await BusinessCalendar.objects.acreate(timezone='Asia/Tokyo')
+        await BusinessHours.objects.acreate(
+            calendar=business_calendar, weekday=0, opens_at=time(9), closes_at=time(17),
+        )
+        compiled = await get_business_calendar()
+        self.assertFalse(compiled.is_open(monday_noon))
+        self.assertTrue(compiled.is_open(datetime(2024, 3, 4, 1, 0, tzinfo=dt_timezone.utc)))
+
+
+class DbExecutorTests(TransactionTestCase):
+    """Consumer queries run on the dedicated executor, which reports its load"""
+
+    async def test_calls_run_on_the_db_executor(self):
+        @db_sync_to_async
+        def count_sessions():
+            return threading.current_thread().name, ChatSession.objects.count()
+        
+        completed = db_executor_metrics()['completed']
+        thread_name, count = await count_sessions()
+        self.assertTrue(thread_name.startswith('chat-db'))
+        self.assertEqual(count, 0)
+        
+        metrics = db_executor_metrics()
+        self.assertEqual(metrics['completed'], completed + 1)
+        self.assertEqual(metrics['queue_depth'], 0)
+        self.assertIsNotNone(metrics['wait_ms']['max'])
+
+
+class ReplicaRoutingTests(TestCase):
+    """Read-only views use a replica until their caller writes"""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_writes_pin_reads_to_the_primary(self):
+        router = ReplicaRouter()
+        
+        @read_from_replica
+        def view(request, customer_id):
+            return router.db_for_read(ChatSession)
+        
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        
+        def customer_socket():
+            # A write made on the customer's socket
+            bind_pin_identity('customer:pin_customer')
+            ChatSession.objects.create(customer_id='pin_customer')
+        
+        with mock.patch('chat.db_router.replica_aliases', return_value=['replica_0']):
+            self.assertEqual(view(request, customer_id='pin_customer'), 'replica_0')
+            contextvars.copy_context().run(customer_socket)
+            self.assertIsNone(view(request, customer_id='pin_customer'))
+            self.assertEqual(view(request, customer_id='other_customer'), 'replica_0')
+        
+        # Without replicas everything stays on the primary
+        with mock.patch('chat.db_router.replica_aliases', return_value=[]):
+            self.assertIsNone(view(request, customer_id='other_customer'))
+        self.assertEqual(router.db_for_write(ChatSession), 'default')
+    
+    @override_settings(CHAT_REPLICA_PIN_SECONDS=10)
+    def test_pin_lasts_a_full_window_after_the_last_write(self):
+        state = PinState('customer:steady_writer')
+        clock = [0.0]
+        expires = []
+        
+        def record_pin(key, value, timeout):
+            expires.append(clock[0] + timeout)
+        
+        with mock.patch('chat.db_router.time.monotonic', side_effect=lambda: clock[0]), \
+                mock.patch('chat.db_router.cache.set', side_effect=record_pin):
+            for clock[0] in (0.0, 1.0, 4.9, 5.1, 9.0, 14.5, 30.0):
+                state.note_write()
+                self.assertGreaterEqual(expires[-1], clock[0] + 10)
+        
+        # Writes in quick succession share one cache write
+        self.assertEqual(len(expires), 4)
+
+
+class FakeConnection:
+    """Just enough of a psycopg2 connection for the pool"""
+
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.autocommit = True
+        self.executed = []
+
+    @contextmanager
+    def cursor(self):
+        if self.broken:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        yield mock.Mock(execute=self.executed.append)
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionPoolTests(TestCase):
+    """The pool bounds, reuses and health-checks connections"""
+
+    def test_checkout_is_bounded_and_reuses_connections(self):
+        pool = ConnectionPool(min_size=1, max_size=2, timeout=0.05)
+        first = pool.getconn(FakeConnection)
+        second = pool.getconn(FakeConnection)
+        with self.assertRaises(PoolTimeout):
+            pool.getconn(FakeConnection)
+        
+        pool.putconn(second)
+        self.assertIs(pool.getconn(FakeConnection), second)
+        
+        # Closed connections are not handed out again
+        first.close()
+        pool.putconn(first)
+        metrics = pool.metrics()
+        self.assertEqual((metrics['size'], metrics['in_use'], metrics['max_in_use']), (1, 1, 2))
+        self.assertEqual((metrics['created'], metrics['timeouts'], metrics['discarded']), (2, 1, 1))
+
+    def test_idle_connections_are_pinged(self):
+        pool = ConnectionPool(min_size=0, max_size=2, check_interval=0)
+        connection = pool.getconn(FakeConnection)
+        pool.putconn(connection)
+        self.assertIs(pool.getconn(FakeConnection), connection)
+        
+        pool.putconn(connection)
+        connection.broken = True
+        replacement = pool.getconn(FakeConnection)
+        self.assertIsNot(replacement, connection)
+        self.assertTrue(connection.closed)
+        self.assertEqual(pool.metrics()['size'], 1)
+
+    def test_returned_connections_are_reset(self):
+        pool = ConnectionPool(min_size=0, max_size=1)
+        connection = pool.getconn(FakeConnection)
+        connection.autocommit = False
+        pool.putconn(connection)
+        # Session state set by one borrower is gone before the next one gets the connection
+        self.assertEqual(connection.executed, ['DISCARD ALL'])
+        self.assertFalse(connection.autocommit)
+        
+        connection = pool.getconn(FakeConnection)
+        connection.broken = True
+        pool.putconn(connection)
+        self.assertTrue(connection.closed)
+        self.assertEqual(pool.metrics()['discarded'], 1)
+
+
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        overrides = override_settings(
+            MEDIA_ROOT=media_root,
+            CHAT_UPLOAD_TEMP_DIR=os.path.join(media_root, 'tmp'),
+            CHAT_UPLOAD_CHUNK_SIZE=1024,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def start(self, size, content_type='image/png'):
+        return self.client.post('/chat/api/chat/upload/start/', {
+            'customer_id': 'uploader', 'filename': 'photo.png', 'size': size, 'content_type': content_type,
+        }, content_type='application/json')
+
+    def url(self, upload_id, action='', customer_id='uploader'):
+        return f'/chat/api/chat/upload/{upload_id}/{action}?customer_id={customer_id}'
+
+    def put(self, upload_id, offset, body, customer_id='uploader'):
+        return self.client.put(
+            self.url(upload_id, customer_id=customer_id), body,
+            content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET=str(offset),
+        )
+
+    def test_upload_resumes_from_acknowledged_offset(self):
+        content = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 8
+        upload_id = self.start(len(content)).json()['upload_id']
+
+        self.assertEqual(self.put(upload_id, 0, content[:1024]).json()['offset'], 1024)
+        # A retried chunk the server already has is refused with the offset to resume from
+        response = self.put(upload_id, 0, content[:1024])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Upload-Offset'], '1024')
+        # Finishing early is refused too
+        self.assertEqual(self.client.post(self.url(upload_id, 'complete/')).status_code, 409)
+
+        self.assertEqual(self.client.get(self.url(upload_id)).json()['offset'], 1024)
+        self.put(upload_id, 1024, content[1024:2048])
+        self.put(upload_id, 2048, content[2048:])
+
+        # The fake PNG cannot be previewed; that is logged in the background and the upload still succeeds
+        with self.assertLogs('chat.thumbnails', 'WARNING'):
+            response = self.client.post(self.url(upload_id, 'complete/'))
+            self.assertEqual(response.status_code, 201)
+            self.assertIsNone(create_thumbnail(response.json()['attachment_path']).result(timeout=30))
+        with default_storage.open(response.json()['attachment_path']) as stored:
+            self.assertEqual(stored.read(), content)
+        self.assertTrue(ChatSession.objects.filter(customer_id='uploader').exists())
+        self.assertEqual(os.listdir(settings.CHAT_UPLOAD_TEMP_DIR), [])
+
+    def test_concurrent_puts_for_one_offset_write_once(self):
+        content = b'%PDF-1.4 ' + b'x' * 1500
+        upload_id = self.start(len(content), content_type='application/pdf').json()['upload_id']
+        competing = []
+
+        class Stream(io.BytesIO):
+            # A second request for the same offset arrives while this one is streaming
+            def read(stream, size=-1):
+                if not competing:
+                    competing.append(self.put(upload_id, 0, b'%PDF-1.4 ' + b'y' * 1015))
+                return super().read(size)
+
+        upload = ChunkedUpload.objects.get(id=upload_id)
+        self.assertEqual(write_chunk(upload, 0, 1024, Stream(content[:1024])), 1024)
+        self.assertEqual(competing[0].status_code, 409)
+        self.assertEqual(competing[0]['Upload-Offset'], '0')
+        self.put(upload_id, 1024, content[1024:])
+        response = self.client.post(self.url(upload_id, 'complete/'))
+        with default_storage.open(response.json()['attachment_path']) as stored:
+            self.assertEqual(stored.read(), content)
+
+    def test_claim_is_released_when_a_chunk_fails(self):
+        content = b'%PDF-1.4 ' + b'x' * 1500
+        upload_id = self.start(len(content), content_type='application/pdf').json()['upload_id']
+        upload = ChunkedUpload.objects.get(id=upload_id)
+        with self.assertRaises(UploadError):
+            write_chunk(upload, 0, 1024, io.BytesIO(content[:100]))
+        self.assertEqual(ChunkedUpload.objects.get(id=upload_id).status, 'uploading')
+        # A claim whose request died lapses
+        ChunkedUpload.objects.filter(id=upload_id).update(
+            status='receiving', updated_at=timezone.now() - timedelta(minutes=10)
+        )
+        self.assertEqual(self.put(upload_id, 0, content[:1024]).json()['offset'], 1024)
+
+    def test_rejects_early(self):
+        self.assertEqual(self.start(MAX_ATTACHMENT_SIZE + 1).status_code, 413)
+        self.assertEqual(self.start(100, content_type='application/x-msdownload').status_code, 415)
+
+        upload_id = self.start(100).json()['upload_id']
+        self.assertEqual(self.put(upload_id, 0, b'x' * 2000).status_code, 413)
+        # The first chunk must start like a PNG
+        self.assertEqual(self.put(upload_id, 0, b'MZ' + b'\0' * 98).status_code, 415)
+        self.assertFalse(ChunkedUpload.objects.filter(id=upload_id).exists())
+
+    def test_only_the_owner_can_use_an_upload(self):
+        content = b'%PDF-1.4 ' + b'x' * 1500
+        upload_id = self.start(len(content), content_type='application/pdf').json()['upload_id']
+
+        self.assertEqual(self.client.get(self.url(upload_id, customer_id='intruder')).status_code, 404)
+        self.assertEqual(self.client.get(f'/chat/api/chat/upload/{upload_id}/').status_code, 404)
+        self.assertEqual(self.put(upload_id, 0, content[:1024], customer_id='intruder').status_code, 404)
+        self.assertEqual(ChunkedUpload.objects.get(id=upload_id).received, 0)
+
+        self.put(upload_id, 0, content[:1024])
+        self.put(upload_id, 1024, content[1024:])
+        self.assertEqual(self.client.post(self.url(upload_id, 'complete/', customer_id='intruder')).status_code, 404)
+        self.assertEqual(self.client.post(self.url(upload_id, 'complete/')).status_code, 201)
+
+    def test_digest_is_computed_while_streaming(self):
+        content = b'%PDF-1.4 ' + bytes(range(256)) * 11
+        upload_id = self.start(len(content), content_type='application/pdf').json()['upload_id']
+        self.put(upload_id, 0, content[:1024])
+        # The next chunks reach a worker that did not see the first one
+        uploads_module._running_digests.clear()
+        self.put(upload_id, 1024, content[1024:2048])
+        self.put(upload_id, 2048, content[2048:])
+
+        # Finishing does not read the whole file again to hash it
+        with mock.patch('chat.uploads._sha256', side_effect=AssertionError('file re-hashed')):
+            response = self.client.post(self.url(upload_id, 'complete/'))
+        self.assertEqual(response.status_code, 201)
+        digest = hashlib.sha256(content).hexdigest()
+        self.assertEqual(response.json()['attachment_path'], blob_name(digest, 'application/pdf'))
+        self.assertNotIn(uuid.UUID(upload_id), uploads_module._running_digests)
+
+    def test_purge_stale_uploads(self):
+        upload_id = self.start(100).json()['upload_id']
+        ChunkedUpload.objects.filter(id=upload_id).update(updated_at=timezone.now() - timedelta(days=2))
+        self.assertEqual(purge_stale_uploads(), 1)
+        self.assertEqual(os.listdir(settings.CHAT_UPLOAD_TEMP_DIR), [])
+
+
+class ThumbnailTests(TransactionTestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        overrides = override_settings(MEDIA_ROOT=media_root, CHAT_THUMBNAIL_SIZE=64)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def image_bytes(self, size, image_format='JPEG'):
+        output = io.BytesIO()
+        Image.new('RGB', size, 'red').save(output, image_format)
+        return output.getvalue()
+
+    def upload(self):
+        photo = SimpleUploadedFile('claim.jpg', self.image_bytes((1200, 1600)), content_type='image/jpeg')
+        response = self.client.post('/chat/api/chat/upload/', {'customer_id': 'photographer', 'file': photo})
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def test_render_thumbnail_bounds_size(self):
+        with Image.open(io.BytesIO(render_thumbnail(self.image_bytes((1600, 900)), 64, 'WEBP'))) as thumbnail:
+            self.assertEqual(thumbnail.format, 'WEBP')
+            self.assertEqual(thumbnail.size, (64, 36))
+
+    def test_thumbnail_is_rendered_in_background_and_sent_to_the_conversation(self):
+        # The upload answers without waiting for its preview
+        data = self.upload()
+        self.assertIsNone(data['thumbnail_url'])
+        chat_session = ChatSession.objects.get(customer_id='photographer')
+
+        attached = []
+
+        def create(*args):
+            attached.append(create_thumbnail(*args))
+            return attached[-1]
+
+        channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        with mock.patch('chat.thumbnails.create_thumbnail', side_effect=create), \
+                mock.patch('chat.thumbnails.get_channel_layer', return_value=channel_layer):
+            message = Message.objects.create(
+                chat_session=chat_session, content='photo', sender_type='customer', attachment=data['attachment_path']
+            )
+            self.assertFalse(message.attachment_thumbnail)
+            thumbnail_path = attached[0].result(timeout=30)
+
+        message.refresh_from_db()
+        self.assertEqual(message.attachment_thumbnail.name, thumbnail_path)
+        with default_storage.open(thumbnail_path) as stored, Image.open(stored) as thumbnail:
+            self.assertLessEqual(max(thumbnail.size), 64)
+
+        groups = [call.args[0] for call in channel_layer.group_send.call_args_list]
+        self.assertEqual(groups, ['chat_photographer', f'admin_session_{chat_session.id}'])
+        event = channel_layer.group_send.call_args_list[0].args[1]
+        self.assertEqual(event['type'], 'thumbnail_ready')
+        self.assertEqual(event['thumbnail_url'], MessageSerializer(message).data['attachment_thumbnail'])
+
+        # The same image uploaded again already has its preview
+        self.assertEqual(self.upload()['thumbnail_path'], thumbnail_path)
+
+    def test_failed_thumbnail_still_resolves(self):
+        path = default_storage.save('chat_attachments/photo.jpg', ContentFile(self.image_bytes((800, 600))))
+        message = Message.objects.create(
+            chat_session=ChatSession.objects.create(customer_id='photographer'), content='photo', sender_type='customer',
+        )
+        # Storage failing while saving the thumbnail does not leave waiters hanging
+        with mock.patch('chat.thumbnails.default_storage.save', side_effect=OSError('disk full')), \
+                mock.patch('chat.thumbnails.default_storage.exists', return_value=False), \
+                self.assertLogs('chat.thumbnails', 'WARNING'):
+            self.assertIsNone(create_thumbnail(path, message.pk).result(timeout=30))
+
+
+class AttachmentStorageTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        overrides = override_settings(MEDIA_ROOT=media_root)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def upload(self, customer_id):
+        form = SimpleUploadedFile('form.pdf', b'%PDF-1.4 hospital claim form', content_type='application/pdf')
+        return self.client.post('/chat/api/chat/upload/', {'customer_id': customer_id, 'file': form}).json()
+
+    def test_same_content_is_stored_once(self):
+        first = self.upload('first')
+        second = self.upload('second')
+        self.assertEqual(first['attachment_path'], second['attachment_path'])
+        self.assertRegex(first['attachment_path'], r'^chat_attachments/([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{60}\.pdf$')
+        self.assertEqual(AttachmentBlob.objects.count(), 1)
+
+    def test_messages_reference_count_blobs(self):
+        path = self.upload('sender')['attachment_path']
+        chat_session = ChatSession.objects.get(customer_id='sender')
+        messages = [
+            Message.objects.create(chat_session=chat_session, content='form', sender_type='customer', attachment=path)
+            for _ in range(2)
+        ]
+        write_message_batch([PendingMessage('sender', 'again', 'customer', 'Tester', path, False)])
+        self.assertEqual(AttachmentBlob.objects.get(path=path).ref_count, 3)
+
+        for message in messages:
+            message.delete()
+        self.assertEqual(AttachmentBlob.objects.get(path=path).ref_count, 1)
+        self.assertEqual(purge_unused_attachments(timedelta(0)), 0)
+
+        Message.objects.filter(content='again').delete()
+        self.assertEqual(purge_unused_attachments(timedelta(0)), 1)
+        self.assertFalse(default_storage.exists(path))
+
+
+class AttachmentServingTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        overrides = override_settings(MEDIA_ROOT=media_root)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.content = b'%PDF-1.4 ' + bytes(range(256)) * 4
+        self.path = store_attachment(ContentFile(self.content), 'application/pdf')
+        self.url = default_storage.url(self.path)
+
+    def test_full_and_conditional_responses(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response['X-Content-Type-Options'], 'nosniff')
+        self.assertEqual(response['Content-Disposition'], 'attachment')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['ETag'], f'"{os.path.basename(self.path)[:-4]}"')
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_range_requests(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.content)}')
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:20])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content), self.content[-5:])
+
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, 416)
+
+        # A stale If-Range gets the whole, current file
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(CHAT_ATTACHMENT_SENDFILE='x-accel-redirect')
+    def test_hands_off_to_front_end_server(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.path}')
+        self.assertEqual(response.content, b'')
+
+    def test_rejects_paths_outside_attachments(self):
+        self.assertEqual(self.client.get('/media/chat_attachments/../../settings.py').status_code, 404)
+        # Other media, such as uploads still in progress, stays private
+        os.makedirs(os.path.join(settings.MEDIA_ROOT, 'chat_uploads_tmp'))
+        with open(os.path.join(settings.MEDIA_ROOT, 'chat_uploads_tmp', 'upload.part'), 'wb') as part:
+            part.write(b'secret')
+        self.assertEqual(self.client.get('/media/chat_attachments/../chat_uploads_tmp/upload.part').status_code, 404)
+        self.assertEqual(self.client.get('/media/chat_attachments/%2E%2E/chat_uploads_tmp/upload.part').status_code, 404)
+
+    def test_type_comes_from_validated_content(self):
+        # Text named like a page is stored and served as text, never as HTML
+        page = SimpleUploadedFile('x.html', b'<script>alert(1)</script>', content_type='text/plain')
+        data = self.client.post('/chat/api/chat/upload/', {'customer_id': 'mallory', 'file': page}).json()
+        self.assertTrue(data['attachment_path'].endswith('.txt'))
+        response = self.client.get(data['attachment_url'])
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertEqual(response['Content-Disposition'], 'attachment')
+        
+        # Images are shown inline
+        photo = SimpleUploadedFile('photo.gif', b'GIF89a' + b'\0' * 32, content_type='image/gif')
+        path = store_attachment(photo, 'image/gif')
+        response = self.client.get(default_storage.url(path))
+        self.assertEqual(response['Content-Type'], 'image/gif')
+        self.assertTrue(response['Content-Disposition'].startswith('inline'))
+
+
+class WidgetConfigTests(TestCase):
+    def setUp(self):
+        invalidate_widget_config()
+
+    def test_config_is_cached_and_revalidated(self):
+        widget = ChatWidget.objects.create(name='Claims Desk')
+        response = self.client.get('/chat/api/widget/config/')
+        self.assertEqual(response.json()['name'], 'Claims Desk')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=300')
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/chat/api/widget/config/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Saving the widget (widget settings page or admin) bumps the shared version
+        widget.name = 'Claims Help'
+        widget.save()
+        response = self.client.get('/chat/api/widget/config/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['name'], 'Claims Help')
+        self.assertNotEqual(response['ETag'], etag)
@@ -0,0 +1,241 @@
+"""
+Preview thumbnails for image attachments
+
+Decoding and resizing a multi-megabyte phone photo takes long enough to hold
+the GIL (and a request thread) for a noticeable time, so it runs in a small
+process pool of CHAT_THUMBNAIL_WORKERS processes per worker. The pool is
+started with 'spawn' because forking a threaded ASGI server is not safe; the
+children only import Pillow and this module's render_thumbnail.
+
+Images are bounded to CHAT_THUMBNAIL_SIZE pixels on their longest side and
+stored as WebP (JPEG if Pillow was built without WebP support) under
+chat_attachments/thumbnails/. The UIs show the thumbnail and only load the
+original when it is clicked.
+
+Nothing on the request or socket path waits for a thumbnail. Uploads start
+rendering in the background and answer without one (unless the same image
+was uploaded before); a new image message gets its thumbnail saved once it
+is ready, and the sockets showing the conversation are sent a
+'thumbnail_ready' event to swap the original for the preview.
+"""
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps, features
+
+# Models and the fan-out helpers are imported where they are used: the pool's
+# children import this module without setting Django up
+
+
+logger = logging.getLogger(__name__)
+
+IMAGE_CONTENT_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp'}
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
+
+THUMBNAIL_QUALITY = 80
+
+
+def thumbnail_format():
+    return 'WEBP' if features.check('webp') else 'JPEG'
+
+
+def render_thumbnail(data, max_size, image_format, quality=THUMBNAIL_QUALITY):
+    """Return image bytes for data scaled to fit max_size x max_size (runs in the pool)"""
+    with Image.open(io.BytesIO(data)) as image:
+        # Let JPEG decode at a reduced scale instead of decoding every pixel
+        image.draft('RGB', (max_size, max_size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_size, max_size))
+
+        has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        if has_alpha and image_format == 'WEBP':
+            image = image.convert('RGBA')
+        else:
+            image = image.convert('RGB')
+
+        output = io.BytesIO()
+        image.save(output, image_format, quality=quality)
+        return output.getvalue()
+
+
+_pool = None
+_jobs = None
+_pool_lock = threading.Lock()
+
+# Attachment path -> Future of its stored thumbnail, while one is being rendered
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+def get_thumbnail_pool():
+    """Return this process's thumbnail pool, creating it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(
+                    max_workers=settings.CHAT_THUMBNAIL_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+    return _pool
+
+
+def get_thumbnail_jobs():
+    """Threads that feed the pool, store its results and update messages"""
+    global _jobs
+    if _jobs is None:
+        with _pool_lock:
+            if _jobs is None:
+                _jobs = ThreadPoolExecutor(
+                    max_workers=settings.CHAT_THUMBNAIL_WORKERS, thread_name_prefix='chat-thumbnail'
+                )
+    return _jobs
+
+
+def thumbnail_name(attachment_path, image_format):
+    """Thumbnail path for an attachment, mirroring its fan-out directories"""
+    stem = os.path.splitext(os.path.relpath(attachment_path, 'chat_attachments'))[0]
+    extension = 'webp' if image_format == 'WEBP' else 'jpg'
+    return f'chat_attachments/thumbnails/{stem}.{extension}'
+
+
+def is_image(path):
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def stored_thumbnail(attachment_path):
+    """The attachment's thumbnail path if one has been stored already, else None"""
+    name = thumbnail_name(attachment_path, thumbnail_format())
+    return name if default_storage.exists(name) else None
+
+
+def _store_thumbnail(attachment_path):
+    # Runs on a job thread; failures are not fatal, the UIs fall back to the original
+    image_format = thumbnail_format()
+    name = thumbnail_name(attachment_path, image_format)
+    # Attachments are stored once per content, so a repeated upload already has its thumbnail
+    if default_storage.exists(name):
+        return name
+
+    future = None
+    try:
+        with default_storage.open(attachment_path, 'rb') as attachment:
+            data = attachment.read()
+        future = get_thumbnail_pool().submit(render_thumbnail, data, settings.CHAT_THUMBNAIL_SIZE, image_format)
+        thumbnail = future.result(timeout=settings.CHAT_THUMBNAIL_TIMEOUT)
+    except Exception:
+        if future is not None:
+            future.cancel()
+        logger.warning('Thumbnail failed for %s', attachment_path, exc_info=True)
+        return None
+    return default_storage.save(name, ContentFile(thumbnail))
+
+
+async def _announce_thumbnail(message):
+    from .fanout import admin_session_group
+
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    chat_session = message.chat_session
+    event = {
+        'type': 'thumbnail_ready',
+        'message_id': str(message.id),
+        'attachment_url': message.attachment.url,
+        'thumbnail_url': message.attachment_thumbnail.url,
+    }
+    await channel_layer.group_send(f'chat_{chat_session.customer_id}', event)
+    await channel_layer.group_send(
+        admin_session_group(chat_session.id),
+        dict(event, chat_session_id=str(chat_session.id), customer_id=chat_session.customer_id),
+    )
+
+
+def _attach_thumbnail(message_id, thumbnail_path):
+    # Runs on a job thread, which has its own database connection
+    from .models import Message
+
+    if thumbnail_path is None:
+        return None
+    close_old_connections()
+    try:
+        message = Message.objects.select_related('chat_session').filter(pk=message_id).first()
+        if message is None:
+            # Deleted while its thumbnail was rendering
+            return None
+        message.attachment_thumbnail = thumbnail_path
+        # Bumps the conversation's updated_at, so cached history is revalidated
+        message.save(update_fields=['attachment_thumbnail'])
+        async_to_sync(_announce_thumbnail)(message)
+    except Exception:
+        logger.warning('Could not attach thumbnail %s to message %s', thumbnail_path, message_id, exc_info=True)
+        return None
+    finally:
+        close_old_connections()
+    return thumbnail_path
+
+
+def create_thumbnail(attachment_path, message_id=None):
+    """
+    Render and store a thumbnail for a stored image attachment in the background
+    Returns a Future for the thumbnail's storage path, which is None if the image
+    could not be read or took longer than CHAT_THUMBNAIL_TIMEOUT seconds. With
+    message_id, the thumbnail is also saved on that message and announced to
+    its conversation before the Future completes.
+    """
+    with _pending_lock:
+        # An upload and the message sending it share one rendering
+        stored = _pending.get(attachment_path)
+        started = stored is None
+        if started:
+            stored = _pending[attachment_path] = get_thumbnail_jobs().submit(_store_thumbnail, attachment_path)
+    if started:
+        stored.add_done_callback(lambda done: _forget_pending(attachment_path))
+    if message_id is None:
+        return stored
+
+    attached = Future()
+
+    def attach(done):
+        try:
+            job = get_thumbnail_jobs().submit(_attach_thumbnail, message_id, done.result())
+        except Exception:
+            # e.g. storage failed to save the thumbnail; whoever waits still gets an answer
+            logger.warning('Thumbnail failed for %s', attachment_path, exc_info=True)
+            attached.set_result(None)
+            return
+        job.add_done_callback(lambda job: _resolve(attached, job))
+
+    stored.add_done_callback(attach)
+    return attached
+
+
+def _forget_pending(attachment_path):
+    with _pending_lock:
+        _pending.pop(attachment_path, None)
+
+
+def _resolve(future, job):
+    try:
+        result = job.result()
+    except Exception:
+        logger.warning('Thumbnail job failed', exc_info=True)
+        result = None
+    future.set_result(result)
+
+
+def thumbnail_new_messages(messages):
+    """Render thumbnails for new image messages sent without one, once they are committed"""
+    for message in messages:
+        if message.attachment and not message.attachment_thumbnail and is_image(message.attachment.name):
+            transaction.on_commit(lambda message=message: create_thumbnail(message.attachment.name, message.pk))
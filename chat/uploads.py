@@ -0,0 +1,367 @@
+"""
+Attachment upload validation and chunked, resumable uploads
+
+Uploads are checked as early as possible: the declared size and content type
+when an upload starts (or the request's Content-Length for single-request
+uploads), each chunk's length before it is read, and the file's leading
+magic bytes when the first chunk arrives.
+
+A chunked upload is a ChunkedUpload row plus a part file in
+CHAT_UPLOAD_TEMP_DIR, which must be shared by every worker. A request first
+claims the chunk at the acknowledged offset (status 'receiving'), so two
+requests for the same offset never write the part file at once; the claim
+lapses after CHUNK_CLAIM_TIMEOUT if its request died. The chunk is then
+streamed from the request into the part file at its offset and acknowledged
+by advancing ChunkedUpload.received, so an interrupted client asks for the
+acknowledged offset and resumes from there. Finalizing stores the part file
+like any other upload.
+
+Chunks arrive strictly in order, so each worker hashes them as they stream
+through and keeps the running sha256 of the acknowledged bytes; finalizing
+then does not read the whole file again. A worker that did not see some
+chunks (they went to another worker) first hashes what it missed from the
+part file.
+
+Stored attachments are content addressed: a file is hashed as it is read and
+kept once under chat_attachments/<ab>/<cd>/<sha256><ext>, so the same form
+uploaded a thousand times takes one copy and a directory never holds more
+than 256 entries. The extension comes from the validated content type, never
+from the client's filename, because it decides the type the file is served
+as. Uploading content that is already stored returns the existing path
+without writing anything. AttachmentBlob.ref_count counts the
+messages sending each blob; purge_unused_attachments removes blobs no message
+has referenced for CHAT_UPLOAD_EXPIRY_HOURS.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import AttachmentBlob, ChunkedUpload
+from .thumbnails import thumbnail_format, thumbnail_name
+
+
+MAX_ATTACHMENT_SIZE = 10 * 1024 * 1024  # 10MB
+
+ALLOWED_CONTENT_TYPES = [
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp',
+    'application/pdf',
+    'application/msword',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.ms-excel',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'text/plain',
+]
+
+# Stored (and served) extension for each allowed type; the client's filename is never trusted for it
+CONTENT_TYPE_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+    'application/pdf': '.pdf',
+    'application/msword': '.doc',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': '.docx',
+    'application/vnd.ms-excel': '.xls',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': '.xlsx',
+    'text/plain': '.txt',
+}
+
+# Leading bytes each binary type must start with
+_OLE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+_ZIP = b'PK\x03\x04'
+MAGIC_BYTES = {
+    'image/jpeg': [b'\xff\xd8\xff'],
+    'image/png': [b'\x89PNG\r\n\x1a\n'],
+    'image/gif': [b'GIF87a', b'GIF89a'],
+    'application/pdf': [b'%PDF-'],
+    'application/msword': [_OLE],
+    'application/vnd.ms-excel': [_OLE],
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': [_ZIP],
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': [_ZIP],
+}
+
+# Allowance for multipart boundaries and form fields around a single-request upload
+MULTIPART_OVERHEAD = 64 * 1024
+
+# Bytes read from the request at a time while streaming a chunk
+STREAM_BLOCK_SIZE = 64 * 1024
+
+# How long a request may hold the claim on a chunk before another request can take it over
+CHUNK_CLAIM_TIMEOUT = timedelta(minutes=5)
+
+# Running hashes kept per worker; the oldest are dropped (and recomputed if needed) beyond this
+MAX_RUNNING_DIGESTS = 1024
+
+
+class UploadError(Exception):
+    """An upload was rejected; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def validate_declared(size, content_type):
+    """Reject an upload from its declared size and content type"""
+    if size is None or size < 0:
+        raise UploadError('File size is required')
+    if size > MAX_ATTACHMENT_SIZE:
+        raise UploadError('File size exceeds 10MB limit', status=413)
+    if content_type not in ALLOWED_CONTENT_TYPES:
+        raise UploadError('File type not allowed. Allowed: images, PDF, Word, Excel, text', status=415)
+
+
+def content_matches(content_type, head):
+    """True if the first bytes of a file look like the declared content type"""
+    if content_type == 'image/webp':
+        return head[:4] == b'RIFF' and head[8:12] == b'WEBP'
+    if content_type == 'text/plain':
+        # Text has no signature: accept UTF-8 without NUL bytes (a split character at the end is fine)
+        sample = head[:4096]
+        if b'\x00' in sample:
+            return False
+        try:
+            sample.decode('utf-8')
+        except UnicodeDecodeError as e:
+            return e.start >= len(sample) - 3
+        return True
+    return any(head.startswith(magic) for magic in MAGIC_BYTES.get(content_type, []))
+
+
+def blob_name(digest, content_type):
+    """Storage path for validated content with the given sha256 hex digest, fanned out by its first bytes"""
+    file_ext = CONTENT_TYPE_EXTENSIONS[content_type]
+    return f'chat_attachments/{digest[:2]}/{digest[2:4]}/{digest}{file_ext}'
+
+
+def _sha256(file):
+    digest = hashlib.sha256()
+    file.seek(0)
+    for block in iter(lambda: file.read(STREAM_BLOCK_SIZE), b''):
+        digest.update(block)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def store_attachment(file, content_type, digest=None):
+    """
+    Store an attachment's content once and return its storage path
+    content_type must have been validated; it decides the stored extension.
+    Content that is already stored returns the existing path without writing.
+    digest is the content's sha256 hex digest, if the caller already has it.
+    """
+    if digest is None:
+        digest = _sha256(file)
+    blob = AttachmentBlob.objects.filter(sha256=digest).first()
+    if blob is None:
+        name = blob_name(digest, content_type)
+        path = name if default_storage.exists(name) else default_storage.save(name, file)
+        blob, created = AttachmentBlob.objects.get_or_create(
+            sha256=digest, defaults={'path': path, 'size': file.size}
+        )
+        if not created and path != blob.path:
+            # Another request stored the same content first
+            default_storage.delete(path)
+    else:
+        # Keep a blob that is about to be referenced again out of the purge
+        AttachmentBlob.objects.filter(pk=blob.pk).update(updated_at=timezone.now())
+    return blob.path
+
+
+def _part_path(upload):
+    return os.path.join(settings.CHAT_UPLOAD_TEMP_DIR, f'{upload.id}.part')
+
+
+# Upload id -> (offset, sha256 of the part file's first offset bytes)
+_running_digests = OrderedDict()
+_running_digests_lock = threading.Lock()
+
+
+def _running_digest(upload, offset):
+    """sha256 of the upload's first offset bytes, continuing this worker's running hash if it has one"""
+    with _running_digests_lock:
+        hashed, digest = _running_digests.get(upload.pk, (0, None))
+    # A copy, so a chunk that fails halfway leaves the running hash as it was
+    digest = digest.copy() if digest is not None and hashed <= offset else None
+    if digest is None:
+        hashed, digest = 0, hashlib.sha256()
+    if hashed < offset:
+        # Chunks acknowledged by another worker
+        with open(_part_path(upload), 'rb') as part:
+            part.seek(hashed)
+            for block in iter(lambda: part.read(min(STREAM_BLOCK_SIZE, offset - hashed)), b''):
+                digest.update(block)
+                hashed += len(block)
+    return digest
+
+
+def _keep_digest(upload, offset, digest):
+    with _running_digests_lock:
+        _running_digests[upload.pk] = (offset, digest)
+        _running_digests.move_to_end(upload.pk)
+        while len(_running_digests) > MAX_RUNNING_DIGESTS:
+            _running_digests.popitem(last=False)
+
+
+def _drop_digest(upload):
+    with _running_digests_lock:
+        _running_digests.pop(upload.pk, None)
+
+
+def start_upload(customer_id, filename, size, content_type):
+    """Validate the declared file and create the upload"""
+    validate_declared(size, content_type)
+    upload = ChunkedUpload.objects.create(
+        customer_id=customer_id,
+        filename=os.path.basename(filename)[:255],
+        content_type=content_type,
+        size=size,
+    )
+    os.makedirs(settings.CHAT_UPLOAD_TEMP_DIR, exist_ok=True)
+    open(_part_path(upload), 'wb').close()
+    return upload
+
+
+def write_chunk(upload, offset, length, stream):
+    """
+    Stream length bytes from stream into the upload at offset
+    Returns the new acknowledged offset
+    """
+    if upload.status == 'complete':
+        raise UploadError('Upload is already complete', status=409)
+    if offset != upload.received:
+        raise UploadError(f'Expected offset {upload.received}', status=409)
+    if length <= 0 or length > settings.CHAT_UPLOAD_CHUNK_SIZE:
+        raise UploadError(f'Chunks must be 1 to {settings.CHAT_UPLOAD_CHUNK_SIZE} bytes', status=413)
+    if offset + length > upload.size:
+        raise UploadError('Chunk runs past the declared file size', status=413)
+
+    claimed_at = _claim_chunk(upload, offset)
+    claim = ChunkedUpload.objects.filter(pk=upload.pk, received=offset, status='receiving', updated_at=claimed_at)
+    digest = _running_digest(upload, offset)
+    fd = None
+    try:
+        fd = os.open(_part_path(upload), os.O_WRONLY)
+        position = offset
+        remaining = length
+        while remaining:
+            block = stream.read(min(STREAM_BLOCK_SIZE, remaining))
+            if not block:
+                raise UploadError('Chunk ended before Content-Length bytes were received')
+            if position == 0 and not content_matches(upload.content_type, block):
+                os.close(fd)
+                fd = None
+                delete_upload(upload)
+                raise UploadError('File content does not match its type', status=415)
+            os.pwrite(fd, block, position)
+            digest.update(block)
+            position += len(block)
+            remaining -= len(block)
+    except BaseException:
+        # Let the client (or another request) send this chunk again
+        claim.update(status='uploading')
+        raise
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+    # Acknowledge only if the claim was not taken over while this request wrote
+    acknowledged = claim.update(received=offset + length, status='uploading', updated_at=timezone.now())
+    if not acknowledged:
+        upload.refresh_from_db()
+        raise UploadError(f'Expected offset {upload.received}', status=409)
+    upload.received = offset + length
+    upload.status = 'uploading'
+    _keep_digest(upload, upload.received, digest)
+    return upload.received
+
+
+def _claim_chunk(upload, offset):
+    """
+    Claim the chunk at offset for this request, taking over a claim that lapsed
+    Returns the claim's timestamp, which the acknowledgement must still match
+    """
+    claimed_at = timezone.now()
+    claimed = ChunkedUpload.objects.filter(pk=upload.pk, received=offset).filter(
+        Q(status='uploading') | Q(status='receiving', updated_at__lt=claimed_at - CHUNK_CLAIM_TIMEOUT)
+    ).update(status='receiving', updated_at=claimed_at)
+    if not claimed:
+        upload.refresh_from_db()
+        if upload.status == 'receiving' and upload.received == offset:
+            raise UploadError(f'The chunk at offset {offset} is already being received', status=409)
+        raise UploadError(f'Expected offset {upload.received}', status=409)
+    return claimed_at
+
+
+def finish_upload(upload):
+    """Move a fully received upload into storage and return its storage path"""
+    if upload.status == 'complete':
+        return upload.attachment_path
+    if upload.received != upload.size:
+        raise UploadError(f'Upload incomplete: {upload.received} of {upload.size} bytes received', status=409)
+
+    part_path = _part_path(upload)
+    # Drop anything an abandoned request wrote past the acknowledged offset
+    os.truncate(part_path, upload.size)
+    digest = _running_digest(upload, upload.size).hexdigest()
+    with open(part_path, 'rb') as part:
+        file_path = store_attachment(File(part), upload.content_type, digest=digest)
+    os.remove(part_path)
+    _drop_digest(upload)
+
+    upload.status = 'complete'
+    upload.attachment_path = file_path
+    upload.save(update_fields=['status', 'attachment_path', 'updated_at'])
+    return file_path
+
+
+def delete_upload(upload):
+    """Remove an upload and its part file"""
+    _drop_digest(upload)
+    try:
+        os.remove(_part_path(upload))
+    except FileNotFoundError:
+        pass
+    upload.delete()
+
+
+def purge_stale_uploads(max_age=None):
+    """
+    Delete unfinished uploads not touched for max_age (a timedelta, by default
+    CHAT_UPLOAD_EXPIRY_HOURS); returns how many were deleted
+    """
+    if max_age is None:
+        max_age = timedelta(hours=settings.CHAT_UPLOAD_EXPIRY_HOURS)
+    stale = ChunkedUpload.objects.exclude(status='complete').filter(updated_at__lt=timezone.now() - max_age)
+    count = 0
+    for upload in stale:
+        delete_upload(upload)
+        count += 1
+    return count
+
+
+def purge_unused_attachments(max_age=None):
+    """
+    Delete stored attachments (and their thumbnails) that no message has
+    referenced for max_age (default CHAT_UPLOAD_EXPIRY_HOURS); returns how many
+    """
+    if max_age is None:
+        max_age = timedelta(hours=settings.CHAT_UPLOAD_EXPIRY_HOURS)
+    cutoff = timezone.now() - max_age
+    count = 0
+    for blob in AttachmentBlob.objects.filter(ref_count=0, updated_at__lt=cutoff):
+        # Conditional, so a blob referenced or re-uploaded since the query is kept
+        if not AttachmentBlob.objects.filter(pk=blob.pk, ref_count=0, updated_at__lt=cutoff).delete()[0]:
+            continue
+        default_storage.delete(blob.path)
+        default_storage.delete(thumbnail_name(blob.path, thumbnail_format()))
+        count += 1
+    return count
@@ -10,9 +10,15 @@ urlpatterns = [
     path('api/chat/<str:customer_id>/history/', views.chat_history, name='chat_history'),
     path('api/chat/message/', views.send_message, name='send_message'),
     path('api/chat/upload/', views.upload_attachment, name='upload_attachment'),
+    path('api/chat/upload/start/', views.start_upload_view, name='start_upload'),
+    path('api/chat/upload/<uuid:upload_id>/', views.upload_chunk, name='upload_chunk'),
+    path('api/chat/upload/<uuid:upload_id>/complete/', views.complete_upload, name='complete_upload'),
     
     # Admin API endpoints
     path('api/admin/sessions/', views.admin_chat_sessions, name='admin_chat_sessions'),
+    path('api/admin/search/', views.admin_search, name='admin_search'),
+    path('api/admin/presence/', views.admin_presence, name='admin_presence'),
+    path('api/admin/metrics/', views.admin_metrics, name='admin_metrics'),
     path('api/admin/session/<uuid:session_id>/', views.admin_chat_detail, name='admin_chat_detail'),
     path('api/admin/session/<uuid:session_id>/status/', views.admin_update_chat_status, name='admin_update_chat_status'),
 ]
\ No newline at end of file
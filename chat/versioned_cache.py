@@ -0,0 +1,75 @@
+"""
+Process-local values invalidated through a shared version stamp
+
+Rarely-changing data read on hot paths (the automated response rules, the
+business calendar, the widget configuration) is loaded once per worker and
+kept in memory. Saving the underlying rows bumps a version stamp in the shared
+cache; every worker compares its copy against that stamp at most every
+check_interval seconds and reloads from the database only when it differs.
+"""
+import threading
+import time
+
+from channels.db import database_sync_to_async
+from django.core.cache import cache
+
+
+class VersionedCache:
+    """A value built by load() and rebuilt whenever the shared version stamp changes"""
+
+    def __init__(self, version_key, load, check_interval=5):
+        self.version_key = version_key
+        self.check_interval = check_interval
+        self._load = load
+        self._entry = None  # (value, version)
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Drop this worker's copy and bump the shared version stamp so every worker reloads"""
+        self._entry = None
+        cache.add(self.version_key, 0, timeout=None)
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.set(self.version_key, 1, timeout=None)
+
+    def _fresh(self, now):
+        """The current value if the version stamp was checked recently, else None"""
+        entry = self._entry
+        if entry is not None and now - self._checked_at < self.check_interval:
+            return entry[0]
+        return None
+
+    def _stale(self, version):
+        entry = self._entry
+        return entry is None or entry[1] != version
+
+    def get(self):
+        """Return the value, reloading it if the shared version stamp has changed"""
+        now = time.monotonic()
+        value = self._fresh(now)
+        if value is not None:
+            return value
+
+        version = cache.get(self.version_key, 0)
+        if self._stale(version):
+            # One thread reloads; the others wait for it instead of all querying
+            with self._lock:
+                if self._stale(version):
+                    self._entry = (self._load(), version)
+        self._checked_at = now
+        return self._entry[0]
+
+    async def aget(self):
+        """get() for async callers; the load runs on the database thread"""
+        now = time.monotonic()
+        value = self._fresh(now)
+        if value is not None:
+            return value
+
+        version = await cache.aget(self.version_key, 0)
+        if self._stale(version):
+            self._entry = (await database_sync_to_async(self._load)(), version)
+        self._checked_at = now
+        return self._entry[0]
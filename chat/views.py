@@ -8,11 +8,29 @@ from rest_framework.decorators import api_view, permission_classes, authenticati
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.authentication import SessionAuthentication
 from rest_framework.response import Response
-from .models import ChatSession, Message, ChatWidget
-from .serializers import ChatSessionSerializer, MessageSerializer, ChatWidgetSerializer
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.utils.http import parse_etags, quote_etag
+from asgiref.sync import async_to_sync
+from .models import ChatSession, ChunkedUpload, Message
+from .db_executor import db_executor_metrics
+from .db_pool.pool import pool_metrics
+from .db_router import bind_pin_identity, read_from_replica
+from .presence import agent_presence
+from .uploads import (
+    MAX_ATTACHMENT_SIZE, MULTIPART_OVERHEAD, UploadError, content_matches, finish_upload,
+    start_upload, store_attachment, validate_declared, write_chunk,
+)
+from .thumbnails import IMAGE_CONTENT_TYPES, create_thumbnail, stored_thumbnail
+from .stats import apply_stats_delta, new_session_delta, status_change_delta
+from .pagination import decode_cursor, encode_cursor, get_page_size, keyset_after, keyset_before
+from .search import search_conversations
+from .serializers import ChatSessionSerializer, ChatSessionSummarySerializer, MessageSerializer
+from .widget_config import get_widget_config
+import hashlib
 import json
 import uuid
-import os  # Add os import for os.path.splitext
 
 
 # Custom session authentication without CSRF check for file uploads
@@ -22,23 +40,25 @@ class CsrfExemptSessionAuthentication(SessionAuthentication):
 
 
 @api_view(['GET'])
+@authentication_classes([])
 @permission_classes([AllowAny])
 def widget_config(request):
-    """Get chat widget configuration"""
+    """
+    Get chat widget configuration
+    
+    Served from the worker's in-memory copy with an ETag and a shared
+    Cache-Control max-age, so browsers and proxies answer most requests. No
+    authentication runs, so the response does not vary by session cookie.
+    """
     try:
-        widget = ChatWidget.objects.filter(is_active=True).first()
-        if widget:
-            serializer = ChatWidgetSerializer(widget)
-            return Response(serializer.data)
-        else:
-            # Return default configuration
-            return Response({
-                'name': 'Defmis Agent',
-                'welcome_message': 'Hi there! How can we help you today?',
-                'primary_color': '#007bff',
-                'widget_position': 'bottom-right',
-                'is_active': True
-            })
+        config, etag = get_widget_config()
+        headers = {
+            'ETag': etag,
+            'Cache-Control': f'public, max-age={settings.CHAT_WIDGET_CONFIG_MAX_AGE}',
+        }
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(config, headers=headers)
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -54,6 +74,7 @@ def start_chat(request):
         
         if not customer_id:
             customer_id = str(uuid.uuid4())
+        bind_pin_identity(f'customer:{customer_id}')
         
         # Get or create chat session
         chat_session, created = ChatSession.objects.get_or_create(
@@ -65,6 +86,9 @@ def start_chat(request):
             }
         )
         
+        if created:
+            apply_stats_delta(**new_session_delta())
+        
         # Update customer info if provided
         if customer_name and not chat_session.customer_name:
             chat_session.customer_name = customer_name
@@ -85,15 +109,65 @@ def start_chat(request):
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
+@read_from_replica
 def chat_history(request, customer_id):
-    """Get chat history for a customer"""
+    """
+    Get chat history for a customer
+    
+    Returns the newest page of messages, oldest first. Pass ?before=<cursor> to
+    page back through older messages, or ?since=<message_id> to fetch only the
+    messages newer than one the client already has. Responses carry an ETag so
+    an unchanged history costs a 304.
+    """
     try:
-        chat_session = get_object_or_404(ChatSession, customer_id=customer_id)
+        chat_session = ChatSession.objects.get(customer_id=customer_id)
+        
+        # The counters change whenever a message is added or read, and updated_at
+        # whenever one is edited or deleted, so they identify the history
+        # without serializing it
+        etag = quote_etag(hashlib.md5(
+            f'{chat_session.last_message_id}:{chat_session.unread_count}:'
+            f'{chat_session.updated_at.isoformat()}:{request.GET.urlencode()}'.encode()
+        ).hexdigest())
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        
+        limit = get_page_size(request)
         messages = chat_session.messages.all()
-        serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        since = request.GET.get('since')
+        before = request.GET.get('before')
+        
+        if since:
+            anchor = messages.filter(id=since).values('timestamp', 'id').first()
+            if anchor is None:
+                return Response({'error': 'Message not found in this chat session'},
+                              status=status.HTTP_400_BAD_REQUEST)
+            page = list(messages.filter(
+                keyset_after('timestamp', anchor['timestamp'], anchor['id'])
+            ).order_by('timestamp', 'id')[:limit + 1])
+            has_more = len(page) > limit
+            page = page[:limit]
+            previous_cursor = None
+        else:
+            if before:
+                timestamp, pk = decode_cursor(before)
+                messages = messages.filter(keyset_before('timestamp', timestamp, pk))
+            page = list(messages.order_by('-timestamp', '-id')[:limit + 1])
+            has_more = len(page) > limit
+            page = page[:limit]
+            page.reverse()
+            previous_cursor = encode_cursor(page[0].timestamp, page[0].id) if has_more else None
+        
+        serializer = MessageSerializer(page, many=True)
+        return Response({
+            'results': serializer.data,
+            'previous': previous_cursor,
+            'has_more': has_more,
+        }, headers={'ETag': etag})
     except ChatSession.DoesNotExist:
         return Response({'error': 'Chat session not found'}, status=status.HTTP_404_NOT_FOUND)
+    except (ValueError, ValidationError):
+        return Response({'error': 'Invalid cursor or message id'}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -113,7 +187,20 @@ def send_message(request):
             return Response({'error': 'customer_id and message are required'}, 
                           status=status.HTTP_400_BAD_REQUEST)
         
+        # Attachments get the same checks as upload_attachment
+        if attachment:
+            try:
+                validate_declared(attachment.size, attachment.content_type)
+            except UploadError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            head = attachment.read(4096)
+            attachment.seek(0)
+            if not content_matches(attachment.content_type, head):
+                return Response({'error': 'File content does not match its type'}, 
+                              status=status.HTTP_400_BAD_REQUEST)
+        
         # Get chat session
+        bind_pin_identity(f'customer:{customer_id}')
         chat_session = get_object_or_404(ChatSession, customer_id=customer_id)
         
         # Create message
@@ -122,8 +209,9 @@ def send_message(request):
             content=message_content,
             sender_type=sender_type,
             sender_name=sender_name,
-            attachment=attachment
+            attachment=store_attachment(attachment, attachment.content_type) if attachment else None
         )
+        apply_stats_delta(unread_messages=int(sender_type == 'customer'))
         
         serializer = MessageSerializer(message)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -140,6 +228,12 @@ def send_message(request):
 def upload_attachment(request):
     """Upload a file attachment and return the URL"""
     try:
+        # Reject oversized bodies from the header, before the multipart body is parsed
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        if content_length > MAX_ATTACHMENT_SIZE + MULTIPART_OVERHEAD:
+            return Response({'error': 'File size exceeds 10MB limit'}, 
+                          status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        
         customer_id = request.data.get('customer_id')
         attachment = request.FILES.get('file')
         
@@ -147,75 +241,293 @@ def upload_attachment(request):
             return Response({'error': 'customer_id and file are required'}, 
                           status=status.HTTP_400_BAD_REQUEST)
         
-        # Validate file size (max 10MB)
-        max_size = 10 * 1024 * 1024  # 10MB
-        if attachment.size > max_size:
-            return Response({'error': 'File size exceeds 10MB limit'}, 
-                          status=status.HTTP_400_BAD_REQUEST)
+        try:
+            validate_declared(attachment.size, attachment.content_type)
+        except UploadError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Validate file type
-        allowed_types = [
-            'image/jpeg', 'image/png', 'image/gif', 'image/webp',
-            'application/pdf', 
-            'application/msword',
-            'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            'application/vnd.ms-excel',
-            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            'text/plain'
-        ]
-        
-        if attachment.content_type not in allowed_types:
-            return Response({'error': 'File type not allowed. Allowed: images, PDF, Word, Excel, text'}, 
+        # Check the file's leading bytes against its claimed type
+        head = attachment.read(4096)
+        attachment.seek(0)
+        if not content_matches(attachment.content_type, head):
+            return Response({'error': 'File content does not match its type'}, 
                           status=status.HTTP_400_BAD_REQUEST)
         
         # Get or create chat session
-        chat_session, _ = ChatSession.objects.get_or_create(
-            customer_id=customer_id,
-            defaults={'status': 'open'}
-        )
+        _ensure_chat_session(customer_id)
         
         # Save just the file without creating a message
         # The message will be created when sent via WebSocket
-        from django.core.files.storage import default_storage
-        import uuid
-        from datetime import datetime
+        file_path = store_attachment(attachment, attachment.content_type)
+        
+        # Return file info (message will be created later via WebSocket)
+        return Response(
+            _attachment_payload(file_path, attachment.name, attachment.size, attachment.content_type),
+            status=status.HTTP_201_CREATED
+        )
+        
+    except Exception as e:
+        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def _ensure_chat_session(customer_id):
+    chat_session, created = ChatSession.objects.get_or_create(
+        customer_id=customer_id,
+        defaults={'status': 'open'}
+    )
+    if created:
+        apply_stats_delta(**new_session_delta())
+    return chat_session
+
+
+def _attachment_payload(file_path, name, size, content_type):
+    # Images get a preview; the UIs load the original only when it is clicked
+    thumbnail_path = None
+    if content_type in IMAGE_CONTENT_TYPES:
+        # Rendered in the background unless this image was uploaded before; the message gets it when ready
+        thumbnail_path = stored_thumbnail(file_path)
+        if thumbnail_path is None:
+            create_thumbnail(file_path)
+    return {
+        'attachment_url': default_storage.url(file_path),
+        'attachment_path': file_path,  # Full path for database storage
+        'attachment_name': name,
+        'file_size': size,
+        'content_type': content_type,
+        'thumbnail_url': default_storage.url(thumbnail_path) if thumbnail_path else None,
+        'thumbnail_path': thumbnail_path
+    }
+
+
+def _get_upload(request, upload_id):
+    # Only the customer who started an upload may see, extend or finish it
+    return ChunkedUpload.objects.get(id=upload_id, customer_id=request.GET.get('customer_id'))
+
+
+def _upload_state(upload):
+    response = Response({
+        'upload_id': str(upload.id),
+        'offset': upload.received,
+        'size': upload.size,
+        'chunk_size': settings.CHAT_UPLOAD_CHUNK_SIZE,
+        'status': upload.status,
+    })
+    response['Upload-Offset'] = str(upload.received)
+    return response
+
+
+@api_view(['POST'])
+@authentication_classes([CsrfExemptSessionAuthentication])
+@permission_classes([AllowAny])
+def start_upload_view(request):
+    """
+    Start a chunked, resumable upload
+    
+    Takes JSON customer_id, filename, size and content_type; oversized files and
+    disallowed types are rejected here, before any bytes are sent. The file is
+    then sent with PUT requests to api/chat/upload/<upload_id>/ and finished
+    with POST api/chat/upload/<upload_id>/complete/, both with the same
+    ?customer_id= (other customers get a 404).
+    """
+    try:
+        customer_id = request.data.get('customer_id')
+        filename = request.data.get('filename')
+        if not customer_id or not filename:
+            return Response({'error': 'customer_id and filename are required'}, 
+                          status=status.HTTP_400_BAD_REQUEST)
         
-        # Generate unique filename
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        random_id = str(uuid.uuid4())[:8]
-        file_ext = os.path.splitext(attachment.name)[1]
-        filename = f'{customer_id}_{timestamp}_{random_id}{file_ext}'
+        try:
+            size = int(request.data.get('size'))
+        except (TypeError, ValueError):
+            return Response({'error': 'size must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Save file to chat_attachments directory
-        file_path = default_storage.save(f'chat_attachments/{filename}', attachment)
-        file_url = default_storage.url(file_path)
+        try:
+            upload = start_upload(customer_id, filename, size, request.data.get('content_type'))
+        except UploadError as e:
+            return Response({'error': str(e)}, status=e.status)
         
-        # Return file info (message will be created later via WebSocket)
-        return Response({
-            'attachment_url': file_url,
-            'attachment_path': file_path,  # Full path for database storage
-            'attachment_name': attachment.name,
-            'file_size': attachment.size,
-            'content_type': attachment.content_type
-        }, status=status.HTTP_201_CREATED)
+        response = _upload_state(upload)
+        response.status_code = status.HTTP_201_CREATED
+        return response
         
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(['GET', 'PUT'])
+@authentication_classes([CsrfExemptSessionAuthentication])
+@permission_classes([AllowAny])
+def upload_chunk(request, upload_id):
+    """
+    GET: how many bytes of the upload have been received (to resume from)
+    PUT: append the raw request body at the Upload-Offset header's offset
+    
+    A PUT whose Upload-Offset is not the received byte count gets a 409 with
+    the current offset. The body is streamed to disk, never held in memory.
+    """
+    try:
+        upload = _get_upload(request, upload_id)
+        if request.method == 'GET':
+            return _upload_state(upload)
+        
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return Response({'error': 'Upload-Offset header is required'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            write_chunk(upload, offset, length, request.stream)
+        except UploadError as e:
+            if e.status == status.HTTP_409_CONFLICT:
+                response = _upload_state(upload)
+                response.status_code = e.status
+                response.data['error'] = str(e)
+                return response
+            return Response({'error': str(e)}, status=e.status)
+        
+        return _upload_state(upload)
+        
+    except ChunkedUpload.DoesNotExist:
+        return Response({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+    except Exception as e:
+        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['POST'])
+@authentication_classes([CsrfExemptSessionAuthentication])
+@permission_classes([AllowAny])
+def complete_upload(request, upload_id):
+    """Finish a fully received upload and return the same file info as upload_attachment"""
+    try:
+        upload = _get_upload(request, upload_id)
+        try:
+            file_path = finish_upload(upload)
+        except UploadError as e:
+            return Response({'error': str(e), 'offset': upload.received}, status=e.status)
+        
+        _ensure_chat_session(upload.customer_id)
+        return Response(
+            _attachment_payload(file_path, upload.filename, upload.size, upload.content_type),
+            status=status.HTTP_201_CREATED
+        )
+        
+    except ChunkedUpload.DoesNotExist:
+        return Response({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+    except Exception as e:
+        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 # Admin API Views
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@read_from_replica
 def admin_chat_sessions(request):
-    """Get all chat sessions for admin dashboard"""
+    """
+    Get chat sessions for admin dashboard, most recently updated first
+    
+    Filters: ?status=open|closed and ?assignee=me|none|<user_id>.
+    Pages with ?cursor=<cursor> from the previous response's 'next' value.
+    Runs a single query per page regardless of how many sessions exist.
+    """
     try:
-        sessions = ChatSession.objects.all()
+        sessions = ChatSession.objects.select_related('last_message')
         status_filter = request.GET.get('status')
         if status_filter:
             sessions = sessions.filter(status=status_filter)
         
-        serializer = ChatSessionSerializer(sessions, many=True)
-        return Response(serializer.data)
+        assignee = request.GET.get('assignee')
+        if assignee == 'me':
+            sessions = sessions.filter(admin_user=request.user)
+        elif assignee == 'none':
+            sessions = sessions.filter(admin_user__isnull=True)
+        elif assignee:
+            sessions = sessions.filter(admin_user_id=int(assignee))
+        
+        cursor = request.GET.get('cursor')
+        if cursor:
+            updated_at, pk = decode_cursor(cursor)
+            sessions = sessions.filter(keyset_before('updated_at', updated_at, pk))
+        
+        limit = get_page_size(request)
+        page = list(sessions.order_by('-updated_at', '-id')[:limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit]
+        
+        serializer = ChatSessionSerializer(page, many=True)
+        return Response({
+            'results': serializer.data,
+            'next': encode_cursor(page[-1].updated_at, page[-1].id) if has_more else None,
+            'has_more': has_more,
+        })
+    except (ValueError, ValidationError):
+        return Response({'error': 'Invalid cursor or assignee'}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def admin_search(request):
+    """
+    Ranked full-text search over customer details and message text
+    
+    Query with ?q=<terms>; terms are prefix-matched and all must appear.
+    Filter with ?status=open|closed. Pages with ?page=<n> (1-based) and ?limit=<n>.
+    """
+    try:
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return Response({'error': 'Search query is required'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        page_number = max(int(request.GET.get('page', 1)), 1)
+        limit = get_page_size(request)
+        results = search_conversations(
+            query, limit=limit + 1, offset=(page_number - 1) * limit, status=request.GET.get('status') or None
+        )
+        has_more = len(results) > limit
+        results = results[:limit]
+        
+        return Response({
+            'results': [
+                {
+                    'session': ChatSessionSummarySerializer(result['session']).data,
+                    'snippet': result['snippet'],
+                    'matches': result['matches'],
+                    'score': result['score'],
+                }
+                for result in results
+            ],
+            'page': page_number,
+            'has_more': has_more,
+        })
+    except ValueError:
+        return Response({'error': 'Invalid page'}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def admin_presence(request):
+    """
+    Agents that currently have an admin dashboard open
+    """
+    try:
+        agents = async_to_sync(agent_presence.online_agents)()
+        return Response({'online': bool(agents), 'agents': agents})
+    except Exception as e:
+        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def admin_metrics(request):
+    """
+    Runtime metrics for the worker that serves the request
+    """
+    try:
+        return Response({'db_executor': db_executor_metrics(), 'db_pools': pool_metrics()})
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -229,11 +541,8 @@ def admin_chat_detail(request, session_id):
         messages = chat_session.messages.all()
         
         # Mark customer messages as read
-        Message.objects.filter(
-            chat_session=chat_session,
-            sender_type='customer',
-            is_read=False
-        ).update(is_read=True)
+        marked_read = chat_session.mark_customer_messages_read()
+        apply_stats_delta(unread_messages=-marked_read)
         
         session_serializer = ChatSessionSerializer(chat_session)
         messages_serializer = MessageSerializer(messages, many=True)
@@ -257,6 +566,7 @@ def admin_update_chat_status(request, session_id):
         new_status = request.data.get('status')
         
         if new_status in ['open', 'closed']:
+            apply_stats_delta(**status_change_delta(chat_session.status, new_status))
             chat_session.status = new_status
             chat_session.save()
             
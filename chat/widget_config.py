@@ -0,0 +1,57 @@
+"""
+Process-local cache of the public widget configuration
+
+Every page that embeds the widget fetches its configuration, while the
+configuration itself changes rarely. Each worker keeps the serialized
+configuration and its ETag in memory and only reads the database again when
+the shared version stamp (bumped by the ChatWidget save/delete signals, i.e.
+by widget_settings and the admin, in any worker) changes. The ETag is a hash
+of the configuration, so every worker hands out the same one.
+"""
+import hashlib
+import json
+
+from django.utils.http import quote_etag
+
+from .models import ChatWidget
+from .serializers import ChatWidgetSerializer
+from .versioned_cache import VersionedCache
+
+
+WIDGET_CONFIG_VERSION_CACHE_KEY = 'chat:widget_config:version'
+
+# How often (in seconds) a worker checks the shared version stamp
+WIDGET_CONFIG_VERSION_CHECK_INTERVAL = 5
+
+# Used when no widget is configured
+DEFAULT_WIDGET_CONFIG = {
+    'name': 'Defmis Agent',
+    'welcome_message': 'Hi there! How can we help you today?',
+    'primary_color': '#007bff',
+    'widget_position': 'bottom-right',
+    'is_active': True
+}
+
+
+def _load_config():
+    widget = ChatWidget.objects.filter(is_active=True).first()
+    data = dict(ChatWidgetSerializer(widget).data) if widget else dict(DEFAULT_WIDGET_CONFIG)
+    etag = quote_etag(hashlib.md5(json.dumps(data, sort_keys=True).encode()).hexdigest())
+    return data, etag
+
+
+_config = VersionedCache(WIDGET_CONFIG_VERSION_CACHE_KEY, _load_config, WIDGET_CONFIG_VERSION_CHECK_INTERVAL)
+
+
+def invalidate_widget_config():
+    """Bump the shared version stamp so every worker reloads the configuration"""
+    _config.invalidate()
+
+
+def get_widget_config():
+    """
+    Return (config, etag) for the active widget
+    The shared version stamp is checked at most every WIDGET_CONFIG_VERSION_CHECK_INTERVAL
+    seconds; the database is only read when the configuration has changed.
+    """
+    return _config.get()
@@ -0,0 +1,179 @@
+"""
+WebSocket wire protocols for the chat consumers
+
+Plain JSON stays the default. Clients can opt into a more compact encoding by
+offering a WebSocket subprotocol when they connect; the consumer accepts the
+first one it supports, in server preference order:
+
+- defmis.msgpack.v1: binary msgpack frames with short field codes
+- defmis.compact.v1: JSON text frames with short field codes (no client library needed)
+
+Short codes replace the repeated keys (and the event type names) of every
+frame, e.g. {"type": "chat_message", "sender_type": "admin"} becomes
+{"t": "cm", "s": "admin"}. Unknown keys pass through unchanged, so new fields
+work before they get a code. Keep FIELD_CODES and TYPE_CODES in sync with
+static/js/chat-widget.js and static/js/wire-protocol.js.
+"""
+import json
+
+import msgpack
+
+
+FIELD_CODES = {
+    'type': 't',
+    'message': 'm',
+    'sender_type': 's',
+    'sender_name': 'n',
+    'timestamp': 'ts',
+    'message_id': 'mi',
+    'attachment_url': 'a',
+    'attachment_path': 'ap',
+    'thumbnail_url': 'th',
+    'thumbnail_path': 'thp',
+    'chat_session_id': 'c',
+    'customer_id': 'u',
+    'customer_name': 'un',
+    'customer_email': 'ue',
+    'status': 'x',
+    'closed_by': 'cb',
+    'reopened_by': 'rb',
+    'stats': 'st',
+    'stats_delta': 'sd',
+    'session': 'se',
+    'sessions': 'ss',
+    'unread_count': 'uc',
+    'last_message_preview': 'lp',
+    'updated_at': 'ua',
+    'total_sessions': 'tt',
+    'open_sessions': 'os',
+    'closed_sessions': 'cs',
+    'unread_messages': 'um',
+    'recent_sessions': 'rs',
+    'topics': 'tp',
+    'limit': 'l',
+    'batch_ms': 'bm',
+    'error': 'e',
+}
+
+TYPE_CODES = {
+    'chat_message': 'cm',
+    'close_conversation': 'clc',
+    'conversation_closed': 'cc',
+    'conversation_reopened': 'cr',
+    'new_message_notification': 'nm',
+    'admin_message': 'am',
+    'admin_message_sent': 'as',
+    'admin_close_conversation': 'acc',
+    'admin_reopen_conversation': 'arc',
+    'conversation_status_changed': 'sc',
+    'session_update': 'su',
+    'stats_update': 'sx',
+    'thumbnail_ready': 'tr',
+    'conversations_snapshot': 'snap',
+    'subscribe': 'sub',
+    'unsubscribe': 'unsub',
+    'subscriptions': 'subs',
+    'configure': 'conf',
+    'configured': 'cfg',
+    'error': 'err',
+}
+
+_FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+_TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+
+def shorten(payload):
+    """Replace known keys and event types with their short codes"""
+    if isinstance(payload, list):
+        return [shorten(item) for item in payload]
+    if not isinstance(payload, dict):
+        return payload
+    short = {}
+    for key, value in payload.items():
+        if key == 'type':
+            value = TYPE_CODES.get(value, value)
+        short[FIELD_CODES.get(key, key)] = shorten(value)
+    return short
+
+
+def expand(payload):
+    """Inverse of shorten()"""
+    if isinstance(payload, list):
+        return [expand(item) for item in payload]
+    if not isinstance(payload, dict):
+        return payload
+    full = {}
+    for key, value in payload.items():
+        key = _FIELD_NAMES.get(key, key)
+        if key == 'type':
+            value = _TYPE_NAMES.get(value, value)
+        full[key] = expand(value)
+    return full
+
+
+class JsonCodec:
+    """Plain JSON text frames (the default when no subprotocol is negotiated)"""
+    subprotocol = None
+    binary = False
+
+    def encode(self, payload):
+        return json.dumps(payload)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class CompactJsonCodec:
+    """JSON text frames with short field codes and no whitespace"""
+    subprotocol = 'defmis.compact.v1'
+    binary = False
+
+    def encode(self, payload):
+        return json.dumps(shorten(payload), separators=(',', ':'), ensure_ascii=False)
+
+    def decode(self, data):
+        return expand(json.loads(data))
+
+
+class MsgpackCodec:
+    """Binary msgpack frames with short field codes"""
+    subprotocol = 'defmis.msgpack.v1'
+    binary = True
+
+    def encode(self, payload):
+        return msgpack.packb(shorten(payload))
+
+    def decode(self, data):
+        return expand(msgpack.unpackb(data))
+
+
+# Server preference order for negotiation
+CODECS = [MsgpackCodec(), CompactJsonCodec()]
+DEFAULT_CODEC = JsonCodec()
+
+
+def negotiate(offered):
+    """Pick the codec for the subprotocols a client offered"""
+    for codec in CODECS:
+        if codec.subprotocol in offered:
+            return codec
+    return DEFAULT_CODEC
+
+
+class WireProtocolMixin:
+    """Subprotocol negotiation and encoding for AsyncWebsocketConsumer subclasses"""
+    codec = DEFAULT_CODEC
+
+    async def accept_negotiated(self):
+        self.codec = negotiate(self.scope.get('subprotocols') or [])
+        await self.accept(subprotocol=self.codec.subprotocol)
+
+    async def send_payload(self, payload):
+        data = self.codec.encode(payload)
+        if self.codec.binary:
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        return self.codec.decode(text_data if text_data is not None else bytes_data)
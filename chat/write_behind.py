@@ -0,0 +1,263 @@
+"""
+Write-behind message persistence
+
+When CHAT_WRITE_BEHIND is enabled, the chat consumers hand new messages to a
+per-worker buffer instead of inserting them one by one. The buffer collects
+messages from every socket in the worker for up to
+CHAT_WRITE_BEHIND_MAX_DELAY_MS milliseconds (or CHAT_WRITE_BEHIND_BATCH_SIZE
+messages) and writes them with a single bulk_create, one session counter
+update per conversation and one executor hop for the whole batch.
+
+Each caller waits for its batch to commit, so it still gets the message id and
+timestamp back before fanning the message out. If a batch fails, its messages
+are retried one at a time so a single bad message cannot fail the others.
+Anything still queued when the worker shuts down is written before exit.
+"""
+import asyncio
+import atexit
+import contextvars
+import logging
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .db_executor import db_sync_to_async
+from .db_router import anote_write
+from .models import AttachmentBlob, ChatSession, Message, ScheduledResponse
+from .search import index_messages
+from .stats import add_stats, apply_stats_delta, new_session_delta
+from .thumbnails import thumbnail_new_messages
+
+logger = logging.getLogger(__name__)
+
+
+PendingMessage = namedtuple(
+    'PendingMessage',
+    ['customer_id', 'content', 'sender_type', 'sender_name', 'attachment_path', 'from_admin', 'thumbnail_path'],
+    defaults=(None,),
+)
+
+
+def write_behind_enabled():
+    return getattr(settings, 'CHAT_WRITE_BEHIND', False)
+
+
+def _insert_batch(items):
+    """
+    Insert one batch of PendingMessage items; must run inside a transaction
+    Returns one result per item: (chat_session_id, message, stats delta) or the
+    exception for an item that could not be saved. The deltas add up to the
+    change in the dashboard counters.
+    """
+    sessions = {
+        chat_session.customer_id: chat_session
+        for chat_session in ChatSession.objects.filter(customer_id__in={item.customer_id for item in items})
+    }
+
+    # Customer messages start a conversation if needed; admin messages need an existing one
+    results = []
+    by_session = OrderedDict()
+    for item in items:
+        chat_session = sessions.get(item.customer_id)
+        if chat_session is None:
+            if item.from_admin:
+                results.append(ChatSession.DoesNotExist(f'No chat session for customer {item.customer_id}'))
+                continue
+            chat_session, created = ChatSession.objects.get_or_create(
+                customer_id=item.customer_id,
+                defaults={'status': 'open'}
+            )
+            sessions[item.customer_id] = chat_session
+            stats_delta = new_session_delta() if created else {}
+        else:
+            stats_delta = {}
+
+        message = Message(
+            chat_session=chat_session,
+            content=item.content,
+            sender_type=item.sender_type,
+            sender_name=item.sender_name,
+            attachment=item.attachment_path if item.attachment_path else None,
+            attachment_thumbnail=item.thumbnail_path if item.thumbnail_path else None
+        )
+        by_session.setdefault(chat_session.pk, []).append((item, message, stats_delta))
+        results.append((chat_session.pk, message, stats_delta))
+
+    # An admin reply marks everything the customer sent before it as read
+    reset_unread = set()
+    for session_id, entries in by_session.items():
+        last_admin = max((i for i, (item, _, _) in enumerate(entries) if item.from_admin), default=-1)
+        if last_admin < 0:
+            continue
+        reset_unread.add(session_id)
+        entries[last_admin][2]['unread_messages'] = -Message.objects.filter(
+            chat_session_id=session_id,
+            sender_type='customer',
+            is_read=False
+        ).update(is_read=True)
+        # bulk_create skips Message.save(), which does this for single admin messages
+        ScheduledResponse.cancel_pending(session_id)
+        for _, message, _ in entries[:last_admin]:
+            message.is_read = True
+
+    messages = [message for entries in by_session.values() for _, message, _ in entries]
+    Message.objects.bulk_create(messages)
+    index_messages(messages)
+    AttachmentBlob.add_references([message.attachment.name for message in messages if message.attachment])
+    thumbnail_new_messages(messages)
+
+    # One counter update per conversation, matching what Message.save() does per row
+    for session_id, entries in by_session.items():
+        customer_messages = [message for _, message, _ in entries if message.sender_type == 'customer']
+        unread = sum(1 for message in customer_messages if not message.is_read)
+        last_message = entries[-1][1]
+        for _, message, stats_delta in entries:
+            if message.sender_type == 'customer' and not message.is_read:
+                stats_delta['unread_messages'] = stats_delta.get('unread_messages', 0) + 1
+        ChatSession.objects.filter(pk=session_id).update(
+            unread_count=unread if session_id in reset_unread else F('unread_count') + unread,
+            customer_message_count=F('customer_message_count') + len(customer_messages),
+            last_message=last_message,
+            last_message_preview=last_message.preview,
+            last_activity_at=last_message.timestamp,
+            updated_at=last_message.timestamp,
+        )
+
+    return results
+
+
+def _total_delta(results):
+    total = {}
+    for result in results:
+        if not isinstance(result, Exception):
+            total = add_stats(total, result[2])
+    return total
+
+
+def write_message_batch(items):
+    """
+    Persist PendingMessage items, falling back to one transaction per item if the batch fails
+    Returns one (chat_session, message, stats delta) tuple or exception per item, in order
+    """
+    try:
+        with transaction.atomic():
+            results = _insert_batch(items)
+        apply_stats_delta(**_total_delta(results))
+    except Exception:
+        logger.exception('Batched insert of %d messages failed, retrying one at a time', len(items))
+        results = []
+        for item in items:
+            try:
+                with transaction.atomic():
+                    item_results = _insert_batch([item])
+                apply_stats_delta(**_total_delta(item_results))
+                results.extend(item_results)
+            except Exception as e:
+                results.append(e)
+
+    saved_session_ids = {result[0] for result in results if not isinstance(result, Exception)}
+    if not saved_session_ids:
+        return results
+
+    sessions = ChatSession.objects.in_bulk(saved_session_ids)
+    return [
+        result if isinstance(result, Exception) else (sessions[result[0]], result[1], result[2])
+        for result in results
+    ]
+
+
+class MessageWriteBuffer:
+    """Per-worker buffer that coalesces message inserts into bulk_create batches"""
+
+    def __init__(self):
+        self._pending = []
+        self._loop = None
+        self._task = None
+        self._wakeup = None
+        self._full = None
+        atexit.register(self._flush_at_exit)
+
+    @property
+    def batch_size(self):
+        return max(1, getattr(settings, 'CHAT_WRITE_BEHIND_BATCH_SIZE', 100))
+
+    @property
+    def max_delay(self):
+        return getattr(settings, 'CHAT_WRITE_BEHIND_MAX_DELAY_MS', 5) / 1000
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._task is not None and self._loop is loop and not self._task.done():
+            return
+        self._loop = loop
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        # Run in a fresh context so batch writes are not attributed to the socket that started the task
+        self._task = loop.create_task(self._run(), context=contextvars.Context())
+
+    async def write(self, customer_id, content, sender_type, sender_name, attachment_path=None, from_admin=False,
+                    thumbnail_path=None):
+        """
+        Queue a message for the next batch and wait for it to be committed
+        Returns (chat_session, message, stats delta) like the consumers' save methods
+        """
+        self._ensure_started()
+        future = self._loop.create_future()
+        self._pending.append((
+            PendingMessage(customer_id, content, sender_type, sender_name, attachment_path, from_admin, thumbnail_path),
+            future,
+        ))
+        self._wakeup.set()
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+        result = await future
+        # The batch was written by the buffer task, so pin the caller's reads here
+        await anote_write()
+        return result
+
+    async def flush(self):
+        """Write everything queued so far"""
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            self._pending = self._pending[self.batch_size:]
+            try:
+                results = await db_sync_to_async(write_message_batch)([item for item, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    async def _run(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                # Give other sockets a few milliseconds to join the batch
+                if len(self._pending) < self.batch_size:
+                    try:
+                        await asyncio.wait_for(self._full.wait(), timeout=self.max_delay)
+                    except asyncio.TimeoutError:
+                        pass
+                self._wakeup.clear()
+                self._full.clear()
+                await self.flush()
+        except asyncio.CancelledError:
+            # The worker is shutting down; write what is left before the task ends
+            await self.flush()
+            raise
+
+    def _flush_at_exit(self):
+        """Last-resort synchronous write for messages left behind by a stopped event loop"""
+        pending, self._pending = self._pending, []
+        if pending:
+            write_message_batch([item for item, _ in pending])
+
+
+message_writer = MessageWriteBuffer()
@@ -60,6 +60,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'chat.db_router.PrimaryPinMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -108,6 +109,34 @@ else:
         }
     }
 
+# Optional read replicas (comma-separated database URLs). History, session
+# listings and dashboard pages read from them; see chat/db_router.py
+DATABASE_REPLICA_URLS = config('DATABASE_REPLICA_URLS', default='', cast=Csv())
+for index, replica_url in enumerate(DATABASE_REPLICA_URLS):
+    DATABASES[f'replica_{index}'] = dj_database_url.parse(replica_url, conn_max_age=600)
+    DATABASES[f'replica_{index}']['TEST'] = {'MIRROR': 'default'}
+
+DATABASE_ROUTERS = ['chat.db_router.ReplicaRouter']
+
+# Optional PostgreSQL connection pool shared by HTTP views and consumer
+# database calls; connections are returned after every request and call
+CHAT_DB_POOL = config('CHAT_DB_POOL', default=False, cast=bool)
+if CHAT_DB_POOL:
+    for database in DATABASES.values():
+        if database['ENGINE'] == 'django.db.backends.postgresql':
+            database['ENGINE'] = 'chat.db_pool'
+            database['CONN_MAX_AGE'] = 0
+            database['POOL'] = {
+                'MIN_SIZE': config('CHAT_DB_POOL_MIN_SIZE', default=2, cast=int),
+                'MAX_SIZE': config('CHAT_DB_POOL_MAX_SIZE', default=10, cast=int),
+                'TIMEOUT': config('CHAT_DB_POOL_TIMEOUT', default=10.0, cast=float),
+                'CHECK_INTERVAL': config('CHAT_DB_POOL_CHECK_INTERVAL', default=30.0, cast=float),
+                'MAX_IDLE': config('CHAT_DB_POOL_MAX_IDLE', default=300.0, cast=float),
+            }
+
+# Seconds a writer keeps reading from the primary after a write
+CHAT_REPLICA_PIN_SECONDS = config('CHAT_REPLICA_PIN_SECONDS', default=5, cast=int)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -190,6 +219,61 @@ else:
         },
     }
 
+# Cache - shared across workers when Redis is available
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+
+# Write-behind message persistence: coalesce inserts from all sockets in a
+# worker into bulk_create batches (see chat/write_behind.py)
+CHAT_WRITE_BEHIND = config('CHAT_WRITE_BEHIND', default=False, cast=bool)
+CHAT_WRITE_BEHIND_BATCH_SIZE = config('CHAT_WRITE_BEHIND_BATCH_SIZE', default=100, cast=int)
+CHAT_WRITE_BEHIND_MAX_DELAY_MS = config('CHAT_WRITE_BEHIND_MAX_DELAY_MS', default=5, cast=int)
+
+# Default outbound batch window for admin dashboard sockets, in milliseconds
+# (0 sends every event as its own frame; clients can override with ?batch_ms=)
+CHAT_ADMIN_BATCH_WINDOW_MS = config('CHAT_ADMIN_BATCH_WINDOW_MS', default=0, cast=int)
+
+# Threads in the chat consumers' database executor (0 = 1 on SQLite, 8 otherwise)
+CHAT_DB_EXECUTOR_WORKERS = config('CHAT_DB_EXECUTOR_WORKERS', default=0, cast=int)
+
+# Chunked attachment uploads: where partial files are kept (must be shared by
+# every worker), the largest chunk accepted per request in bytes, and how long
+# an unfinished upload or an attachment no message uses is kept before
+# purge_stale_uploads deletes it
+CHAT_UPLOAD_TEMP_DIR = config('CHAT_UPLOAD_TEMP_DIR', default=str(MEDIA_ROOT / 'chat_uploads_tmp'))
+CHAT_UPLOAD_CHUNK_SIZE = config('CHAT_UPLOAD_CHUNK_SIZE', default=1024 * 1024, cast=int)
+CHAT_UPLOAD_EXPIRY_HOURS = config('CHAT_UPLOAD_EXPIRY_HOURS', default=24, cast=int)
+
+# Image attachment previews: processes rendering thumbnails per worker, longest
+# side in pixels, and how long rendering one may take in seconds (thumbnails are
+# made in the background, so requests never wait for them)
+CHAT_THUMBNAIL_WORKERS = config('CHAT_THUMBNAIL_WORKERS', default=2, cast=int)
+CHAT_THUMBNAIL_SIZE = config('CHAT_THUMBNAIL_SIZE', default=480, cast=int)
+CHAT_THUMBNAIL_TIMEOUT = config('CHAT_THUMBNAIL_TIMEOUT', default=10.0, cast=float)
+
+# Attachment serving (see chat/serving.py): hand files to the front-end server
+# with 'x-accel-redirect' (nginx, under CHAT_ATTACHMENT_ACCEL_PREFIX) or
+# 'x-sendfile', or leave empty to stream them from Django; browser cache
+# lifetime in seconds for attachments that are not content addressed
+CHAT_ATTACHMENT_SENDFILE = config('CHAT_ATTACHMENT_SENDFILE', default='')
+CHAT_ATTACHMENT_ACCEL_PREFIX = config('CHAT_ATTACHMENT_ACCEL_PREFIX', default='/protected-media/')
+CHAT_ATTACHMENT_MAX_AGE = config('CHAT_ATTACHMENT_MAX_AGE', default=3600, cast=int)
+
+# How long browsers and proxies may reuse the public widget configuration, in
+# seconds (changes made in widget settings show up within this time)
+CHAT_WIDGET_CONFIG_MAX_AGE = config('CHAT_WIDGET_CONFIG_MAX_AGE', default=300, cast=int)
+
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = DEBUG  # Only for development
 CORS_ALLOWED_ORIGINS = [
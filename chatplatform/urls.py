@@ -14,11 +14,14 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from django.conf import settings
 from django.conf.urls.static import static
 from django.shortcuts import render
+from chat.serving import serve_attachment
 
 def demo_view(request):
     return render(request, 'demo.html')
@@ -29,6 +32,12 @@ urlpatterns = [
     path('dashboard/', include('dashboard.urls')),
     path('chat/', include('chat.urls')),
     path('accounts/', include('accounts.urls')),
+    # Chat attachments are served with range, conditional and cache headers in every environment
+    re_path(
+        r'^%s(?P<path>chat_attachments/.+)$' % re.escape(settings.MEDIA_URL.lstrip('/')),
+        serve_attachment,
+        name='chat_attachment',
+    ),
 ]
 
 # Serve media files during development
@@ -3,44 +3,34 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import authenticate, login, logout
 from django.contrib import messages
-from django.db.models import Count, Q
-from chat.models import ChatSession, Message
-from django.utils import timezone
-from datetime import timedelta
+from django.db.models import Count
+from chat.db_router import read_from_replica
+from chat.models import ChatSession
+from chat.search import search_conversations
+from chat.stats import apply_stats_delta, get_stats
+
+
+CONVERSATIONS_PER_PAGE = 50
 
 
 @login_required(login_url='dashboard:login')
+@read_from_replica
 def dashboard_home(request):
     if not request.user.is_staff:
         messages.error(request, 'You need staff privileges to access the dashboard.')
         return redirect('dashboard:login')
     """Admin dashboard home page with statistics"""
-    # Get statistics
-    total_sessions = ChatSession.objects.count()
-    open_sessions = ChatSession.objects.filter(status='open').count()
-    closed_sessions = ChatSession.objects.filter(status='closed').count()
-    unread_messages = Message.objects.filter(sender_type='customer', is_read=False).count()
-    
-    # Get recent activity (last 7 days)
-    week_ago = timezone.now() - timedelta(days=7)
-    recent_sessions = ChatSession.objects.filter(created_at__gte=week_ago).count()
+    # Get statistics (cached snapshot, kept current by the chat consumers)
+    context = get_stats()
     
     # Get recent conversations
-    recent_conversations = ChatSession.objects.select_related().prefetch_related('messages')[:10]
-    
-    context = {
-        'total_sessions': total_sessions,
-        'open_sessions': open_sessions,
-        'closed_sessions': closed_sessions,
-        'unread_messages': unread_messages,
-        'recent_sessions': recent_sessions,
-        'recent_conversations': recent_conversations,
-    }
+    context['recent_conversations'] = ChatSession.objects.all()[:10]
     
     return render(request, 'dashboard/home.html', context)
 
 
 @login_required(login_url='dashboard:login')
+@read_from_replica
 def conversations_list(request):
     if not request.user.is_staff:
         messages.error(request, 'You need staff privileges to access the dashboard.')
@@ -48,23 +38,38 @@ def conversations_list(request):
     """List all conversations with filtering"""
     status_filter = request.GET.get('status', 'all')
     search_query = request.GET.get('search', '')
-    
-    conversations = ChatSession.objects.all().order_by('-updated_at')
-    
-    if status_filter != 'all':
-        conversations = conversations.filter(status=status_filter)
+    try:
+        page_number = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page_number = 1
+    offset = (page_number - 1) * CONVERSATIONS_PER_PAGE
     
     if search_query:
-        conversations = conversations.filter(
-            Q(customer_name__icontains=search_query) |
-            Q(customer_email__icontains=search_query) |
-            Q(customer_id__icontains=search_query)
-        )
+        # Ranked full-text search over customer details and message text, filtered in SQL
+        conversations = []
+        for result in search_conversations(
+            search_query, limit=CONVERSATIONS_PER_PAGE + 1, offset=offset,
+            status=status_filter if status_filter != 'all' else None
+        ):
+            conversation = result['session']
+            conversation.search_snippet = result['snippet']
+            conversations.append(conversation)
+    else:
+        sessions = ChatSession.objects.order_by('-updated_at', '-id')
+        if status_filter != 'all':
+            sessions = sessions.filter(status=status_filter)
+        conversations = list(sessions[offset:offset + CONVERSATIONS_PER_PAGE + 1])
+    
+    # One extra row tells whether there is a next page without counting
+    has_next = len(conversations) > CONVERSATIONS_PER_PAGE
     
     context = {
-        'conversations': conversations,
+        'conversations': conversations[:CONVERSATIONS_PER_PAGE],
         'status_filter': status_filter,
         'search_query': search_query,
+        'page_number': page_number,
+        'has_previous': page_number > 1,
+        'has_next': has_next,
     }
     
     return render(request, 'dashboard/conversations.html', context)
@@ -81,11 +86,8 @@ def conversation_detail(request, session_id):
         messages = conversation.messages.all().order_by('timestamp')
         
         # Mark customer messages as read
-        Message.objects.filter(
-            chat_session=conversation,
-            sender_type='customer',
-            is_read=False
-        ).update(is_read=True)
+        marked_read = conversation.mark_customer_messages_read()
+        apply_stats_delta(unread_messages=-marked_read)
         
         context = {
             'conversation': conversation,
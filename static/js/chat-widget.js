@@ -7,7 +7,8 @@
  *     apiUrl: 'http://localhost:8000',
  *     customerId: null, // Auto-generated if not provided
  *     customerName: '', // Optional
- *     customerEmail: '' // Optional
+ *     customerEmail: '', // Optional
+ *     protocol: 'json' // Optional: 'compact' or 'msgpack' (needs window.MessagePack)
  *   };
  * </script>
  * <script src="http://localhost:8000/static/js/chat-widget.js"></script>
@@ -21,10 +22,40 @@
         apiUrl: window.DEFMISChat?.apiUrl || 'http://localhost:8000',
         customerId: window.DEFMISChat?.customerId || localStorage.getItem('defmis_customer_id') || null,
         customerName: window.DEFMISChat?.customerName || localStorage.getItem('defmis_customer_name') || '',
-        customerEmail: window.DEFMISChat?.customerEmail || localStorage.getItem('defmis_customer_email') || ''
+        customerEmail: window.DEFMISChat?.customerEmail || localStorage.getItem('defmis_customer_email') || '',
+        protocol: window.DEFMISChat?.protocol || 'json'
     };
 
+    // Compact wire protocols (keep the code tables in sync with chat/wire.py)
+    const COMPACT_PROTOCOL = 'defmis.compact.v1';
+    const MSGPACK_PROTOCOL = 'defmis.msgpack.v1';
+    const FIELD_CODES = {
+        type: 't', message: 'm', sender_type: 's', sender_name: 'n', timestamp: 'ts',
+        message_id: 'mi', attachment_url: 'a', attachment_path: 'ap', thumbnail_url: 'th',
+        thumbnail_path: 'thp', chat_session_id: 'c',
+        customer_id: 'u', customer_name: 'un', customer_email: 'ue', status: 'x',
+        closed_by: 'cb', reopened_by: 'rb', stats: 'st', stats_delta: 'sd', session: 'se', sessions: 'ss',
+        unread_count: 'uc', last_message_preview: 'lp', updated_at: 'ua',
+        total_sessions: 'tt', open_sessions: 'os', closed_sessions: 'cs',
+        unread_messages: 'um', recent_sessions: 'rs', topics: 'tp', limit: 'l',
+        batch_ms: 'bm', error: 'e'
+    };
+    const TYPE_CODES = {
+        chat_message: 'cm', close_conversation: 'clc', conversation_closed: 'cc',
+        conversation_reopened: 'cr', new_message_notification: 'nm', admin_message: 'am',
+        admin_message_sent: 'as', admin_close_conversation: 'acc', admin_reopen_conversation: 'arc',
+        conversation_status_changed: 'sc', session_update: 'su', stats_update: 'sx', thumbnail_ready: 'tr',
+        conversations_snapshot: 'snap', subscribe: 'sub', unsubscribe: 'unsub',
+        subscriptions: 'subs', configure: 'conf', configured: 'cfg', error: 'err'
+    };
+    const invertCodes = (codes) => Object.fromEntries(Object.entries(codes).map(([name, code]) => [code, name]));
+    const FIELD_NAMES = invertCodes(FIELD_CODES);
+    const TYPE_NAMES = invertCodes(TYPE_CODES);
+
     let chatSession = null;
+    let historyCursor = null;  // Cursor for the next page of older messages
+    let lastMessageId = null;  // Newest message we have displayed
+    let isLoadingHistory = false;
     let socket = null;
     let widgetConfig = null;
     let isConnected = false;
@@ -413,7 +444,12 @@
     const loadChatHistory = async () => {
         try {
             const response = await fetch(`${config.apiUrl}/chat/api/chat/${config.customerId}/history/`);
-            const messages = await response.json();
+            const data = await response.json();
+            const messages = data.results || [];
+            historyCursor = data.previous;
+            if (messages.length) {
+                lastMessageId = messages[messages.length - 1].id;
+            }
 
             const messagesContainer = document.getElementById('defmis-messages');
             messagesContainer.innerHTML = `
@@ -431,10 +467,7 @@
             `;
 
             messages.forEach(message => {
-                const attachmentUrl = message.attachment ? 
-                    (message.attachment.startsWith('http') ? message.attachment : `${config.apiUrl}${message.attachment}`) : 
-                    null;
-                addMessage(message.content, message.sender_type, message.sender_name || 'Admin', false, attachmentUrl);
+                addMessage(message.content, message.sender_type, message.sender_name || 'Admin', false, getAttachmentUrl(message), false, getThumbnailUrl(message));
             });
 
             scrollToBottom();
@@ -443,28 +476,143 @@
         }
     };
 
+    // Resolve a history message's attachment to an absolute URL
+    const getAttachmentUrl = (message) => {
+        if (!message.attachment) return null;
+        return message.attachment.startsWith('http') ? message.attachment : `${config.apiUrl}${message.attachment}`;
+    };
+
+    const getThumbnailUrl = (message) => {
+        if (!message.attachment_thumbnail) return null;
+        return message.attachment_thumbnail.startsWith('http') ? message.attachment_thumbnail : `${config.apiUrl}${message.attachment_thumbnail}`;
+    };
+
+    // Swap the preview in for an image sent before its thumbnail was ready
+    const showThumbnail = (attachmentUrl, thumbnailUrl) => {
+        const src = thumbnailUrl.startsWith('http') ? thumbnailUrl : `${config.apiUrl}${thumbnailUrl}`;
+        document.querySelectorAll('#defmis-messages a[href] img').forEach((img) => {
+            if (img.parentElement.getAttribute('href').endsWith(attachmentUrl)) {
+                img.src = src;
+            }
+        });
+    };
+
+    // Load the previous page of history when the customer scrolls to the top
+    const loadOlderMessages = async () => {
+        if (!historyCursor || isLoadingHistory) return;
+        isLoadingHistory = true;
+        try {
+            const response = await fetch(`${config.apiUrl}/chat/api/chat/${config.customerId}/history/?before=${encodeURIComponent(historyCursor)}`);
+            const data = await response.json();
+            historyCursor = data.previous;
+
+            const messagesContainer = document.getElementById('defmis-messages');
+            const previousHeight = messagesContainer.scrollHeight;
+            // Insert oldest-last so each message lands above the ones already shown
+            (data.results || []).slice().reverse().forEach(message => {
+                addMessage(message.content, message.sender_type, message.sender_name || 'Admin', false, getAttachmentUrl(message), true, getThumbnailUrl(message));
+            });
+            messagesContainer.scrollTop = messagesContainer.scrollHeight - previousHeight;
+        } catch (error) {
+            console.error('Error loading older messages:', error);
+        } finally {
+            isLoadingHistory = false;
+        }
+    };
+
+    // Fetch messages that arrived while the socket was disconnected
+    const syncMissedMessages = async () => {
+        if (!lastMessageId) return;
+        try {
+            let hasMore = true;
+            while (hasMore) {
+                const response = await fetch(`${config.apiUrl}/chat/api/chat/${config.customerId}/history/?since=${lastMessageId}`);
+                if (!response.ok) return;
+                const data = await response.json();
+                (data.results || []).forEach(message => {
+                    lastMessageId = message.id;
+                    // Customer messages sent while offline are already shown locally
+                    if (message.sender_type !== 'customer') {
+                        addMessage(message.content, message.sender_type, message.sender_name || 'Admin', true, getAttachmentUrl(message), false, getThumbnailUrl(message));
+                    }
+                });
+                hasMore = data.has_more && data.results.length > 0;
+            }
+        } catch (error) {
+            console.error('Error syncing missed messages:', error);
+        }
+    };
+
+    // Swap keys and event types using the given code tables
+    const translateFrame = (payload, keys, types) => {
+        if (Array.isArray(payload)) return payload.map(item => translateFrame(item, keys, types));
+        if (payload === null || typeof payload !== 'object') return payload;
+        const result = {};
+        Object.entries(payload).forEach(([key, value]) => {
+            const name = keys[key] || key;
+            if (name === 'type') value = types[value] || value;
+            result[name] = translateFrame(value, keys, types);
+        });
+        return result;
+    };
+
+    // Subprotocols to offer for the configured wire protocol
+    const offeredProtocols = () => {
+        if (config.protocol === 'msgpack' && window.MessagePack) return [MSGPACK_PROTOCOL, COMPACT_PROTOCOL];
+        if (config.protocol === 'compact' || config.protocol === 'msgpack') return [COMPACT_PROTOCOL];
+        return [];
+    };
+
+    // Decode an incoming frame in whichever protocol the server accepted
+    const decodeFrame = (data) => {
+        if (socket.protocol === MSGPACK_PROTOCOL) {
+            return translateFrame(window.MessagePack.decode(new Uint8Array(data)), FIELD_NAMES, TYPE_NAMES);
+        }
+        if (socket.protocol === COMPACT_PROTOCOL) {
+            return translateFrame(JSON.parse(data), FIELD_NAMES, TYPE_NAMES);
+        }
+        return JSON.parse(data);
+    };
+
+    // Encode and send a frame in the negotiated protocol
+    const sendFrame = (payload) => {
+        if (socket.protocol === MSGPACK_PROTOCOL) {
+            socket.send(window.MessagePack.encode(translateFrame(payload, FIELD_CODES, TYPE_CODES)));
+        } else if (socket.protocol === COMPACT_PROTOCOL) {
+            socket.send(JSON.stringify(translateFrame(payload, FIELD_CODES, TYPE_CODES)));
+        } else {
+            socket.send(JSON.stringify(payload));
+        }
+    };
+
     // Initialize WebSocket connection
     const initWebSocket = () => {
         const wsScheme = config.apiUrl.startsWith('https') ? 'wss' : 'ws';
         const wsUrl = `${wsScheme}://${new URL(config.apiUrl).host}/ws/chat/${config.customerId}/`;
 
-        socket = new WebSocket(wsUrl);
+        socket = new WebSocket(wsUrl, offeredProtocols());
+        socket.binaryType = 'arraybuffer';
 
         socket.onopen = () => {
             isConnected = true;
             updateConnectionStatus('Connected');
+            // Catch up on anything sent while we were disconnected
+            syncMissedMessages();
         };
 
         socket.onmessage = (event) => {
-            const data = JSON.parse(event.data);
+            const data = decodeFrame(event.data);
             console.log('Client widget received WebSocket message:', data);  // Debug log
             
             if (data.type === 'chat_message') {
+                if (data.message_id) {
+                    lastMessageId = data.message_id;
+                }
                 // Display messages from admin or system (automated responses)
                 if (data.sender_type === 'admin' || data.sender_type === 'system') {
                     console.log('Displaying admin/system message:', data.message);  // Debug log
                     const attachmentUrl = data.attachment_url || null;
-                    addMessage(data.message, data.sender_type, data.sender_name, true, attachmentUrl);
+                    addMessage(data.message, data.sender_type, data.sender_name, true, attachmentUrl, false, data.thumbnail_url || null);
                     
                     // Show notification if widget is closed
                     if (!isWidgetOpen) {
@@ -476,6 +624,8 @@
                 handleConversationClosed(data.closed_by);
             } else if (data.type === 'conversation_reopened') {
                 handleConversationReopened(data.reopened_by);
+            } else if (data.type === 'thumbnail_ready') {
+                showThumbnail(data.attachment_url, data.thumbnail_url);
             }
         };
 
@@ -655,6 +805,16 @@
         if (removeFileButton) {
             removeFileButton.addEventListener('click', removeSelectedFile);
         }
+
+        // Load older history when scrolled to the top
+        const messagesContainer = document.getElementById('defmis-messages');
+        if (messagesContainer) {
+            messagesContainer.addEventListener('scroll', () => {
+                if (messagesContainer.scrollTop === 0) {
+                    loadOlderMessages();
+                }
+            });
+        }
     };
 
     // Handle file selection
@@ -706,25 +866,93 @@
         document.getElementById('defmis-file-preview').style.display = 'none';
     };
 
-    const uploadFile = async (file) => {
-        const formData = new FormData();
-        formData.append('file', file);
-        formData.append('customer_id', config.customerId);
-        formData.append('sender_name', config.customerName || 'Customer');
+    // Chunked uploads resume after a dropped connection; the upload id is kept per file
+    const uploadKey = (file) => `defmis_upload_${config.customerId}_${file.name}_${file.size}_${file.lastModified}`;
 
-        try {
-            const response = await fetch(`${config.apiUrl}/chat/api/chat/upload/`, {
-                method: 'POST',
-                body: formData
-            });
+    const uploadRequest = async (url, options, allowConflict = false) => {
+        const response = await fetch(url, options);
+        const data = await response.json();
+        if (!response.ok && !(allowConflict && response.status === 409)) {
+            const error = new Error(data.error || 'Upload failed');
+            error.status = response.status;
+            throw error;
+        }
+        return data;
+    };
 
-            const data = await response.json();
-            
-            if (response.ok) {
-                return data;
-            } else {
-                throw new Error(data.error || 'Upload failed');
+    // An upload only answers to the customer who started it
+    const uploadUrl = (uploadId, action = '') => `${config.apiUrl}/chat/api/chat/upload/${uploadId}/${action}?customer_id=${encodeURIComponent(config.customerId)}`;
+
+    const startUpload = async (file) => {
+        const stored = localStorage.getItem(uploadKey(file));
+        if (stored) {
+            try {
+                const state = await uploadRequest(uploadUrl(stored));
+                if (state.status !== 'complete') return state;
+            } catch (error) {
+                // Expired or unknown upload: start over
+            }
+            localStorage.removeItem(uploadKey(file));
+        }
+
+        const state = await uploadRequest(`${config.apiUrl}/chat/api/chat/upload/start/`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                customer_id: config.customerId,
+                filename: file.name,
+                size: file.size,
+                content_type: file.type
+            })
+        });
+        localStorage.setItem(uploadKey(file), state.upload_id);
+        return state;
+    };
+
+    const uploadFile = async (file) => {
+        let state = await startUpload(file);
+        const chunkUrl = uploadUrl(state.upload_id);
+        let offset = state.offset;
+        let retries = 0;
+
+        while (offset < file.size) {
+            const chunk = file.slice(offset, offset + state.chunk_size);
+            try {
+                // A 409 carries the server's offset, so a lost acknowledgement is not resent
+                const result = await uploadRequest(chunkUrl, {
+                    method: 'PUT',
+                    headers: {
+                        'Content-Type': 'application/offset+octet-stream',
+                        'Upload-Offset': String(offset)
+                    },
+                    body: chunk
+                }, true);
+                if (result.offset === offset) {
+                    // Another request is still sending this chunk; give it time to finish or lapse
+                    await new Promise(resolve => setTimeout(resolve, 1000));
+                }
+                offset = result.offset;
+                retries = 0;
+            } catch (error) {
+                if (error.status || retries >= 5) {
+                    localStorage.removeItem(uploadKey(file));
+                    throw error;
+                }
+                // Network failure: wait, then ask the server where to resume
+                retries += 1;
+                await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+                try {
+                    offset = (await uploadRequest(chunkUrl)).offset;
+                } catch (statusError) {
+                    // Still offline; retry the same chunk
+                }
             }
+        }
+
+        try {
+            const data = await uploadRequest(uploadUrl(state.upload_id, 'complete/'), { method: 'POST' });
+            localStorage.removeItem(uploadKey(file));
+            return data;
         } catch (error) {
             console.error('Error uploading file:', error);
             throw error;
@@ -749,14 +977,16 @@
                 const fileMessage = `📎 ${selectedFile.name}`;
                 
                 if (socket && isConnected) {
-                    socket.send(JSON.stringify({
+                    sendFrame({
                         type: 'chat_message',
                         message: message || fileMessage,
                         sender_type: 'customer',
                         sender_name: config.customerName || 'Customer',
                         attachment_path: uploadData.attachment_path,  // Send path for DB storage
-                        attachment_url: uploadData.attachment_url      // Send URL for display
-                    }));
+                        attachment_url: uploadData.attachment_url,     // Send URL for display
+                        thumbnail_path: uploadData.thumbnail_path,     // Preview of an image attachment
+                        thumbnail_url: uploadData.thumbnail_url
+                    });
                 }
                 
                 // Remove file preview
@@ -778,12 +1008,12 @@
 
         // Send via WebSocket if connected
         if (socket && isConnected) {
-            socket.send(JSON.stringify({
+            sendFrame({
                 type: 'chat_message',
                 message: message,
                 sender_type: 'customer',
                 sender_name: config.customerName || 'Customer'
-            }));
+            });
         } else {
             // Fallback to HTTP API
             fetch(`${config.apiUrl}/chat/api/chat/message/`, {
@@ -804,7 +1034,7 @@
     };
 
     // Add message to UI
-    const addMessage = (content, senderType, senderName, animate = false, attachmentUrl = null) => {
+    const addMessage = (content, senderType, senderName, animate = false, attachmentUrl = null, prepend = false, thumbnailUrl = null) => {
         const messagesContainer = document.getElementById('defmis-messages');
         const isCustomer = senderType === 'customer';
         const isSystem = senderType === 'system';
@@ -874,10 +1104,11 @@
             const isImage = /\.(jpg|jpeg|png|gif|webp)$/i.test(attachmentUrl);
             
             if (isImage) {
+                // Show the preview; the full-size original only loads when clicked
                 messageContent += `
                     <div style="margin-top: 8px;">
                         <a href="${attachmentUrl}" target="_blank">
-                            <img src="${attachmentUrl}" style="max-width: 200px; max-height: 150px; border-radius: 8px; cursor: pointer;" />
+                            <img src="${thumbnailUrl || attachmentUrl}" loading="lazy" style="max-width: 200px; max-height: 150px; border-radius: 8px; cursor: pointer;" />
                         </a>
                     </div>
                 `;
@@ -894,6 +1125,11 @@
         }
 
         messageDiv.innerHTML = messageContent;
+        if (prepend) {
+            // Keep the welcome message first; older history goes right after it
+            messagesContainer.insertBefore(messageDiv, messagesContainer.firstElementChild.nextSibling);
+            return;
+        }
         messagesContainer.appendChild(messageDiv);
         scrollToBottom();
     };
@@ -909,10 +1145,10 @@
         if (confirm('Are you sure you want to end this conversation?')) {
             // Send close message via WebSocket if connected
             if (socket && isConnected) {
-                socket.send(JSON.stringify({
+                sendFrame({
                     type: 'close_conversation',
                     sender_name: config.customerName || 'Customer'
-                }));
+                });
             } else {
                 // Fallback to HTTP API
                 fetch(`${config.apiUrl}/chat/api/admin/session/${chatSession.id}/status/`, {
@@ -987,6 +1223,8 @@
         
         // Reset chat session
         chatSession = null;
+        historyCursor = null;
+        lastMessageId = null;
         
         // Clear messages
         const messagesContainer = document.getElementById('defmis-messages');
@@ -0,0 +1,86 @@
+/**
+ * DEFMIS WebSocket wire protocol helpers for the admin dashboard
+ *
+ * Offers the compact subprotocols when connecting and encodes/decodes frames
+ * for whichever one the server accepted (plain JSON if none). msgpack is only
+ * offered when a decoder is loaded on the page as window.MessagePack
+ * (e.g. the @msgpack/msgpack UMD build).
+ *
+ * Keep FIELD_CODES and TYPE_CODES in sync with chat/wire.py.
+ */
+
+(function() {
+    'use strict';
+
+    const COMPACT = 'defmis.compact.v1';
+    const MSGPACK = 'defmis.msgpack.v1';
+
+    const FIELD_CODES = {
+        type: 't', message: 'm', sender_type: 's', sender_name: 'n', timestamp: 'ts',
+        message_id: 'mi', attachment_url: 'a', attachment_path: 'ap', thumbnail_url: 'th',
+        thumbnail_path: 'thp', chat_session_id: 'c',
+        customer_id: 'u', customer_name: 'un', customer_email: 'ue', status: 'x',
+        closed_by: 'cb', reopened_by: 'rb', stats: 'st', stats_delta: 'sd', session: 'se', sessions: 'ss',
+        unread_count: 'uc', last_message_preview: 'lp', updated_at: 'ua',
+        total_sessions: 'tt', open_sessions: 'os', closed_sessions: 'cs',
+        unread_messages: 'um', recent_sessions: 'rs', topics: 'tp', limit: 'l',
+        batch_ms: 'bm', error: 'e'
+    };
+
+    const TYPE_CODES = {
+        chat_message: 'cm', close_conversation: 'clc', conversation_closed: 'cc',
+        conversation_reopened: 'cr', new_message_notification: 'nm', admin_message: 'am',
+        admin_message_sent: 'as', admin_close_conversation: 'acc', admin_reopen_conversation: 'arc',
+        conversation_status_changed: 'sc', session_update: 'su', stats_update: 'sx', thumbnail_ready: 'tr',
+        conversations_snapshot: 'snap', subscribe: 'sub', unsubscribe: 'unsub',
+        subscriptions: 'subs', configure: 'conf', configured: 'cfg', error: 'err'
+    };
+
+    const invert = (codes) => Object.fromEntries(Object.entries(codes).map(([name, code]) => [code, name]));
+    const FIELD_NAMES = invert(FIELD_CODES);
+    const TYPE_NAMES = invert(TYPE_CODES);
+
+    const translate = (payload, keys, types) => {
+        if (Array.isArray(payload)) return payload.map(item => translate(item, keys, types));
+        if (payload === null || typeof payload !== 'object') return payload;
+        const result = {};
+        Object.entries(payload).forEach(([key, value]) => {
+            const name = keys[key] || key;
+            if (key === 'type' || name === 'type') value = types[value] || value;
+            result[name] = translate(value, keys, types);
+        });
+        return result;
+    };
+
+    const shorten = (payload) => translate(payload, FIELD_CODES, TYPE_CODES);
+    const expand = (payload) => translate(payload, FIELD_NAMES, TYPE_NAMES);
+
+    const protocols = () => (window.MessagePack ? [MSGPACK, COMPACT] : [COMPACT]);
+
+    // Open a socket offering the compact protocols
+    const connect = (url) => {
+        const socket = new WebSocket(url, protocols());
+        socket.binaryType = 'arraybuffer';
+        return socket;
+    };
+
+    // Decode an incoming frame into a plain event object (or array of events)
+    const decode = (socket, data) => {
+        if (socket.protocol === MSGPACK) return expand(window.MessagePack.decode(new Uint8Array(data)));
+        if (socket.protocol === COMPACT) return expand(JSON.parse(data));
+        return JSON.parse(data);
+    };
+
+    // Encode and send an event in the negotiated protocol
+    const send = (socket, payload) => {
+        if (socket.protocol === MSGPACK) {
+            socket.send(window.MessagePack.encode(shorten(payload)));
+        } else if (socket.protocol === COMPACT) {
+            socket.send(JSON.stringify(shorten(payload)));
+        } else {
+            socket.send(JSON.stringify(payload));
+        }
+    };
+
+    window.DefmisWire = { connect, decode, send, shorten, expand };
+})();